@@ -0,0 +1,163 @@
+"""Indici MongoDB per le query dell'API.
+
+Eseguito all'avvio del server (ensure_indexes) e da riga di comando:
+
+    python db_indexes.py            # crea gli indici mancanti
+    python db_indexes.py --report   # indici mancanti, non dichiarati e mai usati
+"""
+import asyncio
+import logging
+import os
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+from pymongo.errors import OperationFailure
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# collezione -> indici. unique dove il codice presuppone l'unicità
+INDEX_SPECS = {
+    "users": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("email", ASCENDING)], unique=True),
+        IndexModel([("last_action_reset", ASCENDING)]),
+    ],
+    "backgrounds": [
+        IndexModel([("user_id", ASCENDING)], unique=True),
+    ],
+    "chat_history": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        # Archivio a pagine: ordinamento (created_at, id) con cursore keyset
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        # Ricerca nell'archivio del PG (user_id in uguaglianza, poi testo)
+        IndexModel(
+            [("user_id", ASCENDING), ("question", TEXT), ("answer", TEXT)],
+            default_language="italian",
+            weights={"question": 2, "answer": 1},
+        ),
+    ],
+    "challenges": [
+        IndexModel([("id", ASCENDING)], unique=True),
+    ],
+    # Una sola prova per PG
+    "challenge_attempts": [
+        IndexModel([("user_id", ASCENDING), ("challenge_id", ASCENDING)], unique=True),
+    ],
+    "aids": [
+        IndexModel([("id", ASCENDING)], unique=True),
+    ],
+    # Ogni livello di un aiuto si usa una volta sola
+    "aid_uses": [
+        IndexModel([("user_id", ASCENDING), ("aid_id", ASCENDING), ("level", ASCENDING)], unique=True),
+    ],
+    "follower_spends": [
+        IndexModel([("user_id", ASCENDING), ("month_key", ASCENDING)]),
+    ],
+    "follower_spend_totals": [
+        IndexModel([("user_id", ASCENDING), ("month_key", ASCENDING)], unique=True),
+    ],
+    "resource_items": [
+        IndexModel([("id", ASCENDING)], unique=True),
+    ],
+    "resource_locks": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("user_id", ASCENDING), ("status", ASCENDING), ("expires_at", ASCENDING)]),
+        IndexModel([("status", ASCENDING), ("expires_at", ASCENDING)]),
+    ],
+    "knowledge_base": [
+        IndexModel([("id", ASCENDING)], unique=True),
+    ],
+    "knowledge_chunks": [
+        # Un chunk per posizione: store_kb_chunks è idempotente anche tra più processi
+        IndexModel([("kb_id", ASCENDING), ("position", ASCENDING)], unique=True),
+        # Ordinamento dello snapshot KB
+        IndexModel([("created_at", ASCENDING), ("kb_id", ASCENDING), ("position", ASCENDING)]),
+    ],
+    "settings": [
+        IndexModel([("id", ASCENDING)], unique=True),
+    ],
+    "collection_versions": [
+        IndexModel([("id", ASCENDING)], unique=True),
+    ],
+    "maintenance": [
+        IndexModel([("id", ASCENDING)], unique=True),
+    ],
+}
+
+
+def index_name(index: IndexModel) -> str:
+    return index.document["name"]
+
+
+async def ensure_indexes(db) -> dict:
+    """Crea gli indici dichiarati che mancano.
+
+    Un indice che non si può creare (es. unique con dati duplicati) viene segnalato e
+    saltato: l'API continua a funzionare, solo senza quell'indice.
+    Ritorna {"created": [...], "failed": [...]} con nomi "collezione.indice".
+    """
+    created, failed = [], []
+    for collection, indexes in INDEX_SPECS.items():
+        existing = await db[collection].index_information()
+        for index in indexes:
+            name = index_name(index)
+            if name in existing:
+                continue
+            try:
+                await db[collection].create_indexes([index])
+                created.append(f"{collection}.{name}")
+            except OperationFailure as e:
+                failed.append(f"{collection}.{name}")
+                logger.error(f"Index {collection}.{name} not created: {e}")
+    if created:
+        logger.info(f"Created indexes: {', '.join(created)}")
+    return {"created": created, "failed": failed}
+
+
+async def index_report(db) -> dict:
+    """Per collezione: indici dichiarati mancanti, indici presenti non dichiarati e mai usati.
+
+    "unused" si basa su $indexStats, che conta gli accessi dall'ultimo riavvio di MongoDB.
+    """
+    report = {}
+    for collection, indexes in INDEX_SPECS.items():
+        declared = {index_name(index) for index in indexes}
+        existing = await db[collection].index_information()
+        usage = {}
+        async for stats in db[collection].aggregate([{"$indexStats": {}}]):
+            usage[stats["name"]] = int(stats["accesses"]["ops"])
+        report[collection] = {
+            "missing": sorted(declared - set(existing)),
+            "undeclared": sorted(set(existing) - declared - {"_id_"}),
+            "unused": sorted(name for name, ops in usage.items() if ops == 0 and name != "_id_"),
+        }
+    return report
+
+
+async def main(report_only: bool):
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+
+    if not report_only:
+        result = await ensure_indexes(db)
+        for name in result["created"]:
+            print(f"✓ Creato {name}")
+        for name in result["failed"]:
+            print(f"✗ Impossibile creare {name} (dati duplicati?)")
+
+    for collection, info in (await index_report(db)).items():
+        for name in info["missing"]:
+            print(f"✗ {collection}: manca {name}")
+        for name in info["undeclared"]:
+            print(f"? {collection}: {name} non dichiarato in INDEX_SPECS")
+        for name in info["unused"]:
+            print(f"- {collection}: {name} mai usato dall'ultimo riavvio")
+
+    client.close()
+
+if __name__ == "__main__":
+    import sys
+    asyncio.run(main("--report" in sys.argv[1:]))
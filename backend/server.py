@@ -1,23 +1,45 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Request, Response, Query
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.background import BackgroundTask
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
 import os
+import re
+import json
+import hashlib
+import math
+import time
+import random
+import asyncio
+import bisect
+import heapq
 import logging
+import unicodedata
+from collections import Counter, OrderedDict, defaultdict, deque
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr, ConfigDict
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 import uuid
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from zoneinfo import ZoneInfo
 import bcrypt
 import jwt
-from emergentintegrations.llm.chat import LlmChat, UserMessage
+from openai import AsyncOpenAI, RateLimitError
+import httpx
 import aiofiles
 import PyPDF2
 import io
+import tiktoken
+
+from db_indexes import ensure_indexes, index_report
 
 # Upload directory
 UPLOAD_DIR = Path(__file__).parent / "uploads"
@@ -52,6 +74,52 @@ JWT_ALGORITHM = "HS256"
 
 # OpenAI Config
 EMERGENT_LLM_KEY = os.environ.get('EMERGENT_LLM_KEY')
+# Endpoint OpenAI-compatibile dell'Oracolo: di default il proxy Emergent per le chiavi universali
+LLM_BASE_URL = os.environ.get('LLM_BASE_URL') or (
+    f"{os.environ.get('INTEGRATION_PROXY_URL', 'https://integrations.emergentagent.com')}/llm"
+    if (EMERGENT_LLM_KEY or "").startswith("sk-emergent-") else None
+)
+
+# Modello dell'Oracolo e client HTTP condiviso (connessioni keep-alive riusate tra le richieste)
+LLM_MODEL = os.environ.get('LLM_MODEL', 'gpt-4o')
+LLM_MAX_TOKENS = int(os.environ['LLM_MAX_TOKENS']) if os.environ.get('LLM_MAX_TOKENS') else None
+LLM_TIMEOUT_SECONDS = float(os.environ.get('LLM_TIMEOUT_SECONDS', '60'))
+
+# Chiamate LLM: massimo in parallelo e retry con backoff esponenziale (jitter) sui rate limit
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', '8'))
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', '3'))
+LLM_RETRY_BASE_SECONDS = float(os.environ.get('LLM_RETRY_BASE_SECONDS', '1'))
+LLM_RETRY_MAX_SECONDS = float(os.environ.get('LLM_RETRY_MAX_SECONDS', '20'))
+
+# Retrieval KB: budget di token per il contesto e numero massimo di chunk selezionati
+KB_CONTEXT_TOKEN_BUDGET = int(os.environ.get('KB_CONTEXT_TOKEN_BUDGET', '6000'))
+KB_TOP_K = int(os.environ.get('KB_TOP_K', '12'))
+KB_CHUNK_TOKENS = int(os.environ.get('KB_CHUNK_TOKENS', '400'))
+# Limite complessivo del prompt (prefisso + contesto + domanda) e della singola domanda
+LLM_MAX_PROMPT_TOKENS = int(os.environ.get('LLM_MAX_PROMPT_TOKENS', '12000'))
+LLM_MAX_QUESTION_TOKENS = int(os.environ.get('LLM_MAX_QUESTION_TOKENS', '1000'))
+# Documenti senza restrizioni messi nel prefisso stabile del prompt (uguale per tutti i PG, cacheabile dal provider)
+KB_SHARED_PREFIX_TOKEN_BUDGET = int(os.environ.get('KB_SHARED_PREFIX_TOKEN_BUDGET', '3000'))
+
+# Cache delle risposte dell'Oracolo (domanda normalizzata + versione KB + documenti visibili)
+ANSWER_CACHE_SIZE = int(os.environ.get('ANSWER_CACHE_SIZE', '512'))
+ANSWER_CACHE_TTL_SECONDS = float(os.environ.get('ANSWER_CACHE_TTL_SECONDS', '1800'))
+# Similarità minima (Jaccard su trigrammi di caratteri) per riusare la risposta a una domanda quasi identica,
+# che deve comunque avere le stesse parole di contenuto e gli stessi numeri; 1 = solo identiche
+ANSWER_CACHE_SIMILARITY = float(os.environ.get('ANSWER_CACHE_SIMILARITY', '1.0'))
+
+# Ogni quanti secondi le versioni delle collezioni vengono rilette da MongoDB (cache tra più processi)
+VERSION_POLL_SECONDS = float(os.environ.get('VERSION_POLL_SECONDS', '2'))
+# Durata in memoria dei dati utente letti in get_current_user (limite di disallineamento tra processi)
+USER_CACHE_TTL_SECONDS = float(os.environ.get('USER_CACHE_TTL_SECONDS', '5'))
+# Intervallo massimo tra due controlli dei lock RISORSE scaduti
+RESOURCE_SWEEP_SECONDS = float(os.environ.get('RESOURCE_SWEEP_SECONDS', '60'))
+# Le spese SEGUACI più recenti di così restano fuori dalla riconciliazione (il loro $inc può essere in corso)
+FOLLOWER_SPEND_SETTLE_SECONDS = float(os.environ.get('FOLLOWER_SPEND_SETTLE_SECONDS', '60'))
+# Per quanti secondi browser e proxy possono riusare /api/settings senza chiedere al server
+SETTINGS_MAX_AGE_SECONDS = int(os.environ.get('SETTINGS_MAX_AGE_SECONDS', '60'))
+# Fuso orario di date e orari delle focalizzazioni inseriti dagli admin
+EVENT_TIMEZONE = ZoneInfo(os.environ.get('EVENT_TIMEZONE', 'Europe/Rome'))
 
 app = FastAPI()
 api_router = APIRouter(prefix="/api")
@@ -112,6 +180,8 @@ class KnowledgeBaseResponse(BaseModel):
 
 class ChatRequest(BaseModel):
     question: str
+    # Se la domanda richiama una prova non ancora tentata, la prova sostituisce la risposta
+    trigger_challenges: bool = False
 
 class ChatResponse(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -121,6 +191,48 @@ class ChatResponse(BaseModel):
     created_at: str
     type: Optional[str] = "chat"
     challenge_data: Optional[dict] = None
+    aid_data: Optional[dict] = None
+
+class ChatReply(ChatResponse):
+    """Risposta di /chat: consultazione salvata oppure, senza consultazione, la prova richiamata"""
+    id: Optional[str] = None
+    answer: Optional[str] = None
+    created_at: Optional[str] = None
+    triggered_challenge: Optional[dict] = None
+    suggested_challenges: List[dict] = []
+
+class ChatHistoryItem(BaseModel):
+    """Voce della lista archivio: solo i campi per la lista, risposta troncata"""
+    model_config = ConfigDict(extra="ignore")
+    id: str
+    question: str
+    answer_preview: str
+    created_at: str
+    type: Optional[str] = "chat"
+    challenge_data: Optional[dict] = None  # solo outcome
+    aid_data: Optional[dict] = None  # solo level_name
+
+class ChatHistoryPage(BaseModel):
+    items: List[ChatHistoryItem]
+    next_cursor: Optional[str] = None  # da passare come before per la pagina successiva
+
+class ChatHistoryHighlight(BaseModel):
+    field: str  # "question" o "answer"
+    snippet: str
+    ranges: List[List[int]]  # [inizio, fine) dei termini trovati nello snippet
+
+class ChatHistorySearchHit(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str
+    question: str
+    created_at: str
+    type: Optional[str] = "chat"
+    highlights: List[ChatHistoryHighlight] = []
+
+class ChatHistorySearchPage(BaseModel):
+    items: List[ChatHistorySearchHit]
+    page: int
+    has_more: bool
 
 class UpdateUserActions(BaseModel):
     max_actions: int
@@ -348,6 +460,9 @@ class AidResponse(BaseModel):
     end_date: Optional[str] = None
     start_time: str
     end_time: str
+    # Finestra di attività in UTC, calcolata al salvataggio
+    starts_at: Optional[datetime] = None
+    ends_at: Optional[datetime] = None
     created_at: str
     created_by: str
 
@@ -356,6 +471,15 @@ class UseAid(BaseModel):
     level: int  # quale livello sta usando (2, 4 o 5)
     player_attribute_value: int  # valore attributo del giocatore
 
+class PlayerState(BaseModel):
+    """Tutto ciò che serve alla Dashboard del PG, in una sola risposta"""
+    user: UserResponse
+    followers: FollowerStatus
+    resources: ResourceAvailableResponse
+    attempted_challenges: List[str]
+    active_aids: List[AidResponse]
+    used_aids: List[dict]
+
 # ==================== AUTH HELPERS ====================
 
 def hash_password(password: str) -> str:
@@ -376,59 +500,168 @@ def get_month_key(dt: datetime) -> str:
     return dt.strftime("%Y-%m")
 
 async def get_follower_spent_this_month(user_id: str) -> int:
-    """Somma dei punti SEGUACI spesi in questo mese"""
+    """Punti SEGUACI spesi in questo mese (contatore mantenuto da record_follower_spend)"""
     now = datetime.now(timezone.utc)
     month_key = get_month_key(now)
-    spends = await db.follower_spends.find({
+    total = await db.follower_spend_totals.find_one({
         "user_id": user_id,
         "month_key": month_key
-    }, {"_id": 0, "amount": 1}).to_list(1000)
-    return sum(int(s.get("amount", 0)) for s in spends)
+    }, {"_id": 0, "amount": 1})
+    return int((total or {}).get("amount", 0))
 
-async def get_effective_max_actions(user: dict) -> int:
-    """Calcola il limite effettivo di consultazioni per il mese corrente (20 + SEGUACI - SEGUACI_spesi)."""
-    base_max = int(user.get("max_actions", 20))
-    bg = await db.backgrounds.find_one({"user_id": user["id"]}, {"_id": 0, "seguaci": 1}) or {}
-    seguaci = int(bg.get("seguaci", 0))
-    spent = await get_follower_spent_this_month(user["id"])
-    return max(0, base_max + seguaci - spent)
 
 
-async def check_monthly_reset(user: dict) -> dict:
-    """Reset azioni se è passato un mese dall'ultimo reset"""
+# ==================== MONTHLY RESET ====================
+
+MONTHLY_RESET_MARKER = "monthly_action_reset"
+# Intervallo massimo tra due controlli dello scheduler (ritenta dopo un errore)
+MONTHLY_RESET_CHECK_SECONDS = 3600
+
+# Mese (AAAA-MM, UTC) per cui questo processo sa che il reset è già stato eseguito
+_monthly_reset_month: Optional[str] = None
+_monthly_reset_lock = asyncio.Lock()
+monthly_reset_task: Optional[asyncio.Task] = None
+
+def next_month_start(moment: datetime) -> datetime:
+    if moment.month == 12:
+        return datetime(moment.year + 1, 1, 1, tzinfo=timezone.utc)
+    return datetime(moment.year, moment.month + 1, 1, tzinfo=timezone.utc)
+
+async def run_monthly_reset() -> int:
+    """Azzera used_actions di tutti i PG il cui ultimo reset è di un mese precedente.
+
+    Idempotente: il filtro su last_action_reset esclude chi è già stato azzerato e il
+    marcatore in maintenance evita anche la query quando il mese è già stato fatto
+    (da questo o da un altro processo). Ritorna il numero di PG azzerati.
+    """
+    global _monthly_reset_month
     now = datetime.now(timezone.utc)
-    last_reset_str = user.get("last_action_reset")
-    
-    if last_reset_str:
-        last_reset = datetime.fromisoformat(last_reset_str.replace('Z', '+00:00'))
-        # Controlla se siamo in un mese diverso dall'ultimo reset
-        if now.year > last_reset.year or (now.year == last_reset.year and now.month > last_reset.month):
-            # Reset mensile
-            await db.users.update_one(
-                {"id": user["id"]},
-                {"$set": {"used_actions": 0, "last_action_reset": now.isoformat()}}
-            )
-            user["used_actions"] = 0
-            user["last_action_reset"] = now.isoformat()
-            logger.info(f"Monthly reset for user {user['id']}")
-    else:
-        # Se non esiste last_action_reset, lo creiamo
-        await db.users.update_one(
-            {"id": user["id"]},
+    current_month = get_month_key(now)
+
+    marker = await db.maintenance.find_one({"id": MONTHLY_RESET_MARKER}, {"_id": 0})
+    reset_count = 0
+    if not marker or marker.get("month") != current_month:
+        month_start = datetime(now.year, now.month, 1, tzinfo=timezone.utc).isoformat()
+        # Nuovo mese: nessun SEGUACE speso, il limite torna a max_actions + SEGUACI
+        result = await db.users.update_many(
+            # "" precede ogni data: senza $gt la data vuota verrebbe azzerata invece che solo impostata
+            {"last_action_reset": {"$gt": "", "$lt": month_start}},
+            [{"$set": {
+                "used_actions": 0,
+                "last_action_reset": now.isoformat(),
+                "effective_max_actions": {"$cond": [
+                    is_saved_number("followers_total"),
+                    {"$add": [{"$ifNull": ["$max_actions", 20]}, "$followers_total"]},
+                    "$$REMOVE"
+                ]}
+            }}]
+        )
+        reset_count = result.modified_count
+        # Utenti senza last_action_reset: si imposta solo la data, come prima
+        await db.users.update_many(
+            {"last_action_reset": {"$in": [None, ""]}},
             {"$set": {"last_action_reset": now.isoformat()}}
         )
-        user["last_action_reset"] = now.isoformat()
-    
-    return user
+        await db.maintenance.update_one(
+            {"id": MONTHLY_RESET_MARKER},
+            {"$set": {"month": current_month, "completed_at": now.isoformat(), "reset_users": reset_count}},
+            upsert=True
+        )
+        logger.info(f"Monthly reset {current_month}: {reset_count} users reset")
+
+    if _monthly_reset_month != current_month:
+        # I dati in cache possono essere di prima del reset
+        user_cache.clear()
+        _monthly_reset_month = current_month
+    return reset_count
+
+async def ensure_monthly_reset():
+    """Controllo per richiesta: un confronto in memoria, il reset vero solo al cambio di mese"""
+    if _monthly_reset_month == get_month_key(datetime.now(timezone.utc)):
+        return
+    async with _monthly_reset_lock:
+        if _monthly_reset_month != get_month_key(datetime.now(timezone.utc)):
+            await run_monthly_reset()
+
+async def monthly_reset_scheduler():
+    while True:
+        try:
+            await ensure_monthly_reset()
+        except Exception as e:
+            logger.error(f"Monthly reset failed: {e}")
+        now = datetime.now(timezone.utc)
+        # +1s: si sveglia appena dopo la mezzanotte del primo del mese
+        delay = (next_month_start(now) - now).total_seconds() + 1
+        await asyncio.sleep(min(delay, MONTHLY_RESET_CHECK_SECONDS))
+
+# ==================== CURRENT USER ====================
+
+class UserCache:
+    """Utenti autenticati tenuti in memoria per USER_CACHE_TTL_SECONDS.
+
+    Le richieste parallele dello stesso utente con la cache vuota condividono una sola lettura
+    da MongoDB. Gli endpoint che modificano un utente chiamano invalidate() (o clear()): in
+    questo processo la modifica è visibile subito, negli altri entro il TTL.
+    """
+
+    def __init__(self, ttl: float, max_size: int = 4096):
+        self.ttl = ttl
+        self.max_size = max_size
+        # user_id -> (utente, scadenza)
+        self._entries: OrderedDict = OrderedDict()
+        self._loading: Dict[str, asyncio.Future] = {}
+        # Incrementato da ogni invalidazione: una lettura iniziata prima non va salvata
+        self._generation = 0
+
+    async def get(self, user_id: str, load) -> Optional[dict]:
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            if entry[1] > time.monotonic():
+                self._entries.move_to_end(user_id)
+                return dict(entry[0])
+            del self._entries[user_id]
+
+        pending = self._loading.get(user_id)
+        if pending is None:
+            pending = asyncio.ensure_future(self._load(user_id, load))
+            self._loading[user_id] = pending
+            pending.add_done_callback(lambda f: self._loading.pop(user_id, None) if self._loading.get(user_id) is f else None)
+        user = await asyncio.shield(pending)
+        return dict(user) if user is not None else None
+
+    async def _load(self, user_id: str, load) -> Optional[dict]:
+        generation = self._generation
+        user = await load(user_id)
+        if user is not None and generation == self._generation:
+            self._entries[user_id] = (user, time.monotonic() + self.ttl)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return user
+
+    def invalidate(self, user_id: str):
+        self._generation += 1
+        self._entries.pop(user_id, None)
+        self._loading.pop(user_id, None)
+
+    def clear(self):
+        self._generation += 1
+        self._entries.clear()
+        self._loading.clear()
+
+
+user_cache = UserCache(USER_CACHE_TTL_SECONDS)
+
+async def load_user(user_id: str) -> Optional[dict]:
+    return await db.users.find_one({"id": user_id}, {"_id": 0})
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
         payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        user = await db.users.find_one({"id": payload["user_id"]}, {"_id": 0})
+        # Applica il reset mensile se è appena cambiato il mese
+        await ensure_monthly_reset()
+        user = await user_cache.get(payload["user_id"], load_user)
         if not user:
             raise HTTPException(status_code=401, detail="Utente non trovato")
-        # Controlla e applica reset mensile se necessario
-        user = await check_monthly_reset(user)
         return user
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token scaduto")
@@ -440,14 +673,252 @@ async def get_admin_user(user: dict = Depends(get_current_user)):
         raise HTTPException(status_code=403, detail="Accesso negato - Solo admin")
     return user
 
+# ==================== ACTION LEDGER ====================
+# Ogni utente porta effective_max_actions = max_actions + SEGUACI - SEGUACI spesi nel mese,
+# aggiornato da chi modifica uno dei tre valori, e followers_total (copia dei SEGUACI del
+# background) per poterlo ricalcolare al reset mensile. Così scalare un'azione è un solo
+# aggiornamento condizionale.
+
+def is_saved_number(field: str) -> dict:
+    """Condizione (pipeline di update): il campo c'è ed è un numero.
+
+    Gli utenti registrati prima del contatore non lo hanno, o lo hanno non numerico: in quel
+    caso le espressioni qui sotto lo rimuovono e sync_action_limits lo ricalcola dalle fonti.
+    """
+    return {"$isNumber": f"${field}"}
+
+def has_action_limit(user: dict) -> bool:
+    """Come is_saved_number("effective_max_actions"), sul documento già letto"""
+    limit = user.get("effective_max_actions")
+    return isinstance(limit, (int, float)) and not isinstance(limit, bool)
+
+def effective_max_shift(delta) -> dict:
+    """Espressione (pipeline di update) che sposta effective_max_actions di delta, se già calcolato"""
+    return {"$cond": [
+        is_saved_number("effective_max_actions"),
+        {"$add": ["$effective_max_actions", delta]},
+        "$$REMOVE"
+    ]}
+
+async def sync_action_limits(user_id: str):
+    """Calcola effective_max_actions dalle fonti per gli utenti registrati prima che fosse salvato"""
+    user = await db.users.find_one({"id": user_id}, {"_id": 0, "max_actions": 1})
+    if not user:
+        return
+    bg = await db.backgrounds.find_one({"user_id": user_id}, {"_id": 0, "seguaci": 1}) or {}
+    seguaci = int(bg.get("seguaci", 0))
+    spent = await get_follower_spent_this_month(user_id)
+    await db.users.update_one(
+        {"id": user_id, "effective_max_actions": {"$not": {"$type": "number"}}},
+        {"$set": {"followers_total": seguaci, "effective_max_actions": int(user.get("max_actions", 20)) + seguaci - spent}}
+    )
+    user_cache.invalidate(user_id)
+
+async def get_effective_max_actions(user: dict) -> int:
+    """Limite effettivo di consultazioni per il mese corrente (20 + SEGUACI - SEGUACI_spesi)."""
+    if not has_action_limit(user):
+        await sync_action_limits(user["id"])
+        user = await db.users.find_one({"id": user["id"]}, {"_id": 0, "effective_max_actions": 1}) or {}
+    return max(0, int(user.get("effective_max_actions", 0)))
+
+async def set_followers_total(user_id: str, seguaci: int):
+    """Da chiamare quando cambiano i SEGUACI nel background: sposta il limite effettivo della differenza"""
+    await db.users.update_one(
+        {"id": user_id},
+        [{"$set": {
+            "effective_max_actions": effective_max_shift({"$subtract": [seguaci, {"$ifNull": ["$followers_total", 0]}]}),
+            "followers_total": {"$cond": [is_saved_number("effective_max_actions"), seguaci, "$$REMOVE"]}
+        }}]
+    )
+    user_cache.invalidate(user_id)
+
+def check_action_available(user: dict):
+    """Controllo in memoria per rifiutare subito chi ha già esaurito le azioni (la prenotazione vera è reserve_action)"""
+    if has_action_limit(user) and user["used_actions"] >= user["effective_max_actions"]:
+        raise HTTPException(status_code=403, detail="Hai esaurito le tue azioni disponibili")
+
+async def reserve_action(user_id: str) -> dict:
+    """Scala un'azione solo se used_actions < effective_max_actions, in un unico aggiornamento atomico.
+
+    Ritorna il documento utente aggiornato; 403 se le azioni sono esaurite.
+    """
+    for _attempt in range(2):
+        user = await db.users.find_one_and_update(
+            {"id": user_id, "$expr": {"$lt": ["$used_actions", "$effective_max_actions"]}},
+            {"$inc": {"used_actions": 1}},
+            projection={"_id": 0, "password_hash": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        if user is not None:
+            user_cache.invalidate(user_id)
+            return user
+        # Nessun aggiornamento: azioni esaurite, oppure utente senza limite salvato
+        current = await db.users.find_one({"id": user_id}, {"_id": 0, "effective_max_actions": 1})
+        if current is None or has_action_limit(current):
+            break
+        await sync_action_limits(user_id)
+    raise HTTPException(status_code=403, detail="Hai esaurito le tue azioni disponibili")
+
+async def refund_action(user_id: str):
+    """Restituisce un'azione prenotata con reserve_action (es. il modello non ha risposto)"""
+    await db.users.update_one(
+        {"id": user_id, "used_actions": {"$gt": 0}},
+        {"$inc": {"used_actions": -1}}
+    )
+    user_cache.invalidate(user_id)
+
+class ActionReservation:
+    """Azione prenotata con reserve_action: restituita al più una volta se la richiesta non si completa"""
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.settled = False
+
+    def commit(self):
+        self.settled = True
+
+    async def refund(self):
+        if not self.settled:
+            self.settled = True
+            await refund_action(self.user_id)
+
+async def record_follower_spend(user_id: str, amount: int):
+    """Registra punti SEGUACI spesi: voce nel log follower_spends, contatore mensile e limite effettivo"""
+    now = datetime.now(timezone.utc)
+    month_key = get_month_key(now)
+    await db.follower_spends.insert_one({
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "amount": amount,
+        "month_key": month_key,
+        "created_at": now.isoformat()
+    })
+    await db.follower_spend_totals.update_one(
+        {"user_id": user_id, "month_key": month_key},
+        {"$inc": {"amount": amount}, "$set": {"updated_at": now.isoformat()}},
+        upsert=True
+    )
+    await db.users.update_one(
+        {"id": user_id},
+        [{"$set": {"effective_max_actions": effective_max_shift(-amount)}}]
+    )
+    user_cache.invalidate(user_id)
+
+async def follower_spend_log_state(user_id: str, month_key: str) -> Tuple[int, str]:
+    """Totale dal log follower_spends per un PG e un mese, con la data dell'ultima voce"""
+    async for row in db.follower_spends.aggregate([
+        {"$match": {"user_id": user_id, "month_key": month_key}},
+        {"$group": {"_id": None, "amount": {"$sum": "$amount"}, "latest": {"$max": "$created_at"}}}
+    ]):
+        return int(row["amount"]), row.get("latest") or ""
+    return 0, ""
+
+async def reconcile_follower_spend_totals() -> List[dict]:
+    """Ricostruisce i contatori follower_spend_totals dal log follower_spends.
+
+    Ritorna le differenze trovate (e corrette); per il mese corrente corregge anche il
+    limite effettivo degli utenti coinvolti. Ogni correzione ricontrolla il log e scrive solo
+    se il contatore vale ancora quanto letto, così una spesa registrata nel frattempo non
+    viene scambiata per una differenza.
+    """
+    now = datetime.now(timezone.utc)
+    current_month = get_month_key(now)
+    # Una spesa più recente può avere la voce nel log ma non ancora il $inc sul contatore
+    settled_before = (now - timedelta(seconds=FOLLOWER_SPEND_SETTLE_SECONDS)).isoformat()
+    from_log = {}
+    async for row in db.follower_spends.aggregate([
+        {"$group": {"_id": {"user_id": "$user_id", "month_key": "$month_key"}, "amount": {"$sum": "$amount"}}}
+    ]):
+        from_log[(row["_id"]["user_id"], row["_id"]["month_key"])] = int(row["amount"])
+    counters = {}
+    async for total in db.follower_spend_totals.find({}, {"_id": 0, "user_id": 1, "month_key": 1, "amount": 1}):
+        counters[(total["user_id"], total["month_key"])] = total.get("amount")
+
+    mismatches = []
+    for user_id, month_key in set(from_log) | set(counters):
+        found = int(counters.get((user_id, month_key)) or 0)
+        if from_log.get((user_id, month_key), 0) == found:
+            continue
+        # Le due letture sopra non sono contemporanee: si rilegge il log di questa coppia
+        expected, latest = await follower_spend_log_state(user_id, month_key)
+        if expected == found or latest > settled_before:
+            continue
+        if (user_id, month_key) in counters:
+            result = await db.follower_spend_totals.update_one(
+                {"user_id": user_id, "month_key": month_key, "amount": counters[(user_id, month_key)]},
+                {"$set": {"amount": expected, "updated_at": now.isoformat()}}
+            )
+            if not result.modified_count:
+                # Contatore cambiato dopo la lettura: se ne occupa il prossimo controllo
+                continue
+        else:
+            try:
+                await db.follower_spend_totals.insert_one(
+                    {"user_id": user_id, "month_key": month_key, "amount": expected, "updated_at": now.isoformat()}
+                )
+            except DuplicateKeyError:
+                continue
+        mismatches.append({"user_id": user_id, "month_key": month_key, "counter": found, "log": expected})
+        if month_key == current_month:
+            await db.users.update_one(
+                {"id": user_id},
+                [{"$set": {"effective_max_actions": effective_max_shift(found - expected)}}]
+            )
+            user_cache.invalidate(user_id)
+    if mismatches:
+        logger.warning(f"Follower spend counters corrected: {len(mismatches)}")
+    return mismatches
+
+# ==================== COLLECTION VERSIONS ====================
+
+# nome collezione -> (versione, ultima modifica, istante dell'ultima lettura da MongoDB)
+_collection_versions: dict = {}
+
+def _version_updated_at(doc: Optional[dict]) -> Optional[datetime]:
+    updated_at = (doc or {}).get("updated_at")
+    return datetime.fromisoformat(updated_at) if updated_at else None
+
+async def get_collection_stamp(name: str) -> Tuple[int, Optional[datetime]]:
+    """(versione, istante dell'ultima modifica) di una collezione, riletti al massimo ogni VERSION_POLL_SECONDS"""
+    cached = _collection_versions.get(name)
+    now = time.monotonic()
+    if cached and now - cached[2] < VERSION_POLL_SECONDS:
+        return cached[0], cached[1]
+    doc = await db.collection_versions.find_one({"id": name}, {"_id": 0, "value": 1, "updated_at": 1})
+    value = int((doc or {}).get("value", 0))
+    updated_at = _version_updated_at(doc)
+    _collection_versions[name] = (value, updated_at, now)
+    return value, updated_at
+
+async def get_collection_version(name: str) -> int:
+    """Versione corrente di una collezione, riletta da MongoDB al massimo ogni VERSION_POLL_SECONDS"""
+    version, _ = await get_collection_stamp(name)
+    return version
+
+async def bump_collection_version(name: str) -> int:
+    """Da chiamare dopo ogni scrittura: invalida le cache in memoria di tutti i processi"""
+    doc = await db.collection_versions.find_one_and_update(
+        {"id": name},
+        {"$inc": {"value": 1}, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}},
+        projection={"_id": 0, "value": 1, "updated_at": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    value = int(doc["value"])
+    _collection_versions[name] = (value, _version_updated_at(doc), time.monotonic())
+    return value
+
 @api_router.get("/followers/status", response_model=FollowerStatus)
-async def get_follower_status(current_user: UserResponse = Depends(get_current_user)):
+async def get_follower_status(user: dict = Depends(get_current_user)):
     """Ritorna la situazione dei SEGUACI per il mese corrente"""
-    user = current_user.model_dump()
+    bg = await db.backgrounds.find_one({"user_id": user["id"]}, {"_id": 0, "seguaci": 1}) or {}
+    return await build_follower_status(user, bg)
+
+async def build_follower_status(user: dict, bg: dict) -> FollowerStatus:
+    """bg: background del PG, basta il campo seguaci"""
     effective_max = await get_effective_max_actions(user)
     remaining_before = max(0, effective_max - user["used_actions"])
 
-    bg = await db.backgrounds.find_one({"user_id": user["id"]}, {"_id": 0, "seguaci": 1}) or {}
     total_followers = int(bg.get("seguaci", 0))
     spent_followers = await get_follower_spent_this_month(user["id"])
     available_followers = max(0, total_followers - spent_followers)
@@ -459,6 +930,64 @@ async def get_follower_status(current_user: UserResponse = Depends(get_current_u
         remaining_actions_before=remaining_before
     )
 
+# ==================== HTTP CACHING ====================
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """True se l'ETag è tra quelli di If-None-Match (il client ha già questa versione)"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = [tag.strip() for tag in header.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+def not_modified_since(request: Request, updated_at: Optional[datetime]) -> bool:
+    """True se If-Modified-Since non è precedente all'ultima modifica (al secondo, come Last-Modified)"""
+    header = request.headers.get("if-modified-since")
+    if not header or updated_at is None:
+        return False
+    try:
+        since = parsedate_to_datetime(header)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return updated_at.replace(microsecond=0) <= since
+
+def validator_headers(collection: str, version: int, updated_at: Optional[datetime], cache_control: str) -> dict:
+    """ETag, Last-Modified e Cache-Control per una versione di una collezione"""
+    headers = {"ETag": f'"{collection}-{version}"', "Cache-Control": cache_control}
+    if updated_at is not None:
+        headers["Last-Modified"] = format_datetime(updated_at, usegmt=True)
+    return headers
+
+def client_is_fresh(request: Request, etag: str, updated_at: Optional[datetime]) -> bool:
+    if request.headers.get("if-none-match"):
+        # If-Modified-Since si ignora quando c'è If-None-Match (RFC 9110)
+        return etag_matches(request, etag)
+    return not_modified_since(request, updated_at)
+
+async def catalog_not_modified(request: Request, response: Response, collection: str,
+                               cache_control: str = "private, no-cache") -> Optional[Response]:
+    """Validatori HTTP di un catalogo dalla versione della collezione.
+
+    Imposta ETag/Last-Modified sulla risposta e, se il client ha già la versione corrente,
+    ritorna la 304 da restituire al posto dei dati: in quel caso la collezione non viene letta.
+    """
+    version, updated_at = await get_collection_stamp(collection)
+    headers = validator_headers(collection, version, updated_at, cache_control)
+    response.headers.update(headers)
+    if client_is_fresh(request, headers["ETag"], updated_at):
+        return Response(status_code=304, headers=headers)
+    return None
+
+def json_response_with_etag(request: Request, body: bytes, cache_control: str) -> Response:
+    """Risposta JSON con ETag calcolato sul contenuto; 304 senza corpo se il client l'ha già"""
+    etag = f'"{hashlib.sha1(body).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 # ==================== AUTH ROUTES ====================
 
 @api_router.post("/auth/register", response_model=TokenResponse)
@@ -477,10 +1006,16 @@ async def register(data: UserCreate):
         "role": "player",
         "max_actions": 20,
         "used_actions": 0,
+        "followers_total": 0,
+        "effective_max_actions": 20,
         "created_at": now.isoformat(),
         "last_action_reset": now.isoformat()
     }
-    await db.users.insert_one(user_doc)
+    try:
+        await db.users.insert_one(user_doc)
+    except DuplicateKeyError:
+        # Registrazione contemporanea con la stessa email
+        raise HTTPException(status_code=400, detail="Email già registrata")
     
     token = create_token(user_id, "player")
     user_response = UserResponse(
@@ -528,10 +1063,15 @@ async def create_knowledge(data: KnowledgeBaseCreate, user: dict = Depends(get_a
         "created_by": user["username"]
     }
     await db.knowledge_base.insert_one(kb_doc)
+    await store_kb_chunks(kb_doc)
+    await bump_collection_version("knowledge_base")
     return KnowledgeBaseResponse(**kb_doc)
 
 @api_router.get("/knowledge", response_model=List[KnowledgeBaseResponse])
-async def get_knowledge(user: dict = Depends(get_current_user)):
+async def get_knowledge(request: Request, response: Response, user: dict = Depends(get_current_user)):
+    not_modified = await catalog_not_modified(request, response, "knowledge_base")
+    if not_modified:
+        return not_modified
     docs = await db.knowledge_base.find({}, {"_id": 0}).to_list(1000)
     return [KnowledgeBaseResponse(**{
         **doc,
@@ -547,6 +1087,8 @@ async def delete_knowledge(kb_id: str, user: dict = Depends(get_admin_user)):
     result = await db.knowledge_base.delete_one({"id": kb_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Documento non trovato")
+    await db.knowledge_chunks.delete_many({"kb_id": kb_id})
+    await bump_collection_version("knowledge_base")
     return {"message": "Documento eliminato"}
 
 @api_router.post("/knowledge/upload")
@@ -609,6 +1151,8 @@ async def upload_document(file: UploadFile = File(...), user: dict = Depends(get
         "created_by": user["username"]
     }
     await db.knowledge_base.insert_one(kb_doc)
+    await store_kb_chunks(kb_doc)
+    await bump_collection_version("knowledge_base")
     
     return KnowledgeBaseResponse(**{k: v for k, v in kb_doc.items() if k != "file_path"})
 
@@ -620,54 +1164,357 @@ async def get_uploaded_file(filename: str):
         raise HTTPException(status_code=404, detail="File non trovato")
     return FileResponse(file_path)
 
-# ==================== CHAT ROUTES ====================
+# ==================== KNOWLEDGE RETRIEVAL ====================
+
+ITALIAN_STOPWORDS = frozenset("""
+a ad agli ai al all alla alle allo anche avere c che chi ci come con contro cosa cui
+da dagli dai dal dall dalla dalle dallo degli dei del dell della delle dello di dove
+e ed era essere gli ha hai hanno ho i il in io l la le lei lo loro lui ma mi mia mie
+miei mio ne negli nei nel nell nella nelle nello noi non o per perche piu quale quali
+quando quanto quella quelle quelli quello questa queste questi questo se si sia siamo
+sono su sua sue sui sul sull sulla sulle sullo suo suoi ti tra tu tua tue tuo tuoi
+tutti tutto un una uno vi voi
+""".split())
+
+# Suffissi flessivi/derivativi comuni, dal più lungo al più corto (stemmer leggero)
+ITALIAN_SUFFIXES = tuple(sorted((
+    "amente", "mente", "azioni", "azione", "zioni", "zione", "issimi", "issime",
+    "issimo", "issima", "ismi", "ismo", "iste", "isti", "ista", "ando", "endo",
+    "ata", "ate", "ati", "ato", "ita", "ite", "iti", "ito", "are", "ere", "ire",
+    "a", "e", "i", "o",
+), key=len, reverse=True))
+
+
+@lru_cache(maxsize=1)
+def get_token_encoding():
+    try:
+        return tiktoken.encoding_for_model("gpt-4o")
+    except Exception as e:
+        logger.warning(f"Tokenizer non disponibile, uso una stima approssimata: {e}")
+        return None
+
+def count_tokens(text: str) -> int:
+    """Numero di token del testo secondo il tokenizer del modello"""
+    if not text:
+        return 0
+    encoding = get_token_encoding()
+    if encoding is None:
+        return max(1, len(text) // 4)
+    return len(encoding.encode(text, disallowed_special=()))
+
+def normalize_text(text: str) -> str:
+    """Minuscolo e senza accenti (perché -> perche)"""
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+def stem_italian(word: str) -> str:
+    for suffix in ITALIAN_SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+def analyze_text(text: str) -> List[str]:
+    """Tokenizza un testo italiano: normalizza, rimuove le stopword e applica lo stemming"""
+    return [
+        stem_italian(token)
+        for token in re.findall(r"[a-z0-9]+", normalize_text(text or ""))
+        if len(token) > 1 and token not in ITALIAN_STOPWORDS
+    ]
 
-@api_router.post("/chat", response_model=ChatResponse)
-async def send_chat(data: ChatRequest, user: dict = Depends(get_current_user)):
-    # Check action limit (usa limite effettivo 20 + SEGUACI - SEGUACI_spesi)
-    effective_max = await get_effective_max_actions(user)
-    if user["used_actions"] >= effective_max:
-        raise HTTPException(status_code=403, detail="Hai esaurito le tue azioni disponibili")
-    
-    # Recupera background del PG per filtrare in base ai requisiti
-    bg = await db.backgrounds.find_one({"user_id": user["id"]}, {"_id": 0}) or {}
+def _split_to_fit(text: str, max_tokens: int) -> List[str]:
+    """Divide il testo a metà (per parole, o per caratteri se è una parola sola) finché ogni parte sta in max_tokens"""
+    if len(text) <= 1 or count_tokens(text) <= max_tokens:
+        return [text]
+    words = text.split()
+    if len(words) > 1:
+        middle = len(words) // 2
+        halves = [" ".join(words[:middle]), " ".join(words[middle:])]
+    else:
+        middle = len(text) // 2
+        halves = [text[:middle], text[middle:]]
+    return [piece for half in halves for piece in _split_to_fit(half, max_tokens)]
+
+def _pack(parts: List[str], separator: str, max_tokens: int) -> List[Tuple[str, int]]:
+    """Unisce parti consecutive finché il testo risultante (separatori compresi) sta in max_tokens.
+
+    Ritorna [(testo, token)] con il conteggio del testo unito, non la somma delle parti.
+    """
+    packed, current, current_tokens = [], [], 0
+    for part in parts:
+        if current:
+            joined_tokens = count_tokens(separator.join(current + [part]))
+            if joined_tokens <= max_tokens:
+                current.append(part)
+                current_tokens = joined_tokens
+                continue
+            packed.append((separator.join(current), current_tokens))
+        current, current_tokens = [part], count_tokens(part)
+    if current:
+        packed.append((separator.join(current), current_tokens))
+    return packed
+
+def _split_long_paragraph(paragraph: str, max_tokens: int) -> List[str]:
+    """Spezza un paragrafo troppo lungo per frasi (e per parole se una frase non basta)"""
+    sentences = []
+    for sentence in re.split(r"(?<=[.!?])\s+", paragraph):
+        sentences.extend(_split_to_fit(sentence, max_tokens))
+    return [piece for piece, _tokens in _pack(sentences, " ", max_tokens)]
+
+def split_into_chunks(text: str, max_tokens: int = KB_CHUNK_TOKENS) -> List[dict]:
+    """Divide il testo in chunk per sezione (titoli markdown) e paragrafi, ciascuno entro max_tokens.
+
+    Ogni chunk è {"section", "text", "tokens"}: i token vengono contati una sola volta, all'ingest.
+    """
+    chunks = []
+    section, paragraphs = None, []
+
+    def flush():
+        nonlocal paragraphs
+        for chunk_text, tokens in _pack(paragraphs, "\n\n", max_tokens):
+            chunks.append({"section": section, "text": chunk_text, "tokens": tokens})
+        paragraphs = []
+
+    def add_paragraph(paragraph):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            return
+        if count_tokens(paragraph) <= max_tokens:
+            paragraphs.append(paragraph)
+        else:
+            paragraphs.extend(_split_long_paragraph(paragraph, max_tokens))
+
+    for block in re.split(r"\n\s*\n", text or ""):
+        lines = []
+        for line in block.strip().splitlines():
+            heading = re.match(r"^#{1,6}\s+(.+?)\s*#*$", line.strip())
+            if not heading:
+                lines.append(line)
+                continue
+            add_paragraph("\n".join(lines))
+            lines = []
+            # Un nuovo titolo chiude sempre il chunk della sezione precedente
+            flush()
+            section = heading.group(1)
+        add_paragraph("\n".join(lines))
+    flush()
+    return chunks
+
+def build_kb_chunks(kb_doc: dict) -> List[dict]:
+    """Documenti knowledge_chunks per un documento KB, con i requisiti di accesso denormalizzati"""
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "kb_id": kb_doc["id"],
+            "title": kb_doc["title"],
+            "section": chunk["section"],
+            "position": position,
+            "text": chunk["text"],
+            "tokens": chunk["tokens"],
+            "required_contacts": kb_doc.get("required_contacts") or [],
+            "required_mentor": kb_doc.get("required_mentor"),
+            "required_notoriety": kb_doc.get("required_notoriety"),
+            "created_at": kb_doc.get("created_at"),
+        }
+        for position, chunk in enumerate(split_into_chunks(kb_doc.get("content", "")))
+    ]
+
+async def store_kb_chunks(kb_doc: dict) -> int:
+    """Salva i chunk di un documento KB; ritorna quanti ne ha inseriti.
+
+    Upsert su (kb_id, position): se un altro processo ha già salvato gli stessi chunk
+    (backfill all'avvio) quelli esistenti restano e non si creano duplicati.
+    """
+    # Conteggio dei token e suddivisione di un documento intero: in un thread per non bloccare il loop
+    chunk_docs = await asyncio.to_thread(build_kb_chunks, kb_doc)
+    if not chunk_docs:
+        return 0
+    result = await db.knowledge_chunks.bulk_write([
+        UpdateOne({"kb_id": chunk["kb_id"], "position": chunk["position"]}, {"$setOnInsert": chunk}, upsert=True)
+        for chunk in chunk_docs
+    ], ordered=False)
+    return result.upserted_count
+
+
+class KBIndex:
+    """Indice invertito BM25 sui chunk della knowledge base"""
+
+    def __init__(self, chunks: List[dict], k1: float = 1.5, b: float = 0.75):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        self.postings: dict = {}
+        self.lengths: List[int] = []
+        self.kb_tokens: dict = defaultdict(int)
+        for idx, chunk in enumerate(chunks):
+            self.kb_tokens[chunk["kb_id"]] += chunk["tokens"]
+            terms = analyze_text(f"{chunk['title']}\n{chunk.get('section') or ''}\n{chunk['text']}")
+            self.lengths.append(len(terms))
+            for term, tf in Counter(terms).items():
+                self.postings.setdefault(term, []).append((idx, tf))
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+
+    def search(self, query: str, allowed_kb_ids: Optional[set] = None) -> List[Tuple[int, float]]:
+        """Ritorna (indice chunk, punteggio) ordinati per rilevanza decrescente"""
+        total = len(self.chunks)
+        scores = defaultdict(float)
+        for term in set(analyze_text(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+            for idx, tf in postings:
+                if allowed_kb_ids is not None and self.chunks[idx]["kb_id"] not in allowed_kb_ids:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[idx] / (self.avg_length or 1))
+                scores[idx] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+
+def background_fingerprint(background: dict) -> tuple:
+    """Chiave che identifica i background equivalenti ai fini dei requisiti KB"""
+    contacts = {str(c.get("name", "")).lower(): int(c.get("value", 0)) for c in (background.get("contacts") or [])}
+    return (int(background.get("mentor", 0)), int(background.get("notoriety", 0)), tuple(sorted(contacts.items())))
+
+
+class KBAccessRules:
+    """Requisiti di accesso della KB compilati una volta per versione.
+
+    I documenti sono raggruppati per (soglia mentore, soglia notorietà, contatti richiesti):
+    i documenti visibili a un PG sono l'insieme senza restrizioni più i gruppi che soddisfa.
+    """
+
+    VISIBLE_CACHE_SIZE = 1024
 
-    def has_required_contacts(doc, background):
-        required = doc.get("required_contacts") or []
-        if not required:
-            return True
-        contacts_map = {c["name"].lower(): c["value"] for c in (background.get("contacts") or [])}
-        for req in required:
+    def __init__(self, chunks: List[dict]):
+        unrestricted, groups, seen = set(), defaultdict(set), set()
+        for chunk in chunks:
+            if chunk["kb_id"] in seen:
+                continue
+            seen.add(chunk["kb_id"])
+            key = self.requirement_key(chunk)
+            if key == (None, None, ()):
+                unrestricted.add(chunk["kb_id"])
+            else:
+                groups[key].add(chunk["kb_id"])
+        self.unrestricted = frozenset(unrestricted)
+        self.groups = [(key, frozenset(kb_ids)) for key, kb_ids in groups.items()]
+        self._visible_cache: OrderedDict = OrderedDict()
+
+    @staticmethod
+    def requirement_key(doc: dict) -> tuple:
+        contacts = {}
+        for req in doc.get("required_contacts") or []:
             name = str(req.get("name", "")).lower()
-            min_val = int(req.get("value", 0))
-            if not name:
+            if name:
+                contacts[name] = max(contacts.get(name, 0), int(req.get("value", 0)))
+        return (doc.get("required_mentor"), doc.get("required_notoriety"), tuple(sorted(contacts.items())))
+
+    def visible_kb_ids(self, background: dict) -> frozenset:
+        """Documenti KB accessibili al background, condivisi tra PG con lo stesso fingerprint"""
+        fingerprint = background_fingerprint(background)
+        visible = self._visible_cache.get(fingerprint)
+        if visible is not None:
+            self._visible_cache.move_to_end(fingerprint)
+            return visible
+
+        mentor, notoriety, contacts = fingerprint
+        contacts = dict(contacts)
+        result = set(self.unrestricted)
+        for (req_mentor, req_notoriety, req_contacts), kb_ids in self.groups:
+            if req_mentor is not None and mentor < req_mentor:
                 continue
-            if contacts_map.get(name, 0) < min_val:
-                return False
-        return True
+            if req_notoriety is not None and notoriety < req_notoriety:
+                continue
+            if any(contacts.get(name, 0) < min_val for name, min_val in req_contacts):
+                continue
+            result |= kb_ids
 
-    def has_required_background(doc, background):
-        # Mentor
-        req_mentor = doc.get("required_mentor")
-        if req_mentor is not None and (background.get("mentor", 0) < req_mentor):
-            return False
-        # Notoriety
-        req_notoriety = doc.get("required_notoriety")
-        if req_notoriety is not None and (background.get("notoriety", 0) < req_notoriety):
-            return False
-        # Contacts
-        if not has_required_contacts(doc, background):
-            return False
-        return True
+        visible = frozenset(result)
+        self._visible_cache[fingerprint] = visible
+        if len(self._visible_cache) > self.VISIBLE_CACHE_SIZE:
+            self._visible_cache.popitem(last=False)
+        return visible
 
-    # Get knowledge base context
-    kb_docs = await db.knowledge_base.find({}, {"_id": 0}).to_list(100)
-    
-    # Filtra i documenti KB in base al background del PG
-    kb_docs = [doc for doc in kb_docs if has_required_background(doc, bg)]
-    context = "\n\n".join([f"### {doc['title']}\n{doc['content']}" for doc in kb_docs])
-    
-    system_message = f"""Sei l'Oracolo di un live action role‑playing game (LARP) ambientato in Vampire: The Masquerade.
+
+class KBSnapshot:
+    """Knowledge base in memoria (chunk + indice BM25 + regole di accesso) a una data versione.
+
+    Contiene anche il prefisso stabile del prompt: persona dell'Oracolo più i chunk senza
+    restrizioni che stanno in KB_SHARED_PREFIX_TOKEN_BUDGET. È identico per tutti i PG finché la
+    KB non cambia, quindi il provider può riusarne la cache; il resto del contesto va dopo.
+    """
+
+    def __init__(self, version: int, chunks: List[dict]):
+        self.version = version
+        self.chunks = chunks
+        self.index = KBIndex(chunks)
+        self.access = KBAccessRules(chunks)
+
+        shared, self.shared_idxs, self.shared_tokens = [], frozenset(), 0
+        for idx, chunk in enumerate(chunks):
+            if chunk["kb_id"] not in self.access.unrestricted:
+                continue
+            if self.shared_tokens + chunk["tokens"] > KB_SHARED_PREFIX_TOKEN_BUDGET:
+                break
+            shared.append(idx)
+            self.shared_tokens += chunk["tokens"]
+        self.shared_idxs = frozenset(shared)
+        self.prompt_prefix = build_prompt_prefix([chunks[idx] for idx in shared])
+        self.prefix_tokens = count_tokens(self.prompt_prefix)
+        self.prefix_hash = hashlib.sha256(self.prompt_prefix.encode("utf-8")).hexdigest()[:16]
+
+
+def select_context_chunks(snapshot: KBSnapshot, question: str, allowed_kb_ids: frozenset,
+                          budget: int = KB_CONTEXT_TOKEN_BUDGET, top_k: int = KB_TOP_K) -> List[Tuple[int, dict]]:
+    """Chunk da aggiungere dopo il prefisso condiviso: tutti se stanno nel budget, altrimenti i top-k per BM25.
+
+    Ritorna (indice, chunk) in ordine di priorità decrescente: ordine dei documenti se li prende
+    tutti, rilevanza BM25 altrimenti.
+    """
+    index = snapshot.index
+    remaining = sum(index.kb_tokens.get(kb_id, 0) for kb_id in allowed_kb_ids) - snapshot.shared_tokens
+    if remaining <= budget:
+        return [(idx, c) for idx, c in enumerate(index.chunks) if c["kb_id"] in allowed_kb_ids and idx not in snapshot.shared_idxs]
+
+    selected, used = [], 0
+    for idx, _score in index.search(question, allowed_kb_ids):
+        if len(selected) >= top_k:
+            break
+        chunk = index.chunks[idx]
+        if idx in snapshot.shared_idxs or used + chunk["tokens"] > budget:
+            continue
+        selected.append((idx, chunk))
+        used += chunk["tokens"]
+    return selected
+
+
+_kb_snapshot: Optional[KBSnapshot] = None
+_kb_snapshot_lock = asyncio.Lock()
+
+async def get_kb_snapshot() -> KBSnapshot:
+    """Snapshot corrente della KB: ricostruito solo quando la versione "knowledge_base" cambia"""
+    global _kb_snapshot
+    version = await get_collection_version("knowledge_base")
+    if _kb_snapshot is not None and _kb_snapshot.version == version:
+        return _kb_snapshot
+    async with _kb_snapshot_lock:
+        if _kb_snapshot is None or _kb_snapshot.version != version:
+            # kb_id tiene insieme i chunk di documenti creati nello stesso istante (import, backfill)
+            chunks = await db.knowledge_chunks.find({}, {"_id": 0}).sort(
+                [("created_at", 1), ("kb_id", 1), ("position", 1)]
+            ).to_list(None)
+            # Indice BM25 e regole di accesso in un thread: il loop continua a servire le altre richieste
+            _kb_snapshot = await asyncio.to_thread(KBSnapshot, version, chunks)
+            logger.info(f"KB snapshot v{version} built with {len(chunks)} chunks")
+    return _kb_snapshot
+
+def render_context(chunks: List[dict]) -> str:
+    return "\n\n".join(
+        f"### {c['title']} — {c['section']}\n{c['text']}" if c.get("section") else f"### {c['title']}\n{c['text']}"
+        for c in chunks
+    )
+
+ORACLE_PERSONA = """Sei l'Oracolo di un live action role‑playing game (LARP) ambientato in Vampire: The Masquerade.
 Tutte le domande che ricevi sono **in gioco** e riguardano personaggi e situazioni di finzione.
 Non stai dando consigli reali, ma solo risposte narrative per un gioco.
 
@@ -679,62 +1526,808 @@ Linee guida di tono e stile:
 - Se una richiesta si avvicina troppo a istruzioni pratiche per far male nel mondo reale, rispondi in modo vago e simbolico, mantenendo l'atmosfera horror, senza mai dare istruzioni concrete.
 - Se non trovi risposta nel contesto, ammettilo in stile in‑game (es. "L'Oracolo non vede oltre questo velo di tenebra su questo punto") invece di messaggi tecnici.
 
-Basati SOLO sulle informazioni fornite nel contesto seguente.
+Basati SOLO sulle informazioni fornite nel contesto dell'evento (in questo messaggio ed eventualmente nel successivo)."""
+
+def build_prompt_prefix(shared_chunks: List[dict]) -> str:
+    """Prefisso stabile del prompt: persona + contesto condiviso da tutti i PG"""
+    return f"""{ORACLE_PERSONA}
 
 === CONTESTO DELL'EVENTO ===
-{context}
+{render_context(shared_chunks)}
 === FINE CONTESTO ==="""
-    
-    try:
-        chat = LlmChat(
-            api_key=EMERGENT_LLM_KEY,
-            session_id=f"chat-{user['id']}-{uuid.uuid4()}",
-            system_message=system_message
+
+# ==================== ANSWER CACHE ====================
+
+def normalize_question(question: str) -> str:
+    return " ".join(re.findall(r"[a-z0-9]+", normalize_text(question or "")))
+
+def question_shingles(normalized: str, size: int = 3) -> frozenset:
+    padded = f" {normalized} "
+    return frozenset(padded[i:i + size] for i in range(max(1, len(padded) - size + 1)))
+
+# Stopword che cambiano il senso della domanda: "è alleato" e "non è alleato" non sono la stessa domanda
+QUESTION_NEGATIONS = frozenset({"non", "ne", "mai", "nessuno", "nessuna", "niente", "nulla", "senza"})
+
+def question_terms(normalized: str) -> frozenset:
+    """Parole di contenuto e numeri della domanda, senza stemming: devono coincidere per riusare una risposta"""
+    return frozenset(
+        token for token in normalized.split()
+        if token.isdigit() or token in QUESTION_NEGATIONS or token not in ITALIAN_STOPWORDS
+    )
+
+
+class AnswerCache:
+    """Cache LRU con scadenza delle risposte dell'Oracolo.
+
+    Una risposta è riusata solo nello stesso "scope" (versione KB, documenti visibili al PG), quindi
+    non può mai rivelare contenuti a cui il PG non ha accesso. Oltre alle domande identiche dopo la
+    normalizzazione, riconosce quelle quasi identiche tramite la similarità tra trigrammi, purché
+    abbiano le stesse parole di contenuto (negazioni comprese) e gli stessi numeri.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, similarity: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity = similarity
+        self.hits = 0
+        self.misses = 0
+        # (domanda normalizzata, scope) -> (risposta, scadenza, trigrammi, parole di contenuto)
+        self._entries: OrderedDict = OrderedDict()
+        self._by_scope: dict = defaultdict(set)
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        normalized, scope = key
+        questions = self._by_scope.get(scope)
+        if questions is not None:
+            questions.discard(normalized)
+            if not questions:
+                del self._by_scope[scope]
+
+    def _lookup(self, normalized: str, scope):
+        key = (normalized, scope)
+        if key in self._entries:
+            return key
+        if self.similarity >= 1:
+            return None
+        shingles = question_shingles(normalized)
+        terms = question_terms(normalized)
+        best_key, best_score = None, self.similarity
+        for other in self._by_scope.get(scope, ()):
+            other_shingles, other_terms = self._entries[(other, scope)][2:]
+            if other_terms != terms:
+                continue
+            score = len(shingles & other_shingles) / len(shingles | other_shingles)
+            if score >= best_score:
+                best_key, best_score = (other, scope), score
+        return best_key
+
+    def get(self, question: str, scope) -> Optional[str]:
+        now = time.monotonic()
+        key = self._lookup(normalize_question(question), scope)
+        if key is not None:
+            answer, expires_at = self._entries[key][:2]
+            if expires_at > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return answer
+            self._remove(key)
+        self.misses += 1
+        return None
+
+    def put(self, question: str, scope, answer: str):
+        normalized = normalize_question(question)
+        if not normalized or self.max_entries <= 0:
+            return
+        key = (normalized, scope)
+        self._entries[key] = (
+            answer, time.monotonic() + self.ttl_seconds, question_shingles(normalized), question_terms(normalized)
         )
-        chat.with_model("openai", "gpt-4o")
-        
-        user_message = UserMessage(text=data.question)
-        answer = await chat.send_message(user_message)
-    except Exception as e:
-        logger.error(f"OpenAI error: {e}")
-        answer = "Mi dispiace, al momento non riesco a elaborare la tua richiesta. Riprova più tardi."
-    
+        self._entries.move_to_end(key)
+        self._by_scope[scope].add(normalized)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+
+answer_cache = AnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_SIMILARITY)
+
+# ==================== LLM CLIENT ====================
+
+class OracleLLMClient:
+    """Client LLM di lunga durata: un solo pool di connessioni HTTP keep-alive per tutto il processo.
+
+    Creato all'avvio dell'app e chiuso nello shutdown; modello, system message e max token
+    si scelgono per singola chiamata.
+    """
+
+    def __init__(self, api_key: str, base_url: Optional[str], pool_size: int, timeout: float):
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(timeout, connect=10.0)
+        )
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=self.http_client, max_retries=0)
+
+    @staticmethod
+    def _messages(system_message: str, question: str, context: Optional[str]) -> List[dict]:
+        # Prima la parte stabile (cacheabile come prefisso), poi quella variabile
+        messages = [{"role": "system", "content": system_message}]
+        if context:
+            messages.append({"role": "system", "content": context})
+        messages.append({"role": "user", "content": question})
+        return messages
+
+    @staticmethod
+    def _record_usage(usage_out: Optional[dict], usage):
+        if usage_out is None or usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        usage_out.update({
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+            "cached_tokens": (getattr(details, "cached_tokens", None) or 0) if details else 0
+        })
+
+    async def complete(self, system_message: str, question: str, context: Optional[str] = None,
+                       model: str = LLM_MODEL, max_tokens: Optional[int] = LLM_MAX_TOKENS,
+                       usage: Optional[dict] = None) -> str:
+        """Risposta completa; se passato, usage viene riempito con i token usati"""
+        response = await self.client.chat.completions.create(
+            model=model,
+            messages=self._messages(system_message, question, context),
+            max_tokens=max_tokens
+        )
+        self._record_usage(usage, response.usage)
+        return response.choices[0].message.content or ""
+
+    async def stream(self, system_message: str, question: str, context: Optional[str] = None,
+                     model: str = LLM_MODEL, max_tokens: Optional[int] = LLM_MAX_TOKENS,
+                     usage: Optional[dict] = None):
+        """Frammenti della risposta man mano che il modello li genera"""
+        stream = await self.client.chat.completions.create(
+            model=model,
+            messages=self._messages(system_message, question, context),
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        async for event in stream:
+            if event.choices and event.choices[0].delta.content:
+                yield event.choices[0].delta.content
+            if getattr(event, "usage", None):
+                self._record_usage(usage, event.usage)
+
+    async def close(self):
+        await self.client.close()
+        await self.http_client.aclose()
+
+
+llm_client: Optional[OracleLLMClient] = None
+
+
+class LLMMetrics:
+    """Contatori delle chiamate all'Oracolo (token, latenza, prompt troncati) e del riuso del prefisso.
+
+    Il riuso è misurato in due modi: localmente (stesso prefisso inviato entro PREFIX_CACHE_WINDOW,
+    quindi potenzialmente in cache dal provider) e dai token in cache riportati dal provider.
+    """
+
+    PREFIX_CACHE_WINDOW = 300
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_prompt_tokens = 0
+        self.provider_cache_hits = 0
+        self.prefix_reuses = 0
+        self.total_latency_ms = 0
+        self.max_prompt_tokens = 0
+        self.truncated_prompts = 0
+        # hash prefisso -> ultimo invio
+        self._recent_prefixes: dict = {}
+
+    def record_prefix(self, prefix_hash: str):
+        now = time.monotonic()
+        last_sent = self._recent_prefixes.get(prefix_hash)
+        if last_sent is not None and now - last_sent < self.PREFIX_CACHE_WINDOW:
+            self.prefix_reuses += 1
+        self._recent_prefixes[prefix_hash] = now
+        if len(self._recent_prefixes) > 64:
+            self._recent_prefixes = {h: t for h, t in self._recent_prefixes.items() if now - t < self.PREFIX_CACHE_WINDOW}
+
+    def record_call(self, prefix_hash: str, llm_usage: dict):
+        self.record_prefix(prefix_hash)
+        self.calls += 1
+        self.prompt_tokens += llm_usage.get("prompt_tokens") or 0
+        self.completion_tokens += llm_usage.get("completion_tokens") or 0
+        self.total_latency_ms += llm_usage.get("latency_ms") or 0
+        self.max_prompt_tokens = max(self.max_prompt_tokens, llm_usage.get("prompt_tokens") or 0)
+        if llm_usage.get("dropped_chunks"):
+            self.truncated_prompts += 1
+        cached = llm_usage.get("cached_tokens") or 0
+        self.cached_prompt_tokens += cached
+        if cached:
+            self.provider_cache_hits += 1
+
+    def summary(self) -> dict:
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "max_prompt_tokens": self.max_prompt_tokens,
+            "truncated_prompts": self.truncated_prompts,
+            "avg_latency_ms": round(self.total_latency_ms / self.calls) if self.calls else 0,
+            "cached_prompt_tokens": self.cached_prompt_tokens,
+            "provider_cache_hit_rate": round(self.provider_cache_hits / self.calls, 3) if self.calls else 0.0,
+            "cached_prompt_token_ratio": round(self.cached_prompt_tokens / self.prompt_tokens, 3) if self.prompt_tokens else 0.0,
+            "prefix_reuse_rate": round(self.prefix_reuses / self.calls, 3) if self.calls else 0.0
+        }
+
+
+llm_metrics = LLMMetrics()
+
+# ==================== LLM DISPATCH ====================
+
+def is_rate_limit_error(error: Exception) -> bool:
+    if isinstance(error, RateLimitError) or getattr(error, "status_code", None) == 429:
+        return True
+    message = str(error).lower()
+    return "rate limit" in message or "ratelimit" in message or "429" in message
+
+def retry_delay(attempt: int) -> float:
+    """Backoff esponenziale con "full jitter", per non far ripartire tutti i retry insieme"""
+    return random.uniform(0, min(LLM_RETRY_MAX_SECONDS, LLM_RETRY_BASE_SECONDS * 2 ** attempt))
+
+
+class LLMDispatcher:
+    """Limita le chiamate LLM in corso e mette in coda le altre.
+
+    La coda è equa tra utenti: quando si libera un posto tocca al prossimo utente in giro
+    (round-robin), così chi invia molte domande non blocca gli altri. Sui rate limit del
+    provider la chiamata viene ritentata con backoff, liberando il posto durante l'attesa.
+    """
+
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max(1, max_concurrency)
+        self.in_flight = 0
+        # user_id -> deque di future in attesa di un posto
+        self._waiting: OrderedDict = OrderedDict()
+        # Durata media (EWMA) di una chiamata, per stimare l'attesa
+        self.avg_call_seconds = 5.0
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._waiting.values())
+
+    def status(self) -> dict:
+        depth = self.queue_depth
+        saturated = self.in_flight >= self.max_concurrency
+        eta = math.ceil((depth + 1) / self.max_concurrency) * self.avg_call_seconds if saturated else 0.0
+        return {
+            "in_flight": self.in_flight,
+            "queue_depth": depth,
+            "max_concurrency": self.max_concurrency,
+            "estimated_wait_seconds": round(eta, 1)
+        }
+
+    async def _acquire(self, user_id: str):
+        if self.in_flight < self.max_concurrency and not self._waiting:
+            self.in_flight += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(user_id, deque()).append(future)
+        try:
+            # Il posto viene passato direttamente da _release (in_flight resta invariato)
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()
+            else:
+                queue = self._waiting.get(user_id)
+                if queue is not None and future in queue:
+                    queue.remove(future)
+                    if not queue:
+                        del self._waiting[user_id]
+            raise
+
+    def _release(self):
+        while self._waiting:
+            user_id, queue = next(iter(self._waiting.items()))
+            future = queue.popleft()
+            if queue:
+                self._waiting.move_to_end(user_id)
+            else:
+                del self._waiting[user_id]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+    @asynccontextmanager
+    async def slot(self, user_id: str):
+        await self._acquire(user_id)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.avg_call_seconds = 0.8 * self.avg_call_seconds + 0.2 * (time.monotonic() - started)
+            self._release()
+
+    async def call(self, user_id: str, make_call):
+        """Esegue make_call() (coroutine) rispettando limite, coda e retry sui rate limit"""
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            try:
+                async with self.slot(user_id):
+                    return await make_call()
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt == LLM_MAX_RETRIES:
+                    raise
+                logger.warning(f"LLM rate limit, retry {attempt + 1}/{LLM_MAX_RETRIES}: {e}")
+            await asyncio.sleep(retry_delay(attempt))
+
+    async def stream(self, user_id: str, make_stream):
+        """Come call, per uno stream: il posto resta occupato fino alla fine e si ritenta solo prima del primo frammento"""
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            started = False
+            try:
+                async with self.slot(user_id):
+                    async for text in make_stream():
+                        started = True
+                        yield text
+                return
+            except Exception as e:
+                if started or not is_rate_limit_error(e) or attempt == LLM_MAX_RETRIES:
+                    raise
+                logger.warning(f"LLM rate limit, retry {attempt + 1}/{LLM_MAX_RETRIES}: {e}")
+            await asyncio.sleep(retry_delay(attempt))
+
+
+llm_dispatcher = LLMDispatcher(LLM_MAX_CONCURRENCY)
+
+# ==================== CHAT ROUTES ====================
+
+ORACLE_ERROR_ANSWER = "Mi dispiace, al momento non riesco a elaborare la tua richiesta. Riprova più tardi."
+
+async def get_oracle_scope(user: dict) -> Tuple[KBSnapshot, frozenset]:
+    """Snapshot KB corrente e documenti accessibili al PG: insieme identificano il contesto della risposta"""
+    # Recupera background del PG per filtrare in base ai requisiti
+    bg = await db.backgrounds.find_one({"user_id": user["id"]}, {"_id": 0}) or {}
+
+    # Knowledge base dallo snapshot in memoria (ricostruito solo quando la KB cambia)
+    snapshot = await get_kb_snapshot()
+
+    # Documenti KB accessibili al background del PG (regole precompilate per versione)
+    return snapshot, snapshot.access.visible_kb_ids(bg)
+
+# Token aggiuntivi stimati per l'intestazione "### titolo" di ogni chunk e per ogni messaggio
+CHUNK_HEADER_TOKENS = 8
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+class OraclePrompt:
+    """Prompt per il modello con la misura in token di ogni parte"""
+
+    def __init__(self, prefix: str, prefix_tokens: int, context: Optional[str], context_tokens: int,
+                 question: str, question_tokens: int, context_chunks: int, dropped_chunks: int):
+        self.prefix = prefix
+        self.prefix_tokens = prefix_tokens
+        self.context = context
+        self.context_tokens = context_tokens
+        self.question = question
+        self.question_tokens = question_tokens
+        self.context_chunks = context_chunks
+        self.dropped_chunks = dropped_chunks
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prefix_tokens + self.context_tokens + self.question_tokens + 3 * MESSAGE_OVERHEAD_TOKENS
+
+def render_player_context(chunks: List[dict]) -> Optional[str]:
+    if not chunks:
+        return None
+    return f"""=== ULTERIORE CONTESTO DELL'EVENTO ===
+{render_context(chunks)}
+=== FINE CONTESTO ==="""
+
+def check_question_length(question: str) -> int:
+    question_tokens = count_tokens(question)
+    if question_tokens > LLM_MAX_QUESTION_TOKENS:
+        raise HTTPException(status_code=400, detail="La domanda è troppo lunga")
+    return question_tokens
+
+def build_oracle_prompt(snapshot: KBSnapshot, allowed_kb_ids: frozenset, question: str,
+                        question_tokens: int, max_tokens: int = LLM_MAX_PROMPT_TOKENS) -> OraclePrompt:
+    """Prompt dell'Oracolo entro max_tokens.
+
+    Se prefisso + contesto + domanda superano il limite, vengono scartati i chunk del contesto
+    a priorità più bassa (sempre gli stessi, a parità di domanda e KB).
+    """
+    # Solo i chunk più rilevanti per la domanda, entro il budget di token
+    candidates = select_context_chunks(snapshot, question, allowed_kb_ids)
+    available = max_tokens - snapshot.prefix_tokens - question_tokens - 3 * MESSAGE_OVERHEAD_TOKENS
+
+    kept, used = [], 0
+    for idx, chunk in candidates:
+        cost = chunk["tokens"] + CHUNK_HEADER_TOKENS
+        if used + cost > available:
+            continue
+        kept.append((idx, chunk))
+        used += cost
+
+    # Mantiene l'ordine originale dei documenti per un contesto più leggibile
+    ordered = [chunk for _idx, chunk in sorted(kept, key=lambda item: item[0])]
+    context = render_player_context(ordered)
+    context_tokens = count_tokens(context)
+    # La stima per chunk è approssimata: se il testo reale sfora, toglie i chunk meno prioritari
+    while kept and context_tokens > available:
+        kept.pop()
+        ordered = [chunk for _idx, chunk in sorted(kept, key=lambda item: item[0])]
+        context = render_player_context(ordered)
+        context_tokens = count_tokens(context)
+
+    return OraclePrompt(
+        prefix=snapshot.prompt_prefix,
+        prefix_tokens=snapshot.prefix_tokens,
+        context=context,
+        context_tokens=context_tokens,
+        question=question,
+        question_tokens=question_tokens,
+        context_chunks=len(kept),
+        dropped_chunks=len(candidates) - len(kept)
+    )
+
+def build_llm_usage(prompt: Optional[OraclePrompt], usage: dict, answer: str, started: float) -> dict:
+    """Token e latenza di una consultazione, con le stime locali se il provider non riporta l'uso"""
+    if prompt is None:
+        # Risposta dalla cache: nessuna chiamata al modello
+        return {"cache_hit": True, "prompt_tokens": 0, "completion_tokens": 0,
+                "latency_ms": round((time.monotonic() - started) * 1000)}
+    if usage.get("error"):
+        return {"cache_hit": False, "error": True, "estimated_prompt_tokens": prompt.total_tokens,
+                "latency_ms": round((time.monotonic() - started) * 1000)}
+    return {
+        "cache_hit": False,
+        "prompt_tokens": usage.get("prompt_tokens") or prompt.total_tokens,
+        "completion_tokens": usage.get("completion_tokens") or count_tokens(answer),
+        "cached_tokens": usage.get("cached_tokens") or 0,
+        "estimated_prompt_tokens": prompt.total_tokens,
+        "context_chunks": prompt.context_chunks,
+        "dropped_chunks": prompt.dropped_chunks,
+        "latency_ms": round((time.monotonic() - started) * 1000)
+    }
+
+async def save_chat_answer(user: dict, question: str, answer: str, llm_usage: Optional[dict] = None) -> dict:
+    """Salva la consultazione nell'archivio (l'azione è già stata prenotata con reserve_action)"""
     # Save to chat history
-    chat_id = str(uuid.uuid4())
     chat_doc = {
-        "id": chat_id,
+        "id": str(uuid.uuid4()),
         "user_id": user["id"],
-        "question": data.question,
+        "question": question,
         "answer": answer,
         "created_at": datetime.now(timezone.utc).isoformat()
     }
+    if llm_usage is not None:
+        chat_doc["llm_usage"] = llm_usage
     await db.chat_history.insert_one(chat_doc)
-    
-    # Update used actions
-    await db.users.update_one(
-        {"id": user["id"]},
-        {"$inc": {"used_actions": 1}}
+    return chat_doc
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@api_router.post("/chat", response_model=ChatReply)
+async def send_chat(data: ChatRequest, user: dict = Depends(get_current_user)):
+    question_tokens = check_question_length(data.question)
+    triggered, suggested = None, []
+    if data.trigger_challenges:
+        triggered, suggested = await match_question_challenges(user, data.question)
+        if triggered is not None:
+            # La prova prende il posto della consultazione: nessuna azione, nessuna chiamata al modello
+            return ChatReply(question=data.question, type="challenge", triggered_challenge=triggered)
+    check_action_available(user)
+    started = time.monotonic()
+    snapshot, allowed_kb_ids = await get_oracle_scope(user)
+    cache_scope = (snapshot.version, allowed_kb_ids)
+
+    # Domanda già posta con lo stesso contesto: nessuna chiamata al modello (l'azione viene comunque scalata)
+    prompt, usage = None, {}
+    answer = answer_cache.get(data.question, cache_scope)
+    if answer is None:
+        prompt = build_oracle_prompt(snapshot, allowed_kb_ids, data.question, question_tokens)
+
+    # L'azione si prenota solo a contesto pronto; da qui ogni errore la restituisce
+    await reserve_action(user["id"])
+    reservation = ActionReservation(user["id"])
+    try:
+        if prompt is not None:
+            try:
+                answer = await llm_dispatcher.call(
+                    user["id"], lambda: llm_client.complete(prompt.prefix, prompt.question, prompt.context, usage=usage)
+                )
+                # Una risposta vuota non si riusa: servirebbe il vuoto a ogni domanda simile fino alla scadenza
+                if answer and answer.strip():
+                    answer_cache.put(data.question, cache_scope, answer)
+            except Exception as e:
+                logger.error(f"OpenAI error: {e}")
+                answer = ORACLE_ERROR_ANSWER
+                usage["error"] = True
+                # Il modello non ha risposto: l'azione torna al PG
+                await reservation.refund()
+
+        llm_usage = build_llm_usage(prompt, usage, answer, started)
+        if prompt is not None and not llm_usage.get("error"):
+            llm_metrics.record_call(snapshot.prefix_hash, llm_usage)
+        chat_doc = await save_chat_answer(user, data.question, answer, llm_usage)
+        reservation.commit()
+    except BaseException:
+        await asyncio.shield(reservation.refund())
+        raise
+    return ChatReply(id=chat_doc["id"], question=data.question, answer=answer, created_at=chat_doc["created_at"],
+                     suggested_challenges=suggested)
+
+@api_router.post("/chat/stream")
+async def send_chat_stream(data: ChatRequest, user: dict = Depends(get_current_user)):
+    """Come /chat, ma la risposta arriva come Server-Sent Events.
+
+    Eventi: "token" ({"text"}) per ogni frammento, poi "done" con la ChatReply salvata,
+    oppure "error" ({"detail"}). L'azione viene prenotata prima di iniziare e restituita se
+    il modello fallisce o il client si disconnette prima della risposta completa.
+    Con trigger_challenges, una prova richiamata dalla domanda arriva come unico evento
+    "challenge" (ChatReply con triggered_challenge) senza scalare azioni.
+    """
+    question_tokens = check_question_length(data.question)
+    triggered, suggested = None, []
+    if data.trigger_challenges:
+        triggered, suggested = await match_question_challenges(user, data.question)
+        if triggered is not None:
+            reply = ChatReply(question=data.question, type="challenge", triggered_challenge=triggered)
+            return StreamingResponse(
+                iter([sse_event("challenge", reply.model_dump())]),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
+    check_action_available(user)
+    started = time.monotonic()
+    snapshot, allowed_kb_ids = await get_oracle_scope(user)
+    cache_scope = (snapshot.version, allowed_kb_ids)
+    cached_answer = answer_cache.get(data.question, cache_scope)
+    prompt = None
+    if cached_answer is None:
+        prompt = build_oracle_prompt(snapshot, allowed_kb_ids, data.question, question_tokens)
+
+    # Prenotata a contesto pronto. La restituisce il generatore se la risposta non si completa, oppure
+    # il background task se il client si disconnette prima che il generatore parta.
+    await reserve_action(user["id"])
+    reservation = ActionReservation(user["id"])
+
+    async def events():
+        usage = {}
+        try:
+            if cached_answer is not None:
+                parts = [cached_answer]
+                yield sse_event("token", {"text": cached_answer})
+            else:
+                parts = []
+                try:
+                    async for text in llm_dispatcher.stream(
+                        user["id"], lambda: llm_client.stream(prompt.prefix, prompt.question, prompt.context, usage=usage)
+                    ):
+                        parts.append(text)
+                        yield sse_event("token", {"text": text})
+                except Exception as e:
+                    logger.error(f"OpenAI stream error: {e}")
+                    yield sse_event("error", {"detail": ORACLE_ERROR_ANSWER})
+                    return
+                if "".join(parts).strip():
+                    answer_cache.put(data.question, cache_scope, "".join(parts))
+            reservation.commit()
+            answer = "".join(parts)
+            llm_usage = build_llm_usage(prompt, usage, answer, started)
+            if prompt is not None:
+                llm_metrics.record_call(snapshot.prefix_hash, llm_usage)
+            # shield: la risposta è completa, va salvata anche se il client si disconnette ora
+            chat_doc = await asyncio.shield(save_chat_answer(user, data.question, answer, llm_usage))
+            response = ChatReply(id=chat_doc["id"], question=data.question, answer=chat_doc["answer"],
+                                 created_at=chat_doc["created_at"], suggested_challenges=suggested)
+            yield sse_event("done", response.model_dump())
+        finally:
+            await asyncio.shield(reservation.refund())
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(reservation.refund)
     )
-    
-    return ChatResponse(id=chat_id, question=data.question, answer=answer, created_at=chat_doc["created_at"])
 
-@api_router.get("/chat/history", response_model=List[ChatResponse])
-async def get_chat_history(user: dict = Depends(get_current_user)):
+@api_router.get("/chat/queue")
+async def get_chat_queue(user: dict = Depends(get_current_user)):
+    """Stato della coda verso il modello: chiamate in corso, richieste in attesa e attesa stimata"""
+    return llm_dispatcher.status()
+
+HISTORY_PAGE_SIZE = 30
+HISTORY_MAX_PAGE_SIZE = 100
+HISTORY_PREVIEW_CHARS = 160
+
+# Campi per la lista archivio: la risposta arriva già troncata da MongoDB, con un carattere
+# in più per sapere se è stata davvero tagliata
+HISTORY_LIST_PROJECTION = {
+    "_id": 0,
+    "id": 1,
+    "question": 1,
+    "created_at": 1,
+    "type": 1,
+    "answer_preview": {"$substrCP": ["$answer", 0, HISTORY_PREVIEW_CHARS + 1]},
+    "challenge_data.outcome": 1,
+    "aid_data.level_name": 1
+}
+
+def history_cursor(entry: dict) -> str:
+    return f"{entry['created_at']},{entry['id']}"
+
+def history_before_filter(before: Optional[str]) -> dict:
+    """Filtro keyset per le voci più vecchie del cursore (created_at, id)"""
+    if not before:
+        return {}
+    created_at, sep, entry_id = before.rpartition(",")
+    if not sep or not created_at or not entry_id:
+        raise HTTPException(status_code=400, detail="Cursore non valido")
+    return {"$or": [
+        {"created_at": {"$lt": created_at}},
+        {"created_at": created_at, "id": {"$lt": entry_id}}
+    ]}
+
+def history_page(entries: List[dict], limit: int) -> ChatHistoryPage:
+    """entries: fino a limit + 1 voci, l'ultima serve solo a sapere se c'è un'altra pagina"""
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    items = []
+    for e in entries:
+        preview = e.get("answer_preview", "")
+        if len(preview) > HISTORY_PREVIEW_CHARS:
+            preview = preview[:HISTORY_PREVIEW_CHARS].rstrip() + "…"
+        items.append(ChatHistoryItem(**{**e, "answer_preview": preview}))
+    return ChatHistoryPage(items=items, next_cursor=history_cursor(entries[-1]) if has_more else None)
+
+@api_router.get("/chat/history", response_model=ChatHistoryPage)
+async def get_chat_history(before: Optional[str] = None, limit: int = HISTORY_PAGE_SIZE, user: dict = Depends(get_current_user)):
+    """Archivio del PG, dal più recente, a pagine (before = next_cursor della pagina precedente)"""
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+    query = {"user_id": user["id"], **history_before_filter(before)}
     history = await db.chat_history.find(
-        {"user_id": user["id"]},
-        {"_id": 0}
-    ).sort("created_at", -1).to_list(1000)
-    return [ChatResponse(
-        id=h["id"],
-        question=h["question"],
-        answer=h["answer"],
-        created_at=h["created_at"],
-        type=h.get("type", "chat"),
-        challenge_data=h.get("challenge_data")
-    ) for h in history]
+        query,
+        HISTORY_LIST_PROJECTION
+    ).sort([("created_at", -1), ("id", -1)]).limit(limit + 1).to_list(limit + 1)
+    return history_page(history, limit)
+
+HISTORY_SEARCH_PAGE_SIZE = 20
+HISTORY_SNIPPET_CHARS = 160
+HISTORY_TYPES = {"chat", "challenge", "aid"}
+
+def parse_history_date(value: str, end: bool = False) -> str:
+    """Data del filtro (AAAA-MM-GG o ISO) come stringa confrontabile con created_at.
+
+    Una data senza ora come fine intervallo include tutto il giorno.
+    """
+    try:
+        if len(value) == 10:
+            moment = datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+            if end:
+                moment += timedelta(days=1)
+        else:
+            moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+            if moment.tzinfo is None:
+                moment = moment.replace(tzinfo=timezone.utc)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Data non valida")
+    return moment.astimezone(timezone.utc).isoformat()
+
+def history_highlights(field: str, text: str, query_stems: set) -> Optional[ChatHistoryHighlight]:
+    """Snippet attorno al primo termine trovato, con le posizioni di tutti i termini nello snippet"""
+    matches = [
+        (m.start(), m.end()) for m in re.finditer(r"\w+", text)
+        if stem_italian(normalize_text(m.group())) in query_stems
+    ]
+    if not matches:
+        return None
+    start = max(0, matches[0][0] - HISTORY_SNIPPET_CHARS // 4)
+    # Inizia da un confine di parola
+    if start > 0:
+        space = text.find(" ", start)
+        if space != -1 and space < matches[0][0]:
+            start = space + 1
+    end = min(len(text), start + HISTORY_SNIPPET_CHARS)
+    snippet = text[start:end]
+    ranges = [[a - start, b - start] for a, b in matches if a >= start and b <= end]
+    prefix = "…" if start > 0 else ""
+    if prefix:
+        ranges = [[a + 1, b + 1] for a, b in ranges]
+    return ChatHistoryHighlight(
+        field=field,
+        snippet=prefix + snippet + ("…" if end < len(text) else ""),
+        ranges=ranges
+    )
+
+@api_router.get("/chat/history/search", response_model=ChatHistorySearchPage)
+async def search_chat_history(
+    q: Optional[str] = None,
+    entry_type: Optional[str] = Query(None, alias="type"),
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    page: int = 1,
+    limit: int = HISTORY_SEARCH_PAGE_SIZE,
+    user: dict = Depends(get_current_user)
+):
+    """Cerca nell'archivio del PG (domanda e risposta, indice testuale in italiano).
+
+    Filtri opzionali: type (chat, challenge, aid) e intervallo date_from/date_to.
+    Risultati per pertinenza, a pagine, con gli snippet dei termini trovati.
+    """
+    page = max(1, page)
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+    query = {"user_id": user["id"]}
+    if entry_type:
+        if entry_type not in HISTORY_TYPES:
+            raise HTTPException(status_code=400, detail="Tipo non valido")
+        # Le consultazioni dell'Oracolo più vecchie non hanno il campo type
+        query["type"] = {"$in": [None, "chat"]} if entry_type == "chat" else entry_type
+    if date_from or date_to:
+        query["created_at"] = {}
+        if date_from:
+            query["created_at"]["$gte"] = parse_history_date(date_from)
+        if date_to:
+            query["created_at"]["$lt"] = parse_history_date(date_to, end=True)
+
+    projection = {"_id": 0, "id": 1, "question": 1, "answer": 1, "created_at": 1, "type": 1}
+    q = (q or "").strip()
+    if q:
+        query["$text"] = {"$search": q, "$language": "italian"}
+        projection["score"] = {"$meta": "textScore"}
+        sort = [("score", {"$meta": "textScore"}), ("created_at", -1)]
+    else:
+        sort = [("created_at", -1), ("id", -1)]
+
+    entries = await db.chat_history.find(query, projection).sort(sort).skip((page - 1) * limit).limit(limit + 1).to_list(limit + 1)
+
+    query_stems = set(analyze_text(q))
+    items = []
+    for e in entries[:limit]:
+        highlights = []
+        for field in ("question", "answer"):
+            highlight = history_highlights(field, e.get(field) or "", query_stems) if query_stems else None
+            if highlight:
+                highlights.append(highlight)
+        items.append(ChatHistorySearchHit(**e, highlights=highlights))
+    return ChatHistorySearchPage(items=items, page=page, has_more=len(entries) > limit)
+
+@api_router.get("/chat/history/{entry_id}", response_model=ChatResponse)
+async def get_chat_history_entry(entry_id: str, user: dict = Depends(get_current_user)):
+    entry = await db.chat_history.find_one({"id": entry_id, "user_id": user["id"]}, {"_id": 0, "llm_usage": 0})
+    if not entry:
+        raise HTTPException(status_code=404, detail="Consultazione non trovata")
+    return ChatResponse(**entry)
 
 # ==================== ADMIN ROUTES ====================
 
+@api_router.get("/admin/metrics/llm")
+async def get_llm_metrics(admin: dict = Depends(get_admin_user)):
+    """Metriche dell'Oracolo: token, riuso del prefisso del prompt, cache risposte e coda"""
+    return {
+        **llm_metrics.summary(),
+        "answer_cache": {"hits": answer_cache.hits, "misses": answer_cache.misses},
+        "queue": llm_dispatcher.status()
+    }
+
+@api_router.get("/admin/db/indexes")
+async def get_index_report(admin: dict = Depends(get_admin_user)):
+    """Indici MongoDB mancanti, non dichiarati e mai usati (vedi db_indexes.py)"""
+    return await index_report(db)
+
+@api_router.post("/admin/followers/reconcile")
+async def reconcile_followers(admin: dict = Depends(get_admin_user)):
+    """Verifica i contatori dei SEGUACI spesi contro il log e corregge le differenze"""
+    mismatches = await reconcile_follower_spend_totals()
+    return {"corrected": len(mismatches), "mismatches": mismatches}
+
 @api_router.get("/admin/users", response_model=List[UserResponse])
 async def get_all_users(user: dict = Depends(get_admin_user)):
     users = await db.users.find({}, {"_id": 0, "password_hash": 0}).to_list(1000)
@@ -744,16 +2337,24 @@ async def get_all_users(user: dict = Depends(get_admin_user)):
 async def update_user_actions(user_id: str, data: UpdateUserActions, admin: dict = Depends(get_admin_user)):
     result = await db.users.update_one(
         {"id": user_id},
-        {"$set": {"max_actions": data.max_actions}}
+        [{"$set": {
+            "effective_max_actions": effective_max_shift({"$subtract": [data.max_actions, "$max_actions"]}),
+            "max_actions": data.max_actions
+        }}]
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Utente non trovato")
+    user_cache.invalidate(user_id)
     return {"message": "Azioni aggiornate"}
 
 @api_router.post("/admin/users/reset-max-actions")
 async def reset_all_users_max_actions(admin: dict = Depends(get_admin_user)):
     """Imposta max_actions=20 per tutti i PG esistenti"""
-    await db.users.update_many({}, {"$set": {"max_actions": 20}})
+    await db.users.update_many({}, [{"$set": {
+        "effective_max_actions": effective_max_shift({"$subtract": [20, "$max_actions"]}),
+        "max_actions": 20
+    }}])
+    user_cache.clear()
     return {"message": "max_actions impostato a 20 per tutti gli utenti"}
 
 
@@ -802,13 +2403,181 @@ async def create_or_update_my_background(data: Background, user: dict = Depends(
         {"$set": doc},
         upsert=True
     )
+    await set_followers_total(user["id"], data.seguaci)
     return Background(**doc)
 
-@api_router.get("/admin/background/{user_id}", response_model=Background)
+# ==================== RESOURCE LOCKS ====================
+# Il background porta locked_resources (somma dei lock attivi) e next_unlock_at (scadenza
+# più vicina): la disponibilità è una sola lettura e l'acquisto un solo aggiornamento
+# condizionale. I lock scaduti vengono rilasciati da ResourceLockSweeper.
+
+def as_utc(moment: datetime) -> datetime:
+    """MongoDB restituisce le date senza fuso: sono sempre UTC"""
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+def parse_unlock_at(value: str) -> datetime:
+    """block_until di un oggetto: ISO datetime, senza fuso si intende UTC"""
+    return as_utc(datetime.fromisoformat(value.replace('Z', '+00:00')))
+
+async def refresh_next_unlock(user_id: str):
+    """Ricalcola next_unlock_at dai lock ancora attivi del PG.
+
+    Un acquisto pubblica la sua scadenza dopo aver inserito il lock, incrementando unlock_seq:
+    se arriva tra la lettura dei lock e la scrittura, questa non trova più i valori letti
+    e il calcolo si ripete, così la scadenza del nuovo lock non viene sovrascritta.
+    """
+    while True:
+        bg = await db.backgrounds.find_one({"user_id": user_id}, {"_id": 0, "next_unlock_at": 1, "unlock_seq": 1})
+        if bg is None:
+            return
+        next_lock = await db.resource_locks.find_one(
+            {"user_id": user_id, "status": "active"},
+            {"_id": 0, "expires_at": 1},
+            sort=[("expires_at", 1)]
+        )
+        if next_lock:
+            update = {"$set": {"next_unlock_at": next_lock["expires_at"]}}
+        else:
+            update = {"$unset": {"next_unlock_at": ""}}
+        result = await db.backgrounds.update_one(
+            {"user_id": user_id, "next_unlock_at": bg.get("next_unlock_at"), "unlock_seq": bg.get("unlock_seq")},
+            update
+        )
+        if result.matched_count:
+            return
+
+async def release_expired_locks(user_id: Optional[str] = None) -> int:
+    """Rilascia i lock scaduti (di un PG o di tutti) e aggiorna locked_resources; ritorna quanti.
+
+    Ogni lock passa da active a released con un aggiornamento condizionale, quindi più
+    processi possono eseguire lo sweep insieme senza rilasciare due volte lo stesso lock.
+    """
+    now = datetime.now(timezone.utc)
+    query = {"status": "active", "expires_at": {"$lte": now}}
+    if user_id:
+        query["user_id"] = user_id
+    released, released_users = 0, set()
+    async for lock in db.resource_locks.find(query, {"_id": 0, "id": 1, "user_id": 1, "amount": 1}):
+        result = await db.resource_locks.update_one(
+            {"id": lock["id"], "status": "active"},
+            {"$set": {"status": "released", "released_at": now.isoformat()}}
+        )
+        if result.modified_count:
+            await db.backgrounds.update_one(
+                {"user_id": lock["user_id"]},
+                {"$inc": {"locked_resources": -int(lock.get("amount", 0))}}
+            )
+            released += 1
+            released_users.add(lock["user_id"])
+    if user_id:
+        released_users.add(user_id)
+    for released_user_id in released_users:
+        await refresh_next_unlock(released_user_id)
+    return released
+
+class ResourceLockSweeper:
+    """Rilascia i lock alla scadenza.
+
+    Le scadenze dei lock noti a questo processo stanno in un heap, così lo sweep parte appena
+    il primo scade; in ogni caso ne viene eseguito uno ogni RESOURCE_SWEEP_SECONDS per i lock
+    creati da altri processi.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._heap: List[datetime] = []
+        self._wakeup = asyncio.Event()
+
+    def schedule(self, expires_at: datetime):
+        heapq.heappush(self._heap, expires_at)
+        if self._heap[0] == expires_at:
+            self._wakeup.set()
+
+    async def load(self):
+        async for lock in db.resource_locks.find(
+            {"status": "active"}, {"_id": 0, "expires_at": 1}
+        ).sort("expires_at", 1).limit(1000):
+            heapq.heappush(self._heap, as_utc(lock["expires_at"]))
+
+    async def run(self):
+        await self.load()
+        while True:
+            try:
+                await release_expired_locks()
+            except Exception as e:
+                logger.error(f"Resource lock sweep failed: {e}")
+            while True:
+                now = datetime.now(timezone.utc)
+                while self._heap and self._heap[0] <= now:
+                    heapq.heappop(self._heap)
+                delay = self.interval
+                if self._heap:
+                    # piccolo margine per non arrivare un attimo prima della scadenza
+                    delay = min(delay, (self._heap[0] - now).total_seconds() + 0.1)
+                self._wakeup.clear()
+                try:
+                    # schedule() sveglia il ciclo se arriva una scadenza più vicina
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    break
+
+
+resource_lock_sweeper = ResourceLockSweeper(RESOURCE_SWEEP_SECONDS)
+resource_lock_sweeper_task: Optional[asyncio.Task] = None
+
+async def rebuild_resource_lock_totals() -> int:
+    """Porta i lock creati prima di locked_resources al nuovo formato e ricalcola i totali per PG"""
+    now = datetime.now(timezone.utc)
+    async for lock in db.resource_locks.find({"status": {"$exists": False}}, {"_id": 0, "id": 1, "unlock_at": 1}):
+        try:
+            expires_at = parse_unlock_at(lock["unlock_at"])
+        except (KeyError, TypeError, ValueError):
+            expires_at = now
+        await db.resource_locks.update_one(
+            {"id": lock["id"]},
+            {"$set": {"expires_at": expires_at, "status": "active" if expires_at > now else "released"}}
+        )
+    totals = {}
+    async for row in db.resource_locks.aggregate([
+        {"$match": {"status": "active"}},
+        {"$group": {"_id": "$user_id", "amount": {"$sum": "$amount"}, "next_unlock_at": {"$min": "$expires_at"}}}
+    ]):
+        totals[row["_id"]] = row
+    await db.backgrounds.update_many(
+        {"user_id": {"$nin": list(totals)}},
+        {"$set": {"locked_resources": 0}, "$unset": {"next_unlock_at": ""}}
+    )
+    for user_id, row in totals.items():
+        await db.backgrounds.update_one(
+            {"user_id": user_id},
+            {"$set": {"locked_resources": int(row["amount"]), "next_unlock_at": row["next_unlock_at"]}}
+        )
+    return len(totals)
+
+async def build_resources_response(bg: dict) -> ResourceAvailableResponse:
+    total = int(bg.get("risorse", 0))
+    locked = int(bg.get("locked_resources", 0))
+    available = max(0, total - locked)
+
+    items_docs = await db.resource_items.find({}, {"_id": 0}).to_list(1000)
+    items = [ResourceItemResponse(**d) for d in items_docs]
+
+    return ResourceAvailableResponse(
+        total_resources=total,
+        locked_resources=locked,
+        available_resources=available,
+        items=items
+    )
+
 @api_router.post("/resources", response_model=ResourceItemResponse)
 async def create_resource_item(data: ResourceItemCreate, admin: dict = Depends(get_admin_user)):
     if data.cost_resources <= 0:
         raise HTTPException(status_code=400, detail="Il costo in RISORSE deve essere almeno 1")
+    if data.block_until:
+        try:
+            parse_unlock_at(data.block_until)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Data di sblocco non valida")
 
     item_id = str(uuid.uuid4())
     doc = {
@@ -819,36 +2588,38 @@ async def create_resource_item(data: ResourceItemCreate, admin: dict = Depends(g
         "block_until": data.block_until
     }
     await db.resource_items.insert_one(doc)
+    await bump_collection_version("resource_items")
     return ResourceItemResponse(**doc)
 
 @api_router.get("/resources", response_model=List[ResourceItemResponse])
-async def list_resource_items(admin: dict = Depends(get_admin_user)):
+async def list_resource_items(request: Request, response: Response, admin: dict = Depends(get_admin_user)):
+    not_modified = await catalog_not_modified(request, response, "resource_items")
+    if not_modified:
+        return not_modified
     docs = await db.resource_items.find({}, {"_id": 0}).to_list(1000)
     return [ResourceItemResponse(**d) for d in docs]
 
+RESOURCES_BG_PROJECTION = {"_id": 0, "risorse": 1, "locked_resources": 1, "next_unlock_at": 1}
+
+async def load_resources_background(user_id: str, projection: dict = RESOURCES_BG_PROJECTION) -> dict:
+    """Background del PG con locked_resources aggiornato (projection deve includere i campi RISORSE)"""
+    bg = await db.backgrounds.find_one({"user_id": user_id}, projection) or {}
+    # Un lock è scaduto e lo sweeper non è ancora passato: lo rilascia subito
+    if bg.get("next_unlock_at") and as_utc(bg["next_unlock_at"]) <= datetime.now(timezone.utc):
+        await release_expired_locks(user_id)
+        bg = await db.backgrounds.find_one({"user_id": user_id}, projection) or {}
+    return bg
+
 @api_router.get("/resources/available", response_model=ResourceAvailableResponse)
 async def get_available_resources(user: dict = Depends(get_current_user)):
-    # RISORSE totali dal background
-    bg = await db.backgrounds.find_one({"user_id": user["id"]}, {"_id": 0, "risorse": 1}) or {}
-    total = int(bg.get("risorse", 0))
-    now = datetime.now(timezone.utc)
-    # Somma dei lock attivi
-    locks = await db.resource_locks.find({
-        "user_id": user["id"],
-        "unlock_at": {"$gt": now.isoformat()}
-    }, {"_id": 0, "amount": 1}).to_list(1000)
-    locked = sum(int(lock.get("amount", 0)) for lock in locks)
-    available = max(0, total - locked)
+    # RISORSE totali e bloccate dal background
+    bg = await load_resources_background(user["id"])
+    return await build_resources_response(bg)
 
-    items_docs = await db.resource_items.find({}, {"_id": 0}).to_list(1000)
-    items = [ResourceItemResponse(**d) for d in items_docs]
-
-    return ResourceAvailableResponse(
-        total_resources=total,
-        locked_resources=locked,
-        available_resources=available,
-        items=items
-    )
+async def undo_resource_lock(user_id: str, lock_id: str, amount: int):
+    """Annulla un acquisto rimasto a metà: toglie il lock, se è stato inserito, e sblocca le RISORSE"""
+    await db.resource_locks.delete_one({"id": lock_id, "status": "active"})
+    await db.backgrounds.update_one({"user_id": user_id}, {"$inc": {"locked_resources": -amount}})
 
 @api_router.post("/resources/purchase", response_model=ResourceAvailableResponse)
 async def purchase_resource(req: ResourcePurchaseRequest, user: dict = Depends(get_current_user)):
@@ -862,30 +2633,30 @@ async def purchase_resource(req: ResourcePurchaseRequest, user: dict = Depends(g
     if cost <= 0:
         raise HTTPException(status_code=400, detail="Costo RISORSE non valido")
 
-    # Calcola RISORSE disponibili
-    bg = await db.backgrounds.find_one({"user_id": user["id"]}, {"_id": 0, "risorse": 1}) or {}
-    total = int(bg.get("risorse", 0))
-
-    locks = await db.resource_locks.find({
-        "user_id": user["id"],
-        "unlock_at": {"$gt": now.isoformat()}
-    }, {"_id": 0, "amount": 1}).to_list(1000)
-    locked = sum(int(lock.get("amount", 0)) for lock in locks)
-    available = max(0, total - locked)
-
-    if available < cost:
-        raise HTTPException(status_code=403, detail="Non hai RISORSE sufficienti per questo acquisto")
-
     # Calcola unlock_at: se l'oggetto ha block_until, usa quello, altrimenti primo giorno del mese successivo
+    expires_at = next_month_start(now)
     block_until = item.get("block_until")
     if block_until:
-        unlock_at = block_until
-    else:
-        # Primo giorno del mese successivo
-        year = now.year + (1 if now.month == 12 else 0)
-        month = 1 if now.month == 12 else now.month + 1
-        unlock_date = datetime(year, month, 1, tzinfo=timezone.utc)
-        unlock_at = unlock_date.isoformat()
+        try:
+            expires_at = parse_unlock_at(block_until)
+        except ValueError:
+            logger.warning(f"Invalid block_until for resource item {item['id']}: {block_until}")
+
+    # Un lock scaduto che lo sweeper non ha ancora rilasciato non deve bloccare l'acquisto
+    await load_resources_background(user["id"])
+
+    # Blocca le RISORSE solo se bastano (atomico: due acquisti contemporanei non possono superare il totale)
+    bg = await db.backgrounds.find_one_and_update(
+        {
+            "user_id": user["id"],
+            "$expr": {"$lte": [{"$add": [{"$ifNull": ["$locked_resources", 0]}, cost]}, {"$ifNull": ["$risorse", 0]}]}
+        },
+        {"$inc": {"locked_resources": cost}},
+        projection={"_id": 0, "risorse": 1, "locked_resources": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if not bg:
+        raise HTTPException(status_code=403, detail="Non hai RISORSE sufficienti per questo acquisto")
 
     lock_doc = {
         "id": str(uuid.uuid4()),
@@ -893,14 +2664,28 @@ async def purchase_resource(req: ResourcePurchaseRequest, user: dict = Depends(g
         "item_id": item["id"],
         "amount": cost,
         "locked_at": now.isoformat(),
-        "unlock_at": unlock_at
+        "unlock_at": expires_at.isoformat(),
+        "expires_at": expires_at,
+        "status": "active"
     }
-    await db.resource_locks.insert_one(lock_doc)
+    try:
+        await db.resource_locks.insert_one(lock_doc)
+        # Scadenza pubblicata solo a lock inserito (vedi refresh_next_unlock)
+        await db.backgrounds.update_one(
+            {"user_id": user["id"]},
+            {"$min": {"next_unlock_at": expires_at}, "$inc": {"unlock_seq": 1}}
+        )
+    except BaseException:
+        # Senza un lock attivo lo sweeper non rilascerebbe mai queste RISORSE
+        await asyncio.shield(undo_resource_lock(user["id"], lock_doc["id"], cost))
+        raise
+    resource_lock_sweeper.schedule(expires_at)
 
     # Ritorna stato aggiornato
-    return await get_available_resources(user)
+    return await build_resources_response(bg)
 
 
+@api_router.get("/admin/background/{user_id}", response_model=Background)
 async def get_user_background(user_id: str, admin: dict = Depends(get_admin_user)):
     doc = await db.backgrounds.find_one({"user_id": user_id}, {"_id": 0})
     if not doc:
@@ -918,6 +2703,7 @@ async def update_user_background(user_id: str, data: Background, admin: dict = D
         {"$set": doc},
         upsert=True
     )
+    await set_followers_total(user_id, data.seguaci)
     return Background(**doc)
 
 
@@ -931,6 +2717,7 @@ async def delete_user(user_id: str, admin: dict = Depends(get_admin_user)):
     result = await db.users.delete_one({"id": user_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Utente non trovato")
+    user_cache.invalidate(user_id)
     # TODO: opzionale - pulire dati correlati (chat_history, background, ecc.)
     return {"message": "Utente eliminato"}
 
@@ -945,6 +2732,7 @@ async def update_user_role(user_id: str, data: UpdateUserRole, admin: dict = Dep
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Utente non trovato")
+    user_cache.invalidate(user_id)
     return {"message": "Ruolo aggiornato"}
 
 @api_router.post("/admin/users/{user_id}/reset-actions")
@@ -955,6 +2743,7 @@ async def reset_user_actions(user_id: str, admin: dict = Depends(get_admin_user)
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Utente non trovato")
+    user_cache.invalidate(user_id)
     return {"message": "Azioni resettate"}
 
 # ==================== ROOT ====================
@@ -965,27 +2754,59 @@ async def root():
 
 # ==================== SETTINGS ROUTES ====================
 
-@api_router.get("/settings", response_model=AppSettingsResponse)
-async def get_settings():
-    """Get app settings (public endpoint for embed)"""
-    settings = await db.settings.find_one({"id": "app_settings"}, {"_id": 0})
-    if not settings:
-        # Return defaults
-        return AppSettingsResponse(
-            event_name="L'Archivio Maledetto",
-            event_logo_url=None,
-            primary_color="#8a0000",
-            secondary_color="#000033",
-            accent_color="#b8860b",
-            background_color="#050505",
-            hero_title="Svela i Segreti",
-            hero_subtitle="dell'Antico Sapere",
-            hero_description="Benvenuto nell'Archivio Maledetto. Qui potrai porre le tue domande e ricevere risposte dai custodi del sapere arcano.",
-            chat_placeholder="Poni la tua domanda all'Oracolo...",
-            oracle_name="L'Oracolo",
-            background_image_url=None
+# Impostazioni mostrate finché un admin non le salva
+DEFAULT_APP_SETTINGS = {
+    "event_name": "L'Archivio Maledetto",
+    "event_logo_url": None,
+    "primary_color": "#8a0000",
+    "secondary_color": "#000033",
+    "accent_color": "#b8860b",
+    "background_color": "#050505",
+    "hero_title": "Svela i Segreti",
+    "hero_subtitle": "dell'Antico Sapere",
+    "hero_description": "Benvenuto nell'Archivio Maledetto. Qui potrai porre le tue domande e ricevere risposte dai custodi del sapere arcano.",
+    "chat_placeholder": "Poni la tua domanda all'Oracolo...",
+    "oracle_name": "L'Oracolo",
+    "background_image_url": None
+}
+
+class RenderedSettings:
+    """Risposta di /settings per una versione delle impostazioni, già serializzata in JSON"""
+
+    def __init__(self, version: int, updated_at: Optional[datetime], settings: Optional[dict]):
+        self.version = version
+        self.updated_at = updated_at
+        self.body = AppSettingsResponse(**(settings or DEFAULT_APP_SETTINGS)).model_dump_json().encode()
+        self.headers = validator_headers(
+            "settings", version, updated_at,
+            f"public, max-age={SETTINGS_MAX_AGE_SECONDS}, stale-while-revalidate={SETTINGS_MAX_AGE_SECONDS * 5}"
         )
-    return AppSettingsResponse(**settings)
+
+
+_rendered_settings: Optional[RenderedSettings] = None
+_rendered_settings_lock = asyncio.Lock()
+
+async def get_rendered_settings() -> RenderedSettings:
+    global _rendered_settings
+    version, updated_at = await get_collection_stamp("settings")
+    if _rendered_settings is not None and _rendered_settings.version == version:
+        return _rendered_settings
+    async with _rendered_settings_lock:
+        if _rendered_settings is None or _rendered_settings.version != version:
+            settings = await db.settings.find_one({"id": "app_settings"}, {"_id": 0})
+            _rendered_settings = RenderedSettings(version, updated_at, settings)
+    return _rendered_settings
+
+@api_router.get("/settings", response_model=AppSettingsResponse)
+async def get_settings(request: Request):
+    """Get app settings (public endpoint for embed)
+
+    Servite dalla memoria: MongoDB viene letto solo quando cambia la versione "settings".
+    """
+    rendered = await get_rendered_settings()
+    if client_is_fresh(request, rendered.headers["ETag"], rendered.updated_at):
+        return Response(status_code=304, headers=rendered.headers)
+    return Response(content=rendered.body, media_type="application/json", headers=rendered.headers)
 
 @api_router.put("/settings")
 async def update_settings(data: AppSettings, user: dict = Depends(get_admin_user)):
@@ -1000,8 +2821,194 @@ async def update_settings(data: AppSettings, user: dict = Depends(get_admin_user
         {"$set": settings_dict},
         upsert=True
     )
+    await bump_collection_version("settings")
+    # Rigenera subito la risposta pubblica per la nuova versione
+    await get_rendered_settings()
     return {"message": "Impostazioni aggiornate"}
 
+# ==================== CHALLENGE MATCHER ====================
+
+class KeywordAutomaton:
+    """Automa di Aho-Corasick: trova in un solo passaggio tutte le keyword contenute in un testo"""
+
+    def __init__(self, keywords):
+        self.goto: List[dict] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[set] = [set()]
+        for keyword in keywords:
+            state = 0
+            for ch in keyword:
+                next_state = self.goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][ch] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(set())
+                state = next_state
+            self.output[state].add(keyword)
+
+        # Link di fallimento in ampiezza: il suffisso più lungo che è anche un prefisso
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(ch, 0)
+                self.output[next_state] |= self.output[self.fail[next_state]]
+
+    def find(self, text: str) -> set:
+        found, state = set(), 0
+        for ch in text:
+            while state and ch not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(ch, 0)
+            if self.output[state]:
+                found |= self.output[state]
+        return found
+
+
+class ChallengeMatcher:
+    """Indice delle prove per /challenges/search, ricostruito quando cambia la versione "challenges".
+
+    Una prova corrisponde a una ricerca se una sua keyword è contenuta nella ricerca
+    (automa sulle keyword), oppure se la ricerca è contenuta in una keyword, nel nome o nella
+    descrizione (indice di n-grammi sui testi, poi verifica). Stessa semantica del confronto
+    per sottostringhe che sostituisce.
+    """
+
+    def __init__(self, version: int, challenges: List[dict]):
+        self.version = version
+        self.challenges = challenges
+        keyword_owners = defaultdict(set)
+        name_owners = defaultdict(set)
+        # stem di una keyword -> (prova, stem di tutta la keyword) per i suggerimenti dalla chat
+        stem_index = defaultdict(list)
+        # Una keyword vuota è contenuta in qualsiasi ricerca
+        self.always: set = set()
+        # testi (keyword, nome, descrizione in minuscolo) -> prove che li contengono
+        self.texts: List[str] = []
+        self.text_owners: List[int] = []
+        for idx, challenge in enumerate(challenges):
+            for keyword in challenge.get("keywords", []):
+                if keyword:
+                    keyword_owners[keyword].add(idx)
+                    stems = frozenset(analyze_text(keyword))
+                    for stem in stems:
+                        stem_index[stem].append((idx, stems))
+                else:
+                    self.always.add(idx)
+                self._add_text(keyword, idx)
+            name = challenge["name"].lower()
+            if name:
+                name_owners[name].add(idx)
+            self._add_text(name, idx)
+            self._add_text(challenge["description"].lower(), idx)
+        self.keyword_owners = dict(keyword_owners)
+        self.name_owners = dict(name_owners)
+        self.stem_index = dict(stem_index)
+        # Un solo automa per keyword e nomi: i nomi servono solo a question_matches
+        self.automaton = KeywordAutomaton(set(self.keyword_owners) | set(self.name_owners))
+
+        # n-grammi (1, 2, 3 caratteri) -> indici dei testi che li contengono
+        ngrams = defaultdict(set)
+        for text_idx, text in enumerate(self.texts):
+            for n in (1, 2, 3):
+                for i in range(len(text) - n + 1):
+                    ngrams[text[i:i + n]].add(text_idx)
+        self.ngrams = dict(ngrams)
+
+    def _add_text(self, text: str, challenge_idx: int):
+        self.texts.append(text)
+        self.text_owners.append(challenge_idx)
+
+    def _texts_containing(self, query: str) -> set:
+        if len(query) <= 3:
+            return self.ngrams.get(query, set())
+        grams = [query[i:i + 3] for i in range(len(query) - 2)]
+        # Parte dalla lista più corta, poi verifica la sottostringa completa
+        candidates = min((self.ngrams.get(gram, set()) for gram in grams), key=len)
+        return {text_idx for text_idx in candidates if query in self.texts[text_idx]}
+
+    def keyword_matches(self, query: str) -> Dict[int, set]:
+        """Prove con almeno una keyword contenuta nella query -> keyword trovate"""
+        found = defaultdict(set)
+        for keyword in self.automaton.find(query):
+            for idx in self.keyword_owners.get(keyword, ()):
+                found[idx].add(keyword)
+        return found
+
+    def question_matches(self, question: str) -> Tuple[List[int], List[int]]:
+        """Prove richiamate da una domanda in chat, in ordine di catalogo.
+
+        Ritorna (certe, probabili): certe se la domanda contiene una keyword o il nome della
+        prova (la regola usata finora dalla Dashboard); probabili se contiene, anche flesse,
+        tutte le parole di una keyword (es. "aprire la porta" -> "apro le porte").
+        """
+        question = question.lower()
+        certain = set()
+        for phrase in self.automaton.find(question):
+            certain |= self.keyword_owners.get(phrase, set()) | self.name_owners.get(phrase, set())
+        question_stems = set(analyze_text(question))
+        likely = set()
+        for stem in question_stems:
+            for idx, keyword_stems in self.stem_index.get(stem, ()):
+                if idx not in certain and keyword_stems <= question_stems:
+                    likely.add(idx)
+        return sorted(certain), sorted(likely)
+
+    def search(self, query: str) -> List[dict]:
+        query = query.lower()
+        if not query:
+            # Ricerca vuota: la sottostringa vuota è contenuta in ogni testo
+            return list(self.challenges)
+        matched = set(self.always) | set(self.keyword_matches(query))
+        matched |= {self.text_owners[text_idx] for text_idx in self._texts_containing(query)}
+        return [self.challenges[idx] for idx in sorted(matched)]
+
+
+_challenge_matcher: Optional[ChallengeMatcher] = None
+_challenge_matcher_lock = asyncio.Lock()
+
+async def get_challenge_matcher() -> ChallengeMatcher:
+    global _challenge_matcher
+    version = await get_collection_version("challenges")
+    if _challenge_matcher is not None and _challenge_matcher.version == version:
+        return _challenge_matcher
+    async with _challenge_matcher_lock:
+        if _challenge_matcher is None or _challenge_matcher.version != version:
+            challenges = await db.challenges.find({}, {"_id": 0}).to_list(1000)
+            # Automa, n-grammi e stem di tutto il catalogo: in un thread per non bloccare il loop
+            _challenge_matcher = await asyncio.to_thread(ChallengeMatcher, version, challenges)
+    return _challenge_matcher
+
+MAX_SUGGESTED_CHALLENGES = 3
+
+async def match_question_challenges(user: dict, question: str) -> Tuple[Optional[dict], List[dict]]:
+    """Prove richiamate da una domanda in chat, escluse quelle già tentate dal PG.
+
+    Ritorna (prova da avviare, suggerimenti): la prima prova la cui keyword o nome compare
+    nella domanda viene avviata; le altre corrispondenze diventano suggerimenti.
+    """
+    matcher = await get_challenge_matcher()
+    certain, likely = matcher.question_matches(question)
+    if not certain and not likely:
+        return None, []
+    attempted = {
+        a["challenge_id"] for a in await db.challenge_attempts.find(
+            {"user_id": user["id"], "challenge_id": {"$in": [matcher.challenges[idx]["id"] for idx in certain + likely]}},
+            {"_id": 0, "challenge_id": 1}
+        ).to_list(None)
+    }
+    certain = [matcher.challenges[idx] for idx in certain if matcher.challenges[idx]["id"] not in attempted]
+    likely = [matcher.challenges[idx] for idx in likely if matcher.challenges[idx]["id"] not in attempted]
+    triggered = ChallengeResponse(**certain[0]).model_dump() if certain else None
+    suggested = [ChallengeResponse(**c).model_dump() for c in (certain[1:] + likely)[:MAX_SUGGESTED_CHALLENGES]]
+    return triggered, suggested
+
 # ==================== CHALLENGES (PROVE LARP) ROUTES ====================
 
 @api_router.post("/challenges", response_model=ChallengeResponse)
@@ -1019,11 +3026,15 @@ async def create_challenge(data: ChallengeCreate, user: dict = Depends(get_admin
         "created_by": user["username"]
     }
     await db.challenges.insert_one(challenge_doc)
+    await bump_collection_version("challenges")
     return ChallengeResponse(**challenge_doc)
 
 @api_router.get("/challenges", response_model=List[ChallengeResponse])
-async def get_challenges(user: dict = Depends(get_current_user)):
+async def get_challenges(request: Request, response: Response, user: dict = Depends(get_current_user)):
     """Lista tutte le prove"""
+    not_modified = await catalog_not_modified(request, response, "challenges")
+    if not_modified:
+        return not_modified
     challenges = await db.challenges.find({}, {"_id": 0}).to_list(1000)
     return [ChallengeResponse(**c) for c in challenges]
 
@@ -1033,6 +3044,7 @@ async def delete_challenge(challenge_id: str, user: dict = Depends(get_admin_use
     result = await db.challenges.delete_one({"id": challenge_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Prova non trovata")
+    await bump_collection_version("challenges")
     return {"message": "Prova eliminata"}
 
 @api_router.put("/challenges/{challenge_id}")
@@ -1050,10 +3062,9 @@ async def update_challenge(challenge_id: str, data: ChallengeCreate, user: dict
     result = await db.challenges.update_one({"id": challenge_id}, {"$set": update_doc})
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Prova non trovata")
+    await bump_collection_version("challenges")
     return {"message": "Prova aggiornata"}
 
-import random
-
 @api_router.post("/challenges/attempt")
 async def attempt_challenge(data: ChallengeAttempt, user: dict = Depends(get_current_user)):
     """Tenta una prova - calcola il risultato (una sola volta per utente)"""
@@ -1066,9 +3077,7 @@ async def attempt_challenge(data: ChallengeAttempt, user: dict = Depends(get_cur
         raise HTTPException(status_code=403, detail="Hai già tentato questa prova. Non puoi ripeterla.")
     
     # Check action limit (usa limite effettivo 20 + SEGUACI - SEGUACI_spesi)
-    effective_max = await get_effective_max_actions(user)
-    if user["used_actions"] >= effective_max:
-        raise HTTPException(status_code=403, detail="Hai esaurito le tue azioni disponibili")
+    check_action_available(user)
     
     challenge = await db.challenges.find_one({"id": data.challenge_id}, {"_id": 0})
     if not challenge:
@@ -1078,119 +3087,88 @@ async def attempt_challenge(data: ChallengeAttempt, user: dict = Depends(get_cur
         raise HTTPException(status_code=400, detail="Indice prova non valido")
     
     test = challenge["tests"][data.test_index]
-    
-    # Eventuale uso del rifugio per ridurre la difficoltà
-    refuge_bonus = 0
-    if challenge.get("allow_refuge_defense") and data.use_refuge:
-        # Recupera background del PG
-        bg = await db.backgrounds.find_one({"user_id": user["id"]}, {"_id": 0, "rifugio": 1})
-        rifugio = (bg or {}).get("rifugio", 1)
-        if rifugio <= 1:
-            refuge_bonus = 0
-        elif rifugio in [2, 3]:
-            refuge_bonus = 1
-        elif rifugio == 4:
-            refuge_bonus = 2
-        else:  # 5 o più
-            refuge_bonus = 3
-    # Eventuale uso dei SEGUACI per ridurre ulteriormente la difficoltà
-    followers_used = 0
-    # Calcola quante consultazioni rimangono (prima del tentativo corrente)
-    remaining_before = effective_max - user["used_actions"]
-    if remaining_before < 0:
-        remaining_before = 0
-
-    # Leggi eventuali SEGUACI dal background
-    # Registra l'uso dei SEGUACI, se presente
-    if followers_used > 0:
-        now = datetime.now(timezone.utc)
-        spend_doc = {
-            "id": str(uuid.uuid4()),
-            "user_id": user["id"],
-            "amount": followers_used,
-            "month_key": get_month_key(now),
-            "created_at": now.isoformat()
-        }
-        await db.follower_spends.insert_one(spend_doc)
-
 
-    bg_full = await db.backgrounds.find_one({"user_id": user["id"]}, {"_id": 0, "seguaci": 1}) or {}
-    total_followers = int(bg_full.get("seguaci", 0))
-    spent_followers = await get_follower_spent_this_month(user["id"])
-    followers_available = max(0, total_followers - spent_followers)
-
-    # followers_to_use arriva dal frontend
-    followers_to_use = max(0, int(getattr(data, "followers_to_use", 0)))
-    if followers_to_use < 0:
-        followers_to_use = 0
-
-    # Non si possono usare più SEGUACI di quelli disponibili
-    followers_to_use = min(followers_to_use, followers_available)
-
-    # Non si possono usare SEGUACI che porterebbero le consultazioni sotto 0
-    if followers_to_use > remaining_before:
-        followers_to_use = remaining_before
-
-    # Applica il contributo dei SEGUACI alla difficoltà (ogni punto = -1 difficoltà)
-    if followers_to_use > 0:
-        followers_used = followers_to_use
+    # Scala l'azione (atomico: fallisce se nel frattempo le azioni sono finite); da qui ogni errore la restituisce
+    reserved_user = await reserve_action(user["id"])
+    reservation = ActionReservation(user["id"])
+    try:
+        effective_max = max(0, reserved_user["effective_max_actions"])
+
+        # Eventuale uso del rifugio per ridurre la difficoltà
+        refuge_bonus = 0
+        if challenge.get("allow_refuge_defense") and data.use_refuge:
+            # Recupera background del PG
+            bg = await db.backgrounds.find_one({"user_id": user["id"]}, {"_id": 0, "rifugio": 1})
+            rifugio = (bg or {}).get("rifugio", 1)
+            if rifugio <= 1:
+                refuge_bonus = 0
+            elif rifugio in [2, 3]:
+                refuge_bonus = 1
+            elif rifugio == 4:
+                refuge_bonus = 2
+            else:  # 5 o più
+                refuge_bonus = 3
+        # Eventuale uso dei SEGUACI per ridurre ulteriormente la difficoltà
+        followers_used = 0
+        # Calcola quante consultazioni rimangono (prima del tentativo corrente)
+        remaining_before = effective_max - (reserved_user["used_actions"] - 1)
+        if remaining_before < 0:
+            remaining_before = 0
+
+        # SEGUACI del background (copia sul documento utente)
+        total_followers = int(reserved_user.get("followers_total", 0))
+        spent_followers = await get_follower_spent_this_month(user["id"])
+        followers_available = max(0, total_followers - spent_followers)
+
+        # followers_to_use arriva dal frontend
+        followers_to_use = max(0, int(getattr(data, "followers_to_use", 0)))
+        if followers_to_use < 0:
+            followers_to_use = 0
+
+        # Non si possono usare più SEGUACI di quelli disponibili
+        followers_to_use = min(followers_to_use, followers_available)
+
+        # Non si possono usare SEGUACI che porterebbero le consultazioni sotto 0
+        if followers_to_use > remaining_before:
+            followers_to_use = remaining_before
+
+        # Applica il contributo dei SEGUACI alla difficoltà (ogni punto = -1 difficoltà)
+        if followers_to_use > 0:
+            followers_used = followers_to_use
+
+
+
+        # Calcolo con fattori random
+        player_roll = random.randint(1, 5)
+        difficulty_roll = random.randint(1, 5)
+
+        player_result = data.player_value * player_roll
+        # Applica bonus difensivo del rifugio e contributo dei SEGUACI riducendo la difficoltà effettiva
+        effective_difficulty = max(0, test["difficulty"] - refuge_bonus - followers_used)
+        difficulty_result = effective_difficulty * difficulty_roll
+
+        # Determina esito
+        if player_result > difficulty_result:
+            outcome = "success"
+            outcome_text = test["success_text"]
+        elif player_result == difficulty_result:
+            outcome = "tie"
+            outcome_text = test["tie_text"]
+        else:
+            outcome = "failure"
+            outcome_text = test["failure_text"]
 
+        # Formato output richiesto
+        result_message = f"Con il risultato di ({data.player_value}×{player_roll}) {player_result} contro ({test['difficulty']}×{difficulty_roll}) {difficulty_result}: {outcome_text}"
 
-    
-    # Calcolo con fattori random
-    player_roll = random.randint(1, 5)
-    difficulty_roll = random.randint(1, 5)
-    
-    player_result = data.player_value * player_roll
-    # Applica bonus difensivo del rifugio e contributo dei SEGUACI riducendo la difficoltà effettiva
-    effective_difficulty = max(0, test["difficulty"] - refuge_bonus - followers_used)
-    difficulty_result = effective_difficulty * difficulty_roll
-    
-    # Determina esito
-    if player_result > difficulty_result:
-        outcome = "success"
-        outcome_text = test["success_text"]
-    elif player_result == difficulty_result:
-        outcome = "tie"
-        outcome_text = test["tie_text"]
-    else:
-        outcome = "failure"
-        outcome_text = test["failure_text"]
-    
-    # Formato output richiesto
-    result_message = f"Con il risultato di ({data.player_value}×{player_roll}) {player_result} contro ({test['difficulty']}×{difficulty_roll}) {difficulty_result}: {outcome_text}"
-    
-    # Salva nel log (questo blocca tentativi futuri)
-    attempt_log = {
-        "id": str(uuid.uuid4()),
-        "user_id": user["id"],
-        "challenge_id": data.challenge_id,
-        "challenge_name": challenge["name"],
-        "test_index": data.test_index,
-        "test_attribute": test["attribute"],
-        "player_value": data.player_value,
-        "player_roll": player_roll,
-        "player_result": player_result,
-        "difficulty": test["difficulty"],
-        "difficulty_roll": difficulty_roll,
-        "difficulty_result": difficulty_result,
-        "outcome": outcome,
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
-    await db.challenge_attempts.insert_one(attempt_log)
-    
-    # Salva anche nell'archivio chat_history per lo storico
-    chat_id = str(uuid.uuid4())
-    chat_doc = {
-        "id": chat_id,
-        "user_id": user["id"],
-        "type": "challenge",
-        "question": f"Prova: {challenge['name']} - {test['attribute']}",
-        "answer": result_message,
-        "challenge_data": {
+        # Salva nel log (questo blocca tentativi futuri)
+        attempt_log = {
+            "id": str(uuid.uuid4()),
+            "user_id": user["id"],
+            "challenge_id": data.challenge_id,
             "challenge_name": challenge["name"],
-            "description": challenge["description"],
-            "attribute": test["attribute"],
+            "test_index": data.test_index,
+            "test_attribute": test["attribute"],
             "player_value": data.player_value,
             "player_roll": player_roll,
             "player_result": player_result,
@@ -1198,17 +3176,47 @@ async def attempt_challenge(data: ChallengeAttempt, user: dict = Depends(get_cur
             "difficulty_roll": difficulty_roll,
             "difficulty_result": difficulty_result,
             "outcome": outcome,
-            "outcome_text": outcome_text
-        },
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
-    await db.chat_history.insert_one(chat_doc)
-    
-    # Update used actions
-    await db.users.update_one(
-        {"id": user["id"]},
-        {"$inc": {"used_actions": 1}}
-    )
+            "created_at": datetime.now(timezone.utc).isoformat()
+        }
+        try:
+            await db.challenge_attempts.insert_one(attempt_log)
+        except DuplicateKeyError:
+            # Tentativo contemporaneo sulla stessa prova: vale solo il primo
+            await reservation.refund()
+            raise HTTPException(status_code=403, detail="Hai già tentato questa prova. Non puoi ripeterla.")
+
+        # Registra l'uso dei SEGUACI, se presente
+        if followers_used > 0:
+            await record_follower_spend(user["id"], followers_used)
+
+        # Salva anche nell'archivio chat_history per lo storico
+        chat_id = str(uuid.uuid4())
+        chat_doc = {
+            "id": chat_id,
+            "user_id": user["id"],
+            "type": "challenge",
+            "question": f"Prova: {challenge['name']} - {test['attribute']}",
+            "answer": result_message,
+            "challenge_data": {
+                "challenge_name": challenge["name"],
+                "description": challenge["description"],
+                "attribute": test["attribute"],
+                "player_value": data.player_value,
+                "player_roll": player_roll,
+                "player_result": player_result,
+                "difficulty": test["difficulty"],
+                "difficulty_roll": difficulty_roll,
+                "difficulty_result": difficulty_result,
+                "outcome": outcome,
+                "outcome_text": outcome_text
+            },
+            "created_at": datetime.now(timezone.utc).isoformat()
+        }
+        await db.chat_history.insert_one(chat_doc)
+        reservation.commit()
+    except BaseException:
+        await asyncio.shield(reservation.refund())
+        raise
     
     return {
         "challenge_name": challenge["name"],
@@ -1223,62 +3231,255 @@ async def attempt_challenge(data: ChallengeAttempt, user: dict = Depends(get_cur
         "message": result_message
     }
 
-@api_router.get("/challenges/my-attempts")
-async def get_my_attempts(user: dict = Depends(get_current_user)):
-    """Ottieni lista delle prove già tentate dall'utente"""
+async def list_attempted_challenges(user_id: str) -> List[str]:
     attempts = await db.challenge_attempts.find(
-        {"user_id": user["id"]},
+        {"user_id": user_id},
         {"_id": 0, "challenge_id": 1}
     ).to_list(1000)
     return [a["challenge_id"] for a in attempts]
 
+@api_router.get("/challenges/my-attempts")
+async def get_my_attempts(user: dict = Depends(get_current_user)):
+    """Ottieni lista delle prove già tentate dall'utente"""
+    return await list_attempted_challenges(user["id"])
+
 @api_router.get("/challenges/search")
 async def search_challenges(q: str, user: dict = Depends(get_current_user)):
     """Cerca prove per parole chiave"""
-    q_lower = q.lower()
-    challenges = await db.challenges.find({}, {"_id": 0}).to_list(1000)
-    
-    matches = []
-    for c in challenges:
-        # Cerca nelle keywords
-        for kw in c.get("keywords", []):
-            if kw in q_lower or q_lower in kw:
-                matches.append(c)
-                break
-        else:
-            # Cerca nel nome e descrizione
-            if q_lower in c["name"].lower() or q_lower in c["description"].lower():
-                matches.append(c)
-    
-    return matches
+    matcher = await get_challenge_matcher()
+    return matcher.search(q)
 
 # ==================== AIDS (AIUTI ATTRIBUTO) ROUTES ====================
 
-def is_aid_active(event_date_str: str, start_time_str: str = "00:00", end_time_str: str = "23:59", end_date_str: Optional[str] = None) -> bool:
-    """Controlla se l'aiuto è attivo (data/e e orario), supportando un intervallo data inizio/fine"""
-    from datetime import timedelta
+def event_instant(wall: datetime, last: bool = False) -> datetime:
+    """Istante UTC di un orario locale (naive) nel fuso dell'evento.
+
+    Un orario ripetuto al ritorno dell'ora solare è la prima occorrenza, o la seconda con
+    last=True. Un orario saltato dall'ora legale (a Roma 02:00-02:59 l'ultima domenica di marzo)
+    diventa l'istante del salto, il primo che il fuso mostra dopo quell'orario (le 03:00).
+    """
+    def exists(local: datetime) -> bool:
+        return local.astimezone(timezone.utc).astimezone(EVENT_TIMEZONE).replace(tzinfo=None) == local.replace(tzinfo=None)
+
+    local = wall.replace(tzinfo=EVENT_TIMEZONE, fold=int(last))
+    if exists(local):
+        return local.astimezone(timezone.utc)
+    # Gli orari arrivano al minuto: si torna all'ultimo minuto prima del salto
+    while not exists(local):
+        local -= timedelta(minutes=1)
+    return local.astimezone(timezone.utc) + timedelta(minutes=1)
+
+def aid_window(event_date: str, start_time: str = "00:00", end_time: str = "23:59",
+               end_date: Optional[str] = None) -> Tuple[datetime, datetime]:
+    """Finestra di un aiuto come istanti UTC (inizio, fine), entrambi inclusi.
+
+    Date e orari sono nel fuso dell'evento (EVENT_TIMEZONE). Se l'orario di fine precede quello
+    di inizio la finestra attraversa la mezzanotte e termina il giorno dopo end_date.
+    Ai cambi d'ora (vedi event_instant) un orario ripetuto vale dalla prima occorrenza per
+    l'inizio e fino alla seconda per la fine; un orario saltato diventa l'istante del salto.
+    Solleva ValueError se date o orari non sono validi o la fine precede l'inizio.
+    """
+    first_day = datetime.strptime(event_date, "%Y-%m-%d").date()
+    # Se non viene fornita end_date, usiamo la stessa data di inizio
+    last_day = datetime.strptime(end_date, "%Y-%m-%d").date() if end_date else first_day
+    start = datetime.strptime(start_time, "%H:%M").time()
+    end = datetime.strptime(end_time, "%H:%M").time()
+    if end < start:
+        last_day += timedelta(days=1)
+    starts_at = event_instant(datetime.combine(first_day, start))
+    ends_at = event_instant(datetime.combine(last_day, end), last=True)
+    if ends_at < starts_at:
+        raise ValueError("la fine precede l'inizio")
+    return starts_at, ends_at
+
+def aid_window_fields(data: AidCreate) -> dict:
+    """starts_at/ends_at da salvare con l'aiuto; 400 se la finestra non è valida"""
     try:
-        event_start_date = datetime.strptime(event_date_str, "%Y-%m-%d")
-        # Se non viene fornita end_date, usiamo la stessa data di inizio
-        event_end_date = datetime.strptime(end_date_str, "%Y-%m-%d") if end_date_str else event_start_date
-        now = datetime.now()
-        
-        # Parse orari
-        start_h, start_m = map(int, start_time_str.split(":"))
-        end_h, end_m = map(int, end_time_str.split(":"))
-        
-        # Costruisci finestre start/end sul primo e sull'ultimo giorno
-        start_dt = event_start_date.replace(hour=start_h, minute=start_m)
-        # Se l'orario di fine attraversa la mezzanotte, estendiamo di un giorno rispetto a event_end_date
-        if end_h < start_h:
-            end_dt = (event_end_date + timedelta(days=1)).replace(hour=end_h, minute=end_m)
-        else:
-            end_dt = event_end_date.replace(hour=end_h, minute=end_m)
-        
-        return start_dt <= now <= end_dt
-    except Exception as e:
-        logger.error(f"Error checking aid active: {e}")
-        return False
+        starts_at, ends_at = aid_window(data.event_date, data.start_time, data.end_time, data.end_date)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Date o orari della focalizzazione non validi")
+    return {"starts_at": starts_at, "ends_at": ends_at}
+
+def aid_is_active(aid: dict, now: Optional[datetime] = None) -> bool:
+    """Controlla se l'aiuto è attivo adesso (o in now)"""
+    now = now or datetime.now(timezone.utc)
+    if "starts_at" in aid:
+        starts_at, ends_at = aid["starts_at"], aid["ends_at"]
+        if starts_at is None:
+            return False
+        starts_at, ends_at = as_utc(starts_at), as_utc(ends_at)
+    else:
+        # Aiuto salvato prima di starts_at/ends_at e non ancora aggiornato da backfill_aid_windows
+        try:
+            starts_at, ends_at = aid_window(aid["event_date"], aid.get("start_time", "00:00"),
+                                           aid.get("end_time", "23:59"), aid.get("end_date"))
+        except ValueError:
+            return False
+    return starts_at <= now <= ends_at
+
+def aid_response(aid: dict) -> AidResponse:
+    return AidResponse(**{
+        **aid,
+        "start_time": aid.get("start_time", "00:00"),
+        "end_time": aid.get("end_time", "23:59"),
+        "end_date": aid.get("end_date"),
+        "starts_at": as_utc(aid["starts_at"]) if aid.get("starts_at") else None,
+        "ends_at": as_utc(aid["ends_at"]) if aid.get("ends_at") else None
+    })
+
+class AidSchedule:
+    """Finestre degli aiuti di una versione della collezione "aids", ordinate per inizio.
+
+    Gli aiuti attivi in un istante sono quelli iniziati (ricerca binaria sugli inizi) e non
+    ancora finiti. Il risultato non cambia fino al prossimo confine, cioè l'inizio di una
+    finestra o l'istante dopo una fine, quindi resta in cache fino a quel momento.
+    """
+
+    def __init__(self, version: int, aids: List[dict]):
+        self.version = version
+        windows = []
+        for position, aid in enumerate(aids):
+            if aid.get("starts_at") is None or aid.get("ends_at") is None:
+                continue
+            windows.append((as_utc(aid["starts_at"]), as_utc(aid["ends_at"]), position, aid_response(aid)))
+        windows.sort(key=lambda w: (w[0], w[2]))
+        self.windows = windows
+        self.starts = [w[0] for w in windows]
+        # Una finestra smette di essere attiva subito dopo la sua fine (fine inclusa)
+        self.boundaries = sorted({w[0] for w in windows} | {w[1] + timedelta(microseconds=1) for w in windows})
+        self._cached: Optional[Tuple[datetime, Optional[datetime], List[AidResponse]]] = None
+
+    def next_boundary(self, now: datetime) -> Optional[datetime]:
+        """Primo istante dopo now in cui l'insieme degli aiuti attivi cambia"""
+        i = bisect.bisect_right(self.boundaries, now)
+        return self.boundaries[i] if i < len(self.boundaries) else None
+
+    def active(self, now: datetime) -> List[AidResponse]:
+        """Aiuti attivi in now, nell'ordine della collezione"""
+        cached = self._cached
+        if cached is not None and cached[0] <= now and (cached[1] is None or now < cached[1]):
+            return cached[2]
+        started = self.windows[:bisect.bisect_right(self.starts, now)]
+        active = [w for w in started if now <= w[1]]
+        active.sort(key=lambda w: w[2])
+        result = [w[3] for w in active]
+        self._cached = (now, self.next_boundary(now), result)
+        return result
+
+
+_aid_schedule: Optional[AidSchedule] = None
+_aid_schedule_lock = asyncio.Lock()
+
+async def get_aid_schedule() -> AidSchedule:
+    global _aid_schedule
+    version = await get_collection_version("aids")
+    if _aid_schedule is not None and _aid_schedule.version == version:
+        return _aid_schedule
+    async with _aid_schedule_lock:
+        if _aid_schedule is None or _aid_schedule.version != version:
+            aids = await db.aids.find({}, {"_id": 0}).to_list(1000)
+            _aid_schedule = AidSchedule(version, aids)
+    return _aid_schedule
+
+async def backfill_aid_windows() -> int:
+    """Calcola starts_at/ends_at per gli aiuti salvati prima che venissero memorizzati.
+
+    Gli aiuti con date non valide ricevono starts_at/ends_at null: non sono mai attivi,
+    come prima, e non vengono riconsiderati a ogni avvio.
+    """
+    updated = 0
+    async for aid in db.aids.find({"starts_at": {"$exists": False}}, {"_id": 0}):
+        try:
+            starts_at, ends_at = aid_window(aid["event_date"], aid.get("start_time", "00:00"),
+                                           aid.get("end_time", "23:59"), aid.get("end_date"))
+        except (KeyError, ValueError):
+            logger.warning(f"Aid {aid.get('id')} has an invalid window, it will never be active")
+            starts_at = ends_at = None
+        await db.aids.update_one({"id": aid["id"]}, {"$set": {"starts_at": starts_at, "ends_at": ends_at}})
+        updated += 1
+    if updated:
+        await bump_collection_version("aids")
+        logger.info(f"Computed activity windows for {updated} aids")
+    return updated
+
+# Intervallo dei commenti keep-alive sullo stream /aids/events (proxy e load balancer chiudono le connessioni inattive)
+AID_EVENTS_KEEPALIVE_SECONDS = 15
+
+class AidEventHub:
+    """Notifica ai client connessi a /aids/events l'apertura e la chiusura delle finestre.
+
+    Un solo task per processo segue la AidSchedule: dorme fino al prossimo confine (al più
+    VERSION_POLL_SECONDS, per vedere le modifiche fatte da altri processi) e invia agli iscritti
+    solo le differenze rispetto agli aiuti attivi precedenti. Ogni evento viene serializzato
+    una volta sola per tutti gli iscritti.
+    """
+
+    QUEUE_SIZE = 64
+
+    def __init__(self):
+        self.active: Dict[str, AidResponse] = {}
+        self.subscribers: set = set()
+        self._wakeup = asyncio.Event()
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.QUEUE_SIZE)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+
+    def snapshot_event(self) -> str:
+        return sse_event("snapshot", {"aids": [aid.model_dump(mode="json") for aid in self.active.values()]})
+
+    def wake(self):
+        """Ricontrolla subito la schedule (aiuto creato, modificato o eliminato da questo processo)"""
+        self._wakeup.set()
+
+    def _broadcast(self, message: str):
+        for queue in list(self.subscribers):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Client che non legge: chiudiamo lo stream, alla riconnessione riceverà un nuovo snapshot
+                self.subscribers.discard(queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    async def refresh(self) -> Optional[datetime]:
+        """Invia le aperture/chiusure rispetto all'ultimo controllo; ritorna il prossimo confine"""
+        schedule = await get_aid_schedule()
+        now = datetime.now(timezone.utc)
+        active = {aid.id: aid for aid in schedule.active(now)}
+        for aid_id, aid in active.items():
+            # Un aiuto modificato mentre è attivo viene reinviato come "opened" con i nuovi dati
+            if self.active.get(aid_id) != aid:
+                self._broadcast(sse_event("opened", {"aid": aid.model_dump(mode="json")}))
+        for aid_id in self.active.keys() - active.keys():
+            self._broadcast(sse_event("closed", {"aid_id": aid_id}))
+        self.active = active
+        return schedule.next_boundary(now)
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            next_boundary = None
+            try:
+                next_boundary = await self.refresh()
+            except Exception as e:
+                logger.error(f"Aid events refresh failed: {e}")
+            delay = VERSION_POLL_SECONDS
+            if next_boundary is not None:
+                delay = min(delay, max(0.0, (next_boundary - datetime.now(timezone.utc)).total_seconds()))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+
+aid_event_hub = AidEventHub()
+aid_event_hub_task: Optional[asyncio.Task] = None
 
 @api_router.post("/aids", response_model=AidResponse)
 async def create_aid(data: AidCreate, user: dict = Depends(get_admin_user)):
@@ -1293,28 +3494,60 @@ async def create_aid(data: AidCreate, user: dict = Depends(get_admin_user)):
         "end_date": data.end_date,
         "start_time": data.start_time,
         "end_time": data.end_time,
+        **aid_window_fields(data),
         "created_at": datetime.now(timezone.utc).isoformat(),
         "created_by": user["username"]
     }
     await db.aids.insert_one(aid_doc)
-    return AidResponse(**aid_doc)
+    await bump_collection_version("aids")
+    aid_event_hub.wake()
+    return aid_response(aid_doc)
 
 @api_router.get("/aids", response_model=List[AidResponse])
-async def get_aids(user: dict = Depends(get_current_user)):
+async def get_aids(request: Request, response: Response, user: dict = Depends(get_current_user)):
     """Lista tutte le focalizzazioni"""
+    not_modified = await catalog_not_modified(request, response, "aids")
+    if not_modified:
+        return not_modified
     aids = await db.aids.find({}, {"_id": 0}).to_list(1000)
-    return [AidResponse(**{**a, "start_time": a.get("start_time", "00:00"), "end_time": a.get("end_time", "23:59"), "end_date": a.get("end_date")}) for a in aids]
+    return [aid_response(a) for a in aids]
 
 @api_router.get("/aids/active", response_model=List[AidResponse])
 async def get_active_aids(user: dict = Depends(get_current_user)):
     """Lista solo le focalizzazioni attive (data e orario validi)"""
-    aids = await db.aids.find({}, {"_id": 0}).to_list(1000)
-    active = [
-        AidResponse(**{**a, "start_time": a.get("start_time", "00:00"), "end_time": a.get("end_time", "23:59"), "end_date": a.get("end_date")}) 
-        for a in aids 
-        if is_aid_active(a["event_date"], a.get("start_time", "00:00"), a.get("end_time", "23:59"), a.get("end_date"))
-    ]
-    return active
+    schedule = await get_aid_schedule()
+    return schedule.active(datetime.now(timezone.utc))
+
+@api_router.get("/aids/events")
+async def get_aid_events(user: dict = Depends(get_current_user)):
+    """Focalizzazioni attive come Server-Sent Events.
+
+    Eventi: "snapshot" ({"aids"}) alla connessione con gli aiuti attivi, poi "opened" ({"aid"})
+    e "closed" ({"aid_id"}) quando una finestra si apre o si chiude. Se lo stream si chiude il
+    client si riconnette e riparte dallo snapshot.
+    """
+    queue = aid_event_hub.subscribe()
+
+    async def events():
+        try:
+            yield aid_event_hub.snapshot_event()
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), timeout=AID_EVENTS_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if message is None:
+                    return
+                yield message
+        finally:
+            aid_event_hub.unsubscribe(queue)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @api_router.delete("/aids/{aid_id}")
 async def delete_aid(aid_id: str, user: dict = Depends(get_admin_user)):
@@ -1322,6 +3555,8 @@ async def delete_aid(aid_id: str, user: dict = Depends(get_admin_user)):
     result = await db.aids.delete_one({"id": aid_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Aiuto non trovato")
+    await bump_collection_version("aids")
+    aid_event_hub.wake()
     return {"message": "Aiuto eliminato"}
 
 @api_router.put("/aids/{aid_id}")
@@ -1335,31 +3570,34 @@ async def update_aid(aid_id: str, data: AidCreate, user: dict = Depends(get_admi
         "end_date": data.end_date,
         "start_time": data.start_time,
         "end_time": data.end_time,
+        **aid_window_fields(data),
         "updated_at": datetime.now(timezone.utc).isoformat(),
         "updated_by": user["username"]
     }
     result = await db.aids.update_one({"id": aid_id}, {"$set": update_doc})
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Focalizzazione non trovata")
+    await bump_collection_version("aids")
+    aid_event_hub.wake()
     return {"message": "Focalizzazione aggiornata"}
 
+async def list_used_aids(user_id: str) -> List[dict]:
+    return await db.aid_uses.find(
+        {"user_id": user_id},
+        {"_id": 0, "aid_id": 1, "level": 1}
+    ).to_list(1000)
+
 @api_router.get("/aids/my-used")
 async def get_my_used_aids(user: dict = Depends(get_current_user)):
     """Ottieni lista degli aiuti già usati dall'utente (aid_id + level)"""
-    used = await db.aid_uses.find(
-        {"user_id": user["id"]},
-        {"_id": 0, "aid_id": 1, "level": 1}
-    ).to_list(1000)
-    return used
+    return await list_used_aids(user["id"])
 
 @api_router.post("/aids/use")
 async def use_aid(data: UseAid, user: dict = Depends(get_current_user)):
     """Usa un aiuto - verifica attributo e data"""
     
     # Check action limit (usa limite effettivo 20 + SEGUACI - SEGUACI_spesi)
-    effective_max = await get_effective_max_actions(user)
-    if user["used_actions"] >= effective_max:
-        raise HTTPException(status_code=403, detail="Hai esaurito le tue azioni disponibili")
+    check_action_available(user)
     
     # Trova l'aiuto
     aid = await db.aids.find_one({"id": data.aid_id}, {"_id": 0})
@@ -1367,7 +3605,7 @@ async def use_aid(data: UseAid, user: dict = Depends(get_current_user)):
         raise HTTPException(status_code=404, detail="Aiuto non trovato")
     
     # Verifica data e orario attivi
-    if not is_aid_active(aid["event_date"], aid.get("start_time", "00:00"), aid.get("end_time", "23:59"), aid.get("end_date")):
+    if not aid_is_active(aid):
         raise HTTPException(status_code=403, detail="Questo aiuto non è attivo in questo momento. Controlla data e orario dell'evento.")
     
     # Verifica se già usato questo livello
@@ -1396,46 +3634,52 @@ async def use_aid(data: UseAid, user: dict = Depends(get_current_user)):
     if not level_data:
         raise HTTPException(status_code=400, detail="Livello non trovato per questo aiuto")
     
-    # Salva l'uso
-    use_log = {
-        "id": str(uuid.uuid4()),
-        "user_id": user["id"],
-        "aid_id": data.aid_id,
-        "aid_name": aid["name"],
-        "attribute": aid["attribute"],
-        "level": data.level,
-        "level_name": level_data["level_name"],
-        "player_value": data.player_attribute_value,
-        "text": level_data["text"],
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
-    await db.aid_uses.insert_one(use_log)
-    
-    # Salva nell'archivio chat_history
-    chat_id = str(uuid.uuid4())
-    chat_doc = {
-        "id": chat_id,
-        "user_id": user["id"],
-        "type": "aid",
-        "question": f"Aiuto: {aid['name']} - {aid['attribute']} (Livello {level_data['level_name']})",
-        "answer": level_data["text"],
-        "aid_data": {
+    # Scala l'azione (atomico: fallisce se nel frattempo le azioni sono finite); da qui ogni errore la restituisce
+    await reserve_action(user["id"])
+    reservation = ActionReservation(user["id"])
+    try:
+        # Salva l'uso
+        use_log = {
+            "id": str(uuid.uuid4()),
+            "user_id": user["id"],
+            "aid_id": data.aid_id,
             "aid_name": aid["name"],
             "attribute": aid["attribute"],
             "level": data.level,
             "level_name": level_data["level_name"],
             "player_value": data.player_attribute_value,
-            "text": level_data["text"]
-        },
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
-    await db.chat_history.insert_one(chat_doc)
-    
-    # Update used actions
-    await db.users.update_one(
-        {"id": user["id"]},
-        {"$inc": {"used_actions": 1}}
-    )
+            "text": level_data["text"],
+            "created_at": datetime.now(timezone.utc).isoformat()
+        }
+        try:
+            await db.aid_uses.insert_one(use_log)
+        except DuplicateKeyError:
+            await reservation.refund()
+            raise HTTPException(status_code=403, detail="Hai già utilizzato questo aiuto a questo livello.")
+
+        # Salva nell'archivio chat_history
+        chat_id = str(uuid.uuid4())
+        chat_doc = {
+            "id": chat_id,
+            "user_id": user["id"],
+            "type": "aid",
+            "question": f"Aiuto: {aid['name']} - {aid['attribute']} (Livello {level_data['level_name']})",
+            "answer": level_data["text"],
+            "aid_data": {
+                "aid_name": aid["name"],
+                "attribute": aid["attribute"],
+                "level": data.level,
+                "level_name": level_data["level_name"],
+                "player_value": data.player_attribute_value,
+                "text": level_data["text"]
+            },
+            "created_at": datetime.now(timezone.utc).isoformat()
+        }
+        await db.chat_history.insert_one(chat_doc)
+        reservation.commit()
+    except BaseException:
+        await asyncio.shield(reservation.refund())
+        raise
     
     return {
         "aid_name": aid["name"],
@@ -1446,6 +3690,35 @@ async def use_aid(data: UseAid, user: dict = Depends(get_current_user)):
         "message": f"Hai ottenuto l'aiuto {level_data['level_name']} di {aid['attribute']}: {level_data['text']}"
     }
 
+# ==================== PLAYER STATE ====================
+
+PLAYER_STATE_BG_PROJECTION = {**RESOURCES_BG_PROJECTION, "seguaci": 1}
+
+@api_router.get("/player/state", response_model=PlayerState)
+async def get_player_state(request: Request, user: dict = Depends(get_current_user)):
+    """Stato del PG (utente, SEGUACI, RISORSE, prove tentate, aiuti attivi e usati) in una richiesta.
+
+    Il background viene letto una volta sola e il resto in parallelo. L'ETag è calcolato sul
+    contenuto: se non è cambiato nulla il client riceve 304 senza corpo.
+    """
+    bg = await load_resources_background(user["id"], PLAYER_STATE_BG_PROJECTION)
+    followers, resources, attempted, used_aids, schedule = await asyncio.gather(
+        build_follower_status(user, bg),
+        build_resources_response(bg),
+        list_attempted_challenges(user["id"]),
+        list_used_aids(user["id"]),
+        get_aid_schedule()
+    )
+    state = PlayerState(
+        user=UserResponse(**user),
+        followers=followers,
+        resources=resources,
+        attempted_challenges=attempted,
+        active_aids=schedule.active(datetime.now(timezone.utc)),
+        used_aids=used_aids
+    )
+    return json_response_with_etag(request, state.model_dump_json().encode(), "private, no-cache")
+
 app.include_router(api_router)
 
 app.add_middleware(
@@ -1456,6 +3729,96 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def create_indexes():
+    result = await ensure_indexes(db)
+    if result["failed"]:
+        logger.error(f"Missing indexes (run db_indexes.py --report): {', '.join(result['failed'])}")
+
+async def remove_duplicate_kb_chunks() -> int:
+    """Tiene un solo chunk per (kb_id, position): i duplicati impediscono l'indice unique"""
+    removed = 0
+    async for group in db.knowledge_chunks.aggregate([
+        {"$group": {"_id": {"kb_id": "$kb_id", "position": "$position"}, "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ]):
+        result = await db.knowledge_chunks.delete_many({"_id": {"$in": group["ids"][1:]}})
+        removed += result.deleted_count
+    return removed
+
+@app.on_event("startup")
+async def backfill_kb_chunks():
+    """Crea i chunk per i documenti KB inseriti prima dell'introduzione di knowledge_chunks"""
+    if await db.maintenance.find_one({"id": "kb_chunks_built"}):
+        return
+    removed = await remove_duplicate_kb_chunks()
+    if removed:
+        # L'indice unique (kb_id, position) viene creato da ensure_indexes al prossimo avvio
+        logger.warning(f"Removed {removed} duplicate knowledge chunks")
+    chunked_ids = set(await db.knowledge_chunks.distinct("kb_id"))
+    backfilled = 0
+    async for kb_doc in db.knowledge_base.find({"id": {"$nin": list(chunked_ids)}}, {"_id": 0}):
+        if await store_kb_chunks(kb_doc):
+            backfilled += 1
+    if backfilled or removed:
+        await bump_collection_version("knowledge_base")
+        logger.info(f"Chunked {backfilled} knowledge base documents")
+    await db.maintenance.update_one(
+        {"id": "kb_chunks_built"},
+        {"$set": {"completed_at": datetime.now(timezone.utc).isoformat(), "documents": backfilled}},
+        upsert=True
+    )
+
+@app.on_event("startup")
+async def start_aid_event_hub():
+    global aid_event_hub_task
+    await backfill_aid_windows()
+    aid_event_hub_task = asyncio.create_task(aid_event_hub.run())
+
+@app.on_event("startup")
+async def build_follower_spend_totals():
+    """Crea i contatori follower_spend_totals dal log la prima volta che il processo parte con questa versione"""
+    if await db.maintenance.find_one({"id": "follower_spend_totals_built"}):
+        return
+    await reconcile_follower_spend_totals()
+    await db.maintenance.update_one(
+        {"id": "follower_spend_totals_built"},
+        {"$set": {"completed_at": datetime.now(timezone.utc).isoformat()}},
+        upsert=True
+    )
+
+@app.on_event("startup")
+async def start_resource_lock_sweeper():
+    global resource_lock_sweeper_task
+    if not await db.maintenance.find_one({"id": "resource_lock_totals_built"}):
+        rebuilt = await rebuild_resource_lock_totals()
+        await db.maintenance.update_one(
+            {"id": "resource_lock_totals_built"},
+            {"$set": {"completed_at": datetime.now(timezone.utc).isoformat(), "users": rebuilt}},
+            upsert=True
+        )
+    resource_lock_sweeper_task = asyncio.create_task(resource_lock_sweeper.run())
+
+@app.on_event("startup")
+async def start_llm_client():
+    global llm_client
+    if not EMERGENT_LLM_KEY:
+        logger.warning("EMERGENT_LLM_KEY non configurata: l'Oracolo risponderà con il messaggio di errore")
+    llm_client = OracleLLMClient(EMERGENT_LLM_KEY or "", LLM_BASE_URL, pool_size=LLM_MAX_CONCURRENCY * 2, timeout=LLM_TIMEOUT_SECONDS)
+
+@app.on_event("startup")
+async def start_monthly_reset_scheduler():
+    global monthly_reset_task
+    monthly_reset_task = asyncio.create_task(monthly_reset_scheduler())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    if monthly_reset_task is not None:
+        monthly_reset_task.cancel()
+    if resource_lock_sweeper_task is not None:
+        resource_lock_sweeper_task.cancel()
+    if aid_event_hub_task is not None:
+        aid_event_hub_task.cancel()
     client.close()
+    if llm_client is not None:
+        await llm_client.close()
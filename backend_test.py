@@ -2,6 +2,7 @@ import requests
 import sys
 import json
 from datetime import datetime, timedelta
+from urllib.parse import quote
 
 class ArchivioMaledettoAPITester:
     def __init__(self, base_url="https://cursed-lore.preview.emergentagent.com/api"):
@@ -837,17 +838,55 @@ class ArchivioMaledettoAPITester:
         )
 
         if success:
-            # Test getting chat history
+            # Seconda domanda: l'archivio deve avere almeno due pagine da una voce
             success, response = self.run_test(
-                "Get Chat History",
-                "GET",
-                "chat/history",
+                "Send Second Chat Message",
+                "POST",
+                "chat",
                 200,
+                data={"question": "Quali clan partecipano all'evento?"},
                 headers={'Authorization': f'Bearer {self.token}'}
             )
 
+        if success:
+            success = self.test_chat_history_pages()
+
         return success
 
+    def test_chat_history_pages(self):
+        """Scorre l'archivio una voce per pagina seguendo next_cursor"""
+        endpoint = "chat/history?limit=1"
+        seen = []
+        for page_number in range(1, 4):
+            success, response = self.run_test(
+                f"Get Chat History (page {page_number})",
+                "GET",
+                endpoint,
+                200,
+                headers={'Authorization': f'Bearer {self.token}'}
+            )
+            if not success:
+                return False
+            if set(response) != {"items", "next_cursor"}:
+                self.log_test("Chat History Shape", False, f"Unexpected keys: {sorted(response)}")
+                return False
+            if len(response["items"]) != 1:
+                self.log_test("Chat History Shape", False, f"Expected 1 item, got {len(response['items'])}")
+                return False
+            seen.append(response["items"][0]["id"])
+            if not response["next_cursor"]:
+                break
+            endpoint = f"chat/history?limit=1&before={quote(response['next_cursor'])}"
+
+        if len(seen) < 2:
+            self.log_test("Chat History Pagination", False, f"Only {len(seen)} page(s) returned")
+            return False
+        if len(set(seen)) != len(seen):
+            self.log_test("Chat History Pagination", False, f"Repeated entries across pages: {seen}")
+            return False
+        self.log_test("Chat History Pagination", True, f"{len(seen)} pages, no repeated entries")
+        return True
+
     def test_admin_operations(self):
         """Test admin operations (expecting 403 for non-admin users)"""
         if not self.admin_token:
@@ -9,11 +9,11 @@ import { useSettings } from "@/context/SettingsContext";
 
 const API = `${process.env.REACT_APP_BACKEND_URL}/api`;
 
-export default function AidsModal({ token, onClose, onResult, refreshUser }) {
+// aids: focalizzazioni attive seguite dalla Dashboard (null finché non arriva lo snapshot);
+// usedAids: livelli già usati dal PG, aggiornati tramite onAidUsed
+export default function AidsModal({ token, aids, usedAids, onAidUsed, onClose, onResult, refreshUser }) {
   const { settings } = useSettings();
-  const [aids, setAids] = useState([]);
-  const [usedAids, setUsedAids] = useState([]);
-  const [loading, setLoading] = useState(true);
+  const loading = aids === null;
   const [submitting, setSubmitting] = useState(false);
   
   // Step 1: inserisci tutti i valori attributo, Step 2: selezione livello
@@ -42,8 +42,6 @@ export default function AidsModal({ token, onClose, onResult, refreshUser }) {
   };
 
   useEffect(() => {
-    fetchData();
-
     // Se siamo dentro la macrofinestra evento, prova a recuperare valori salvati
     if (isWithinEventWindow()) {
       const key = getEventWindowKey();
@@ -63,25 +61,6 @@ export default function AidsModal({ token, onClose, onResult, refreshUser }) {
     }
   }, []);
 
-  const fetchData = async () => {
-    try {
-      const [aidsRes, usedRes] = await Promise.all([
-        fetch(`${API}/aids/active`, { headers: { Authorization: `Bearer ${token}` } }),
-        fetch(`${API}/aids/my-used`, { headers: { Authorization: `Bearer ${token}` } })
-      ]);
-
-      if (aidsRes.ok) {
-        const aidsData = await aidsRes.json();
-        setAids(aidsData);
-      }
-      if (usedRes.ok) setUsedAids(await usedRes.json());
-    } catch (error) {
-      toast.error("Errore nel caricamento");
-    } finally {
-      setLoading(false);
-    }
-  };
-
   const isLevelUsed = (aidId, level) => {
     return usedAids.some(u => u.aid_id === aidId && u.level === level);
   };
@@ -109,7 +88,7 @@ export default function AidsModal({ token, onClose, onResult, refreshUser }) {
 
   useEffect(() => {
     // Se abbiamo valori salvati e gli aiuti sono stati caricati, ricalcola le focalizzazioni disponibili
-    if (submittedValues && aids.length > 0) {
+    if (submittedValues && aids?.length > 0) {
       recomputeAvailableAids(submittedValues);
     }
     // eslint-disable-next-line react-hooks/exhaustive-deps
@@ -185,6 +164,7 @@ export default function AidsModal({ token, onClose, onResult, refreshUser }) {
       
       if (response.ok) {
         toast.success("Focalizzazione ottenuta!");
+        onAidUsed(aid.id, level.level);
         onResult(data);
         refreshUser();
         onClose();
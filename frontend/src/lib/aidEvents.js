@@ -0,0 +1,47 @@
+import { readEvents } from "./sse";
+
+// Segue le focalizzazioni attive via /aids/events: onChange riceve la lista aggiornata
+// alla connessione ("snapshot") e a ogni apertura/chiusura di una finestra.
+// Si riconnette da solo se lo stream cade; ritorna la funzione per chiuderlo.
+export function subscribeAidEvents(api, token, onChange) {
+  const controller = new AbortController();
+  let aids = new Map();
+  let retryDelay = 1000;
+
+  const apply = (event, payload) => {
+    if (event === "snapshot") {
+      aids = new Map(payload.aids.map(aid => [aid.id, aid]));
+    } else if (event === "opened") {
+      aids = new Map(aids).set(payload.aid.id, payload.aid);
+    } else if (event === "closed") {
+      aids = new Map(aids);
+      aids.delete(payload.aid_id);
+    } else {
+      return undefined;
+    }
+    retryDelay = 1000;
+    onChange([...aids.values()]);
+    return undefined;
+  };
+
+  const connect = async () => {
+    while (!controller.signal.aborted) {
+      try {
+        const response = await fetch(`${api}/aids/events`, {
+          headers: { Authorization: `Bearer ${token}` },
+          signal: controller.signal
+        });
+        // Token non valido: inutile riprovare
+        if (response.status === 401 || response.status === 403) return;
+        if (response.ok) await readEvents(response, apply);
+      } catch (error) {
+        if (controller.signal.aborted) return;
+      }
+      await new Promise(resolve => setTimeout(resolve, retryDelay));
+      retryDelay = Math.min(retryDelay * 2, 30000);
+    }
+  };
+
+  connect();
+  return () => controller.abort();
+}
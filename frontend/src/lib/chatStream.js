@@ -0,0 +1,31 @@
+import { readEvents } from "./sse";
+
+// Consulta l'Oracolo via Server-Sent Events (/chat/stream).
+// onToken riceve ogni frammento di risposta appena arriva; la promise si risolve
+// con la consultazione salvata (evento "done") o fallisce con il "detail" del server.
+// Con triggerChallenges la domanda può richiamare una prova: la promise si risolve
+// subito con l'evento "challenge" ({ triggered_challenge }) e nessun token.
+export async function streamChat(api, token, question, onToken, { triggerChallenges = false } = {}) {
+  const response = await fetch(`${api}/chat/stream`, {
+    method: "POST",
+    headers: {
+      "Content-Type": "application/json",
+      Authorization: `Bearer ${token}`
+    },
+    body: JSON.stringify({ question, trigger_challenges: triggerChallenges })
+  });
+
+  if (!response.ok) {
+    const data = await response.json().catch(() => ({}));
+    throw new Error(data.detail || "Errore nella richiesta");
+  }
+
+  const result = await readEvents(response, (event, payload) => {
+    if (event === "token") onToken(payload.text);
+    else if (event === "done" || event === "challenge") return payload;
+    else if (event === "error") throw new Error(payload.detail);
+    return undefined;
+  });
+  if (result === undefined) throw new Error("Risposta interrotta");
+  return result;
+}
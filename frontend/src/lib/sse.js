@@ -0,0 +1,35 @@
+// Legge una risposta text/event-stream e chiama onEvent(event, payload) per ogni evento.
+// Se onEvent ritorna un valore diverso da undefined la lettura si ferma e la promise si
+// risolve con quel valore; altrimenti si risolve con undefined a fine stream.
+export async function readEvents(response, onEvent) {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) return undefined;
+    buffer += decoder.decode(value, { stream: true });
+
+    let boundary;
+    while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+      const rawEvent = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+
+      let event = "message";
+      let data = "";
+      for (const line of rawEvent.split("\n")) {
+        if (line.startsWith("event:")) event = line.slice(6).trim();
+        else if (line.startsWith("data:")) data += line.slice(5).trim();
+      }
+      // Commenti keep-alive (": ...") ed eventi vuoti
+      if (!data) continue;
+
+      const result = onEvent(event, JSON.parse(data));
+      if (result !== undefined) {
+        reader.cancel().catch(() => {});
+        return result;
+      }
+    }
+  }
+}
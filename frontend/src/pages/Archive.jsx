@@ -1,6 +1,7 @@
-import { useState, useEffect } from "react";
+import { useState, useEffect, useRef } from "react";
 import { Link } from "react-router-dom";
 import { Button } from "@/components/ui/button";
+import { Input } from "@/components/ui/input";
 import { ScrollArea } from "@/components/ui/scroll-area";
 import { toast } from "sonner";
 import { 
@@ -11,7 +12,9 @@ import {
   Loader2,
   BookOpen,
   Swords,
-  Sparkles
+  Sparkles,
+  Search,
+  X
 } from "lucide-react";
 import { useSettings } from "@/context/SettingsContext";
 
@@ -20,22 +23,40 @@ const API = `${process.env.REACT_APP_BACKEND_URL}/api`;
 export default function Archive({ user, token, onLogout }) {
   const { settings } = useSettings();
   const [history, setHistory] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
   const [loading, setLoading] = useState(true);
+  const [loadingMore, setLoadingMore] = useState(false);
+  const [selectedId, setSelectedId] = useState(null);
   const [selectedChat, setSelectedChat] = useState(null);
+  const [detailLoading, setDetailLoading] = useState(false);
+  // Consultazioni complete già scaricate (id -> voce)
+  const detailsRef = useRef({});
+  const selectedIdRef = useRef(null);
+  // Ricerca: searchResults è null quando si mostra l'archivio completo
+  const [searchQuery, setSearchQuery] = useState("");
+  const [searchType, setSearchType] = useState("");
+  const [searchResults, setSearchResults] = useState(null);
+  const [searchPage, setSearchPage] = useState(1);
+  const [searchHasMore, setSearchHasMore] = useState(false);
+  const [searching, setSearching] = useState(false);
 
   useEffect(() => {
     fetchHistory();
   }, []);
 
-  const fetchHistory = async () => {
+  // La lista arriva a pagine con la sola anteprima della risposta
+  const fetchHistory = async (before = null) => {
+    if (before) setLoadingMore(true);
     try {
-      const response = await fetch(`${API}/chat/history`, {
+      const params = before ? `?before=${encodeURIComponent(before)}` : "";
+      const response = await fetch(`${API}/chat/history${params}`, {
         headers: { Authorization: `Bearer ${token}` }
       });
 
       if (response.ok) {
         const data = await response.json();
-        setHistory(data);
+        setHistory(prev => before ? [...prev, ...data.items] : data.items);
+        setNextCursor(data.next_cursor);
       } else {
         toast.error("Errore", { description: "Impossibile caricare l'archivio" });
       }
@@ -43,9 +64,88 @@ export default function Archive({ user, token, onLogout }) {
       toast.error("Errore di connessione");
     } finally {
       setLoading(false);
+      setLoadingMore(false);
     }
   };
 
+  // Il dettaglio completo si scarica solo quando si apre la consultazione
+  const selectChat = async (item) => {
+    setSelectedId(item.id);
+    selectedIdRef.current = item.id;
+    if (detailsRef.current[item.id]) {
+      setSelectedChat(detailsRef.current[item.id]);
+      return;
+    }
+    setSelectedChat(null);
+    setDetailLoading(true);
+    try {
+      const response = await fetch(`${API}/chat/history/${item.id}`, {
+        headers: { Authorization: `Bearer ${token}` }
+      });
+      if (response.ok) {
+        const data = await response.json();
+        detailsRef.current[item.id] = data;
+        // Nel frattempo il PG potrebbe aver aperto un'altra consultazione
+        if (selectedIdRef.current === item.id) setSelectedChat(data);
+      } else {
+        toast.error("Errore", { description: "Impossibile caricare la consultazione" });
+      }
+    } catch (error) {
+      toast.error("Errore di connessione");
+    } finally {
+      setDetailLoading(false);
+    }
+  };
+
+  const searchHistory = async (page = 1) => {
+    if (!searchQuery.trim() && !searchType) {
+      clearSearch();
+      return;
+    }
+    setSearching(true);
+    try {
+      const params = new URLSearchParams({ page: String(page) });
+      if (searchQuery.trim()) params.set("q", searchQuery.trim());
+      if (searchType) params.set("type", searchType);
+      const response = await fetch(`${API}/chat/history/search?${params}`, {
+        headers: { Authorization: `Bearer ${token}` }
+      });
+      if (response.ok) {
+        const data = await response.json();
+        setSearchResults(prev => page > 1 && prev ? [...prev, ...data.items] : data.items);
+        setSearchPage(data.page);
+        setSearchHasMore(data.has_more);
+      } else {
+        const data = await response.json().catch(() => ({}));
+        toast.error("Errore", { description: data.detail || "Ricerca non riuscita" });
+      }
+    } catch (error) {
+      toast.error("Errore di connessione");
+    } finally {
+      setSearching(false);
+    }
+  };
+
+  const clearSearch = () => {
+    setSearchQuery("");
+    setSearchType("");
+    setSearchResults(null);
+    setSearchHasMore(false);
+  };
+
+  // Evidenzia i termini trovati (ranges = [inizio, fine) nello snippet)
+  const renderSnippet = (highlight) => {
+    const parts = [];
+    let last = 0;
+    highlight.ranges.forEach(([start, end], idx) => {
+      if (start > last) parts.push(highlight.snippet.slice(last, start));
+      parts.push(<mark key={idx} className="bg-gold/30 text-parchment rounded-sm">{highlight.snippet.slice(start, end)}</mark>);
+      last = end;
+    });
+    parts.push(highlight.snippet.slice(last));
+    return parts;
+  };
+
   const formatDate = (dateString) => {
     const date = new Date(dateString);
     return date.toLocaleDateString("it-IT", {
@@ -94,10 +194,99 @@ export default function Archive({ user, token, onLogout }) {
                 <h2 className="font-cinzel text-gold uppercase tracking-widest text-sm">
                   {settings.archive_title || "Le Tue Consultazioni"}
                 </h2>
+                <form
+                  onSubmit={(e) => { e.preventDefault(); searchHistory(1); }}
+                  className="flex gap-2 mt-3"
+                  data-testid="archive-search"
+                >
+                  <Input
+                    value={searchQuery}
+                    onChange={(e) => setSearchQuery(e.target.value)}
+                    placeholder="Cerca nell'archivio..."
+                    className="bg-black/50 border-gray-700 text-parchment text-sm h-9"
+                    data-testid="archive-search-input"
+                  />
+                  <select
+                    value={searchType}
+                    onChange={(e) => setSearchType(e.target.value)}
+                    className="bg-black/50 border border-gray-700 rounded-md text-parchment text-sm px-2 h-9"
+                    data-testid="archive-search-type"
+                  >
+                    <option value="">Tutto</option>
+                    <option value="chat">Domande</option>
+                    <option value="challenge">Prove</option>
+                    <option value="aid">Aiuti</option>
+                  </select>
+                  <Button type="submit" size="sm" variant="ghost" className="text-gold hover:bg-gold/10 h-9 px-2" disabled={searching}>
+                    {searching ? <Loader2 className="w-4 h-4 animate-spin" /> : <Search className="w-4 h-4" />}
+                  </Button>
+                  {searchResults !== null && (
+                    <Button type="button" size="sm" variant="ghost" className="text-muted-foreground hover:bg-gold/10 h-9 px-2" onClick={clearSearch}>
+                      <X className="w-4 h-4" />
+                    </Button>
+                  )}
+                </form>
               </div>
               
               <ScrollArea className="h-[calc(100vh-280px)]">
-                {loading ? (
+                {searchResults !== null ? (
+                  searchResults.length === 0 ? (
+                    <div className="text-center py-12 px-4">
+                      <Search className="w-12 h-12 text-muted-foreground/30 mx-auto mb-4" />
+                      <p className="font-cinzel text-muted-foreground">
+                        Nessun risultato
+                      </p>
+                    </div>
+                  ) : (
+                    <div className="divide-y divide-border/30">
+                      {searchResults.map((item) => (
+                        <button
+                          key={item.id}
+                          onClick={() => selectChat(item)}
+                          className={`w-full text-left p-4 hover:bg-gold/5 transition-colors ${
+                            selectedId === item.id ? "bg-gold/10 border-l-2 border-gold" : ""
+                          }`}
+                          data-testid={`archive-result-${item.id}`}
+                        >
+                          <div className="flex items-center gap-2 mb-2">
+                            {item.type === "challenge" ? (
+                              <Swords className="w-4 h-4 text-gold flex-shrink-0" />
+                            ) : item.type === "aid" ? (
+                              <Sparkles className="w-4 h-4 text-gold flex-shrink-0" />
+                            ) : (
+                              <MessageSquare className="w-4 h-4 text-muted-foreground flex-shrink-0" />
+                            )}
+                            <p className="font-body text-parchment line-clamp-2">
+                              {item.question}
+                            </p>
+                          </div>
+                          {item.highlights.filter(h => h.field === "answer").map((h) => (
+                            <p key={h.field} className="font-body text-muted-foreground text-sm mb-2 line-clamp-3">
+                              {renderSnippet(h)}
+                            </p>
+                          ))}
+                          <div className="flex items-center gap-2 text-muted-foreground text-xs">
+                            <Calendar className="w-3 h-3" />
+                            <span className="font-body">{formatDate(item.created_at)}</span>
+                          </div>
+                        </button>
+                      ))}
+                      {searchHasMore && (
+                        <div className="p-4 text-center">
+                          <Button
+                            variant="ghost"
+                            size="sm"
+                            onClick={() => searchHistory(searchPage + 1)}
+                            disabled={searching}
+                            className="text-gold hover:bg-gold/10 font-cinzel"
+                          >
+                            {searching ? <Loader2 className="w-4 h-4 animate-spin" /> : "Altri risultati"}
+                          </Button>
+                        </div>
+                      )}
+                    </div>
+                  )
+                ) : loading ? (
                   <div className="flex items-center justify-center py-12">
                     <Loader2 className="w-8 h-8 animate-spin text-gold" />
                   </div>
@@ -116,9 +305,9 @@ export default function Archive({ user, token, onLogout }) {
                     {history.map((item) => (
                       <button
                         key={item.id}
-                        onClick={() => setSelectedChat(item)}
+                        onClick={() => selectChat(item)}
                         className={`w-full text-left p-4 hover:bg-gold/5 transition-colors ${
-                          selectedChat?.id === item.id ? "bg-gold/10 border-l-2 border-gold" : ""
+                          selectedId === item.id ? "bg-gold/10 border-l-2 border-gold" : ""
                         }`}
                         data-testid={`archive-item-${item.id}`}
                       >
@@ -155,6 +344,20 @@ export default function Archive({ user, token, onLogout }) {
                         </div>
                       </button>
                     ))}
+                    {nextCursor && (
+                      <div className="p-4 text-center">
+                        <Button
+                          variant="ghost"
+                          size="sm"
+                          onClick={() => fetchHistory(nextCursor)}
+                          disabled={loadingMore}
+                          className="text-gold hover:bg-gold/10 font-cinzel"
+                          data-testid="archive-load-more"
+                        >
+                          {loadingMore ? <Loader2 className="w-4 h-4 animate-spin" /> : "Carica altre"}
+                        </Button>
+                      </div>
+                    )}
                   </div>
                 )}
               </ScrollArea>
@@ -320,6 +523,10 @@ export default function Archive({ user, token, onLogout }) {
                     </div>
                   </div>
                 </ScrollArea>
+              ) : detailLoading ? (
+                <div className="h-full flex items-center justify-center p-8">
+                  <Loader2 className="w-8 h-8 animate-spin text-gold" />
+                </div>
               ) : (
                 <div className="h-full flex flex-col items-center justify-center text-center p-8">
                   <BookOpen className="w-16 h-16 text-muted-foreground/20 mb-4" />
@@ -19,6 +19,8 @@ import {
 import ChallengeModal from "@/components/ChallengeModal";
 import AidsModal from "@/components/AidsModal";
 import { useSettings } from "@/context/SettingsContext";
+import { streamChat } from "@/lib/chatStream";
+import { subscribeAidEvents } from "@/lib/aidEvents";
 
 const API = `${process.env.REACT_APP_BACKEND_URL}/api`;
 
@@ -27,33 +29,33 @@ export default function Dashboard({ user, token, onLogout, refreshUser }) {
   const [question, setQuestion] = useState("");
   const [messages, setMessages] = useState([]);
   const [loading, setLoading] = useState(false);
-  const [challenges, setChallenges] = useState([]);
-  const [attemptedChallenges, setAttemptedChallenges] = useState([]);
+  const [streaming, setStreaming] = useState(false);
   const [activeChallenge, setActiveChallenge] = useState(null);
   const [showAidsModal, setShowAidsModal] = useState(false);
+  const [activeAids, setActiveAids] = useState(null);
+  const [usedAids, setUsedAids] = useState([]);
   const [remainingActions, setRemainingActions] = useState(user ? user.max_actions - user.used_actions : 0);
   const [effectiveMaxActions, setEffectiveMaxActions] = useState(user?.max_actions || 0);
   const scrollRef = useRef(null);
 
-  useEffect(() => {
-    fetchChallenges();
-    fetchAttemptedChallenges();
-  }, []);
-
-  // Aggiorna il conteggio azioni tenendo conto dei SEGUACI
+  // Stato del PG in una richiesta: azioni (con i SEGUACI), aiuti usati e attivi.
+  // Si ripete a ogni refreshUser; se non è cambiato nulla il server risponde 304.
   useEffect(() => {
     if (!user) return;
 
-    const fetchFollowerStatus = async () => {
+    const fetchPlayerState = async () => {
       try {
-        const response = await fetch(`${API}/followers/status`, {
+        const response = await fetch(`${API}/player/state`, {
           headers: { Authorization: `Bearer ${token}` }
         });
         if (response.ok) {
           const data = await response.json();
-          const effMax = data.remaining_actions_before + user.used_actions;
-          setRemainingActions(data.remaining_actions_before);
-          setEffectiveMaxActions(effMax);
+          const remaining = data.followers.remaining_actions_before;
+          setRemainingActions(remaining);
+          setEffectiveMaxActions(remaining + data.user.used_actions);
+          setUsedAids(data.used_aids);
+          // Lo stream /aids/events, se già connesso, ha dati più recenti
+          setActiveAids(prev => prev ?? data.active_aids);
         } else {
           const baseRemaining = user.max_actions - user.used_actions;
           setRemainingActions(baseRemaining);
@@ -66,63 +68,18 @@ export default function Dashboard({ user, token, onLogout, refreshUser }) {
       }
     };
 
-    fetchFollowerStatus();
+    fetchPlayerState();
   }, [user, token]);
 
+  // Focalizzazioni attive aggiornate dal server all'apertura/chiusura delle finestre
+  useEffect(() => subscribeAidEvents(API, token, setActiveAids), [token]);
+
   useEffect(() => {
     if (scrollRef.current) {
       scrollRef.current.scrollTop = scrollRef.current.scrollHeight;
     }
   }, [messages]);
 
-  const fetchChallenges = async () => {
-    try {
-      const response = await fetch(`${API}/challenges`, {
-        headers: { Authorization: `Bearer ${token}` }
-      });
-      if (response.ok) {
-        setChallenges(await response.json());
-      }
-    } catch (error) {
-      console.error("Error fetching challenges:", error);
-    }
-  };
-
-  const fetchAttemptedChallenges = async () => {
-    try {
-      const response = await fetch(`${API}/challenges/my-attempts`, {
-        headers: { Authorization: `Bearer ${token}` }
-      });
-      if (response.ok) {
-        setAttemptedChallenges(await response.json());
-      }
-    } catch (error) {
-      console.error("Error fetching attempted challenges:", error);
-    }
-  };
-
-  // Cerca prove che corrispondono alla domanda (escluse quelle già tentate)
-  const findMatchingChallenge = (text) => {
-    const textLower = text.toLowerCase();
-    for (const challenge of challenges) {
-      // Salta se già tentata
-      if (attemptedChallenges.includes(challenge.id)) {
-        continue;
-      }
-      // Cerca nelle keywords
-      for (const kw of challenge.keywords || []) {
-        if (textLower.includes(kw.toLowerCase())) {
-          return challenge;
-        }
-      }
-      // Cerca nel nome
-      if (textLower.includes(challenge.name.toLowerCase())) {
-        return challenge;
-      }
-    }
-    return null;
-  };
-
   const handleSubmit = async (e) => {
     e.preventDefault();
     if (!question.trim() || loading) return;
@@ -132,53 +89,42 @@ export default function Dashboard({ user, token, onLogout, refreshUser }) {
       return;
     }
 
-    // Controlla se la domanda corrisponde a una prova
-    const matchedChallenge = findMatchingChallenge(question);
-    if (matchedChallenge) {
-      const userMessage = { type: "user", text: question, timestamp: new Date().toISOString() };
-      setMessages(prev => [...prev, userMessage]);
-      
-      // Mostra la prova trovata
-      const challengeMessage = { 
-        type: "challenge", 
-        challenge: matchedChallenge,
-        timestamp: new Date().toISOString() 
-      };
-      setMessages(prev => [...prev, challengeMessage]);
-      setQuestion("");
-      return;
-    }
-
     const userMessage = { type: "user", text: question, timestamp: new Date().toISOString() };
     setMessages(prev => [...prev, userMessage]);
     setQuestion("");
     setLoading(true);
 
+    let streamed = false;
     try {
-      const response = await fetch(`${API}/chat`, {
-        method: "POST",
-        headers: {
-          "Content-Type": "application/json",
-          Authorization: `Bearer ${token}`
-        },
-        body: JSON.stringify({ question: userMessage.text })
-      });
-
-      const data = await response.json();
-
-      if (response.ok) {
-        const aiMessage = { type: "ai", text: data.answer, timestamp: data.created_at };
-        setMessages(prev => [...prev, aiMessage]);
-        refreshUser();
-      } else {
-        toast.error("Errore", { description: data.detail || "Errore nella richiesta" });
-        setMessages(prev => prev.slice(0, -1));
+      // Il server riconosce le prove richiamate dalla domanda (escluse quelle già tentate)
+      const data = await streamChat(API, token, userMessage.text, (text) => {
+        if (!streamed) {
+          streamed = true;
+          setStreaming(true);
+          setMessages(prev => [...prev, { type: "ai", text, timestamp: new Date().toISOString() }]);
+        } else {
+          setMessages(prev => [...prev.slice(0, -1), { ...prev[prev.length - 1], text: prev[prev.length - 1].text + text }]);
+        }
+      }, { triggerChallenges: true });
+      if (data.triggered_challenge) {
+        // Mostra la prova trovata: nessuna azione scalata
+        setMessages(prev => [...prev, { type: "challenge", challenge: data.triggered_challenge, timestamp: new Date().toISOString() }]);
+        return;
+      }
+      if (!streamed) {
+        setMessages(prev => [...prev, { type: "ai", text: data.answer, timestamp: data.created_at }]);
+      }
+      if (data.suggested_challenges?.length) {
+        setMessages(prev => [...prev, { type: "challenge-suggestions", challenges: data.suggested_challenges, timestamp: data.created_at }]);
       }
+      refreshUser();
     } catch (error) {
-      toast.error("Errore di connessione", { description: "Impossibile contattare il server" });
-      setMessages(prev => prev.slice(0, -1));
+      toast.error("Errore", { description: error.message || "Impossibile contattare il server" });
+      // Rimuove la domanda (e l'eventuale risposta parziale) non andata a buon fine
+      setMessages(prev => prev.slice(0, streamed ? -2 : -1));
     } finally {
       setLoading(false);
+      setStreaming(false);
     }
   };
 
@@ -194,10 +140,6 @@ export default function Dashboard({ user, token, onLogout, refreshUser }) {
       timestamp: new Date().toISOString()
     };
     setMessages(prev => [...prev, resultMessage]);
-    // Aggiorna la lista delle prove tentate
-    if (activeChallenge) {
-      setAttemptedChallenges(prev => [...prev, activeChallenge.id]);
-    }
     refreshUser();
   };
 
@@ -398,6 +340,32 @@ export default function Dashboard({ user, token, onLogout, refreshUser }) {
                       </div>
                     )}
 
+                    {/* Prove suggerite dalla domanda */}
+                    {msg.type === "challenge-suggestions" && (
+                      <div className="flex justify-start">
+                        <div className="max-w-[90%] p-3 rounded-sm bg-secondary/20 border border-gold/20">
+                          <p className="font-cinzel text-xs text-gold uppercase tracking-wide mb-2">
+                            Prove collegate
+                          </p>
+                          <div className="flex flex-wrap gap-2">
+                            {msg.challenges.map((challenge) => (
+                              <Button
+                                key={challenge.id}
+                                variant="outline"
+                                size="sm"
+                                onClick={() => setMessages(prev => [...prev, { type: "challenge", challenge, timestamp: new Date().toISOString() }])}
+                                className="border-gold/30 text-parchment rounded-sm font-cinzel"
+                                data-testid="suggested-challenge-btn"
+                              >
+                                <Swords className="w-3 h-3 mr-2 text-gold" />
+                                {challenge.name}
+                              </Button>
+                            ))}
+                          </div>
+                        </div>
+                      </div>
+                    )}
+
                     {/* Risultato prova */}
                     {msg.type === "challenge-result" && (
                       <div className="flex justify-start">
@@ -450,7 +418,7 @@ export default function Dashboard({ user, token, onLogout, refreshUser }) {
                     )}
                   </div>
                 ))}
-                {loading && (
+                {loading && !streaming && (
                   <div className="flex justify-start fade-in">
                     <div className="chat-message-ai text-parchment p-4 rounded-sm">
                       <p className="font-cinzel text-xs mb-2 opacity-70 uppercase tracking-wide">
@@ -522,6 +490,9 @@ export default function Dashboard({ user, token, onLogout, refreshUser }) {
       {showAidsModal && (
         <AidsModal
           token={token}
+          aids={activeAids}
+          usedAids={usedAids}
+          onAidUsed={(aidId, level) => setUsedAids(prev => [...prev, { aid_id: aidId, level }])}
           onClose={() => setShowAidsModal(false)}
           onResult={handleAidResult}
           refreshUser={refreshUser}
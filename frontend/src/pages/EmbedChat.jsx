@@ -7,6 +7,7 @@ import { ScrollArea } from "@/components/ui/scroll-area";
 import { toast } from "sonner";
 import { Send, Loader2, MessageSquare, LogIn, Shield } from "lucide-react";
 import { useSettings } from "@/context/SettingsContext";
+import { streamChat } from "@/lib/chatStream";
 
 const API = `${process.env.REACT_APP_BACKEND_URL}/api`;
 
@@ -20,6 +21,7 @@ export default function EmbedChat() {
   const [messages, setMessages] = useState([]);
   const [question, setQuestion] = useState("");
   const [loading, setLoading] = useState(false);
+  const [streaming, setStreaming] = useState(false);
   const [authLoading, setAuthLoading] = useState(true);
   
   // Auth form
@@ -111,29 +113,27 @@ export default function EmbedChat() {
     setQuestion("");
     setLoading(true);
 
+    let streamed = false;
     try {
-      const response = await fetch(`${API}/chat`, {
-        method: "POST",
-        headers: {
-          "Content-Type": "application/json",
-          Authorization: `Bearer ${token}`
-        },
-        body: JSON.stringify({ question: userMessage.text })
+      const data = await streamChat(API, token, userMessage.text, (text) => {
+        if (!streamed) {
+          streamed = true;
+          setStreaming(true);
+          setMessages(prev => [...prev, { type: "ai", text }]);
+        } else {
+          setMessages(prev => [...prev.slice(0, -1), { ...prev[prev.length - 1], text: prev[prev.length - 1].text + text }]);
+        }
       });
-
-      const data = await response.json();
-      if (response.ok) {
+      if (!streamed) {
         setMessages(prev => [...prev, { type: "ai", text: data.answer }]);
-        setUser(prev => ({ ...prev, used_actions: prev.used_actions + 1 }));
-      } else {
-        toast.error(data.detail || "Errore");
-        setMessages(prev => prev.slice(0, -1));
       }
+      setUser(prev => ({ ...prev, used_actions: prev.used_actions + 1 }));
     } catch (error) {
-      toast.error("Errore di connessione");
-      setMessages(prev => prev.slice(0, -1));
+      toast.error(error.message || "Errore di connessione");
+      setMessages(prev => prev.slice(0, streamed ? -2 : -1));
     } finally {
       setLoading(false);
+      setStreaming(false);
     }
   };
 
@@ -296,7 +296,7 @@ export default function EmbedChat() {
                 </div>
               </div>
             ))}
-            {loading && (
+            {loading && !streaming && (
               <div className="flex justify-start">
                 <div className="p-3 rounded text-sm" style={{ backgroundColor: "#1a1a1a" }}>
                   <Loader2 className="w-4 h-4 animate-spin" style={{ color: settings.accent_color }} />
@@ -0,0 +1,35 @@
+import os
+import sys
+from pathlib import Path
+
+import mongomock.collection
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+# server.py legge la configurazione all'import; il client Motor non si connette finché non serve
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "archivio_test")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+
+@pytest.fixture
+def mock_db(monkeypatch):
+    """server.db su un MongoDB in memoria, con le cache di versione azzerate"""
+    import server
+
+    # mongomock rilegge il documento aggiornato con il filtro originale se la projection esclude _id:
+    # un filtro che l'aggiornamento rende falso ($expr di reserve_action) darebbe None, MongoDB no
+    find_and_modify = mongomock.collection.Collection._find_and_modify
+
+    def find_and_modify_by_id(self, query, projection=None, *args, **kwargs):
+        doc = find_and_modify(self, query, None, *args, **kwargs)
+        if doc is None or not projection:
+            return doc
+        return self._copy_only_fields(doc, projection, dict)
+
+    monkeypatch.setattr(mongomock.collection.Collection, "_find_and_modify", find_and_modify_by_id)
+    database = AsyncMongoMockClient()["archivio_test"]
+    monkeypatch.setattr(server, "db", database)
+    monkeypatch.setattr(server, "_collection_versions", {})
+    return database
@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+def user_doc(user_id, **fields):
+    return {"id": user_id, "username": user_id, "max_actions": 20, "used_actions": 0, **fields}
+
+
+async def reserve_many(user_id, count):
+    """count prenotazioni contemporanee: ritorna (riuscite, rifiutate con 403)"""
+    results = await asyncio.gather(*(server.reserve_action(user_id) for _ in range(count)), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception) and not (isinstance(result, HTTPException) and result.status_code == 403):
+            raise result
+    refused = sum(isinstance(result, HTTPException) for result in results)
+    return count - refused, refused
+
+
+def test_concurrent_reservations_stop_at_the_effective_limit(mock_db):
+    async def scenario():
+        await mock_db.users.insert_one(user_doc("pg-1", used_actions=1, effective_max_actions=4))
+        outcome = await reserve_many("pg-1", 6)
+        return outcome, await mock_db.users.find_one({"id": "pg-1"})
+
+    (reserved, refused), user = asyncio.run(scenario())
+    assert (reserved, refused) == (3, 3)
+    assert user["used_actions"] == 4
+
+
+def test_exhausted_user_is_refused_without_changes(mock_db):
+    async def scenario():
+        await mock_db.users.insert_one(user_doc("pg-1", used_actions=5, effective_max_actions=5))
+        with pytest.raises(HTTPException) as exc:
+            await server.reserve_action("pg-1")
+        return exc.value, await mock_db.users.find_one({"id": "pg-1"})
+
+    error, user = asyncio.run(scenario())
+    assert error.status_code == 403
+    assert user["used_actions"] == 5
+
+
+def test_refund_frees_one_action_and_never_goes_negative(mock_db):
+    async def scenario():
+        await mock_db.users.insert_one(user_doc("pg-1", used_actions=2, effective_max_actions=2))
+        with pytest.raises(HTTPException):
+            await server.reserve_action("pg-1")
+        await server.refund_action("pg-1")
+        await server.reserve_action("pg-1")
+        for _ in range(4):
+            await server.refund_action("pg-1")
+        return await mock_db.users.find_one({"id": "pg-1"})
+
+    assert asyncio.run(scenario())["used_actions"] == 0
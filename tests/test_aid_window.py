@@ -0,0 +1,66 @@
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+
+import pytest
+
+import server
+
+# Europe/Rome nel 2026: ora legale dal 29 marzo (02:00 -> 03:00), solare dal 25 ottobre (03:00 -> 02:00)
+SPRING_FORWARD = "2026-03-29"
+FALL_BACK = "2026-10-25"
+
+
+@pytest.fixture(autouse=True)
+def rome(monkeypatch):
+    monkeypatch.setattr(server, "EVENT_TIMEZONE", ZoneInfo("Europe/Rome"))
+
+
+def utc(value):
+    return datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+
+
+@pytest.mark.parametrize("start_time, end_time, starts_at, ends_at", [
+    # Finestra che contiene il salto: due ore reali
+    ("01:00", "04:00", "2026-03-29T00:00", "2026-03-29T02:00"),
+    # Confini del salto: 01:59 esiste ancora, 03:00 è il primo orario dopo
+    ("01:59", "03:00", "2026-03-29T00:59", "2026-03-29T01:00"),
+    # Orari nel salto: diventano l'istante del salto, le 03:00
+    ("02:30", "04:00", "2026-03-29T01:00", "2026-03-29T02:00"),
+    ("01:00", "02:30", "2026-03-29T00:00", "2026-03-29T01:00"),
+    ("02:00", "02:59", "2026-03-29T01:00", "2026-03-29T01:00"),
+    # Con le 02:50 spostate di un'ora (03:50) la finestra si invertirebbe
+    ("02:50", "03:10", "2026-03-29T01:00", "2026-03-29T01:10"),
+])
+def test_spring_forward(start_time, end_time, starts_at, ends_at):
+    window = server.aid_window(SPRING_FORWARD, start_time, end_time)
+
+    assert window == (utc(starts_at), utc(ends_at))
+
+
+@pytest.mark.parametrize("start_time, end_time, starts_at, ends_at", [
+    # Finestra che contiene il ritorno all'ora solare: quattro ore reali
+    ("01:00", "04:00", "2026-10-24T23:00", "2026-10-25T03:00"),
+    # Orari ripetuti: dalla prima occorrenza (ora legale) alla seconda (ora solare)
+    ("02:00", "02:30", "2026-10-25T00:00", "2026-10-25T01:30"),
+    ("02:59", "03:00", "2026-10-25T00:59", "2026-10-25T02:00"),
+    # Fine prima dell'inizio: il giorno dopo, già in ora solare
+    ("02:30", "02:10", "2026-10-25T00:30", "2026-10-26T01:10"),
+])
+def test_fall_back(start_time, end_time, starts_at, ends_at):
+    window = server.aid_window(FALL_BACK, start_time, end_time)
+
+    assert window == (utc(starts_at), utc(ends_at))
+
+
+def test_ordinary_days_keep_their_offset():
+    assert server.aid_window("2026-03-28", "02:30", "02:30") == (utc("2026-03-28T01:30"),) * 2
+    assert server.aid_window("2026-10-26", "02:30", "02:30") == (utc("2026-10-26T01:30"),) * 2
+
+
+def test_window_spanning_the_gap_is_active_after_the_jump():
+    aid = {"event_date": SPRING_FORWARD, "start_time": "02:30", "end_time": "03:30"}
+
+    assert not server.aid_is_active(aid, utc("2026-03-29T00:59"))
+    assert server.aid_is_active(aid, utc("2026-03-29T01:00"))
+    assert server.aid_is_active(aid, utc("2026-03-29T01:30"))
+    assert not server.aid_is_active(aid, utc("2026-03-29T01:31"))
@@ -0,0 +1,35 @@
+import server
+
+SCOPE = (3, frozenset({"kb-1"}))
+QUESTION = "Il principe della città è ancora alleato dei Nosferatu?"
+COUNT_QUESTION = "Quanti ghoul servono il principe nel 1998?"
+
+
+def fuzzy_cache():
+    cache = server.AnswerCache(max_entries=16, ttl_seconds=60, similarity=0.9)
+    cache.put(QUESTION, SCOPE, "Sì, è alleato.")
+    cache.put(COUNT_QUESTION, SCOPE, "Tre.")
+    return cache
+
+
+def test_default_cache_only_reuses_identical_questions():
+    cache = server.AnswerCache(16, 60, server.ANSWER_CACHE_SIMILARITY)
+    cache.put(QUESTION, SCOPE, "Sì, è alleato.")
+    assert cache.get("il principe della citta e ancora alleato dei nosferatu", SCOPE) == "Sì, è alleato."
+    assert cache.get("E il principe della città è ancora alleato dei Nosferatu?", SCOPE) is None
+
+
+def test_negated_and_changed_questions_miss_the_cache():
+    cache = fuzzy_cache()
+    # Trigrammi sopra la soglia (0.91), ma le parole di contenuto sono diverse
+    assert cache.get("Il principe della città non è ancora alleato dei Nosferatu?", SCOPE) is None
+    assert cache.get("Quanti ghoul servono il principe nel 1999?", SCOPE) is None
+    assert cache.get("Il principe della città è ancora alleato dei Nosferatu, oggi?", SCOPE) is None
+    assert (cache.hits, cache.misses) == (0, 3)
+
+
+def test_near_identical_question_reuses_the_answer():
+    cache = fuzzy_cache()
+    # Cambia solo una stopword
+    assert cache.get("E il principe della città è ancora alleato dei Nosferatu?", SCOPE) == "Sì, è alleato."
+    assert cache.get("E il principe della città è ancora alleato dei Nosferatu?", (4, SCOPE[1])) is None
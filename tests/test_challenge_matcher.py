@@ -0,0 +1,119 @@
+import asyncio
+import random
+import threading
+
+import pytest
+
+import server
+from server import ChallengeMatcher
+
+# Alfabeto piccolo: le sottostringhe casuali si sovrappongono spesso tra query e testi
+ALPHABET = "abc "
+
+
+def random_text(rng, max_len):
+    return "".join(rng.choice(ALPHABET) for _ in range(rng.randint(0, max_len)))
+
+
+def random_challenges(rng, count):
+    return [
+        {
+            "id": f"prova-{i}",
+            "name": random_text(rng, 6).upper() if rng.random() < 0.2 else random_text(rng, 6),
+            "description": random_text(rng, 20),
+            "keywords": [random_text(rng, 4) for _ in range(rng.randint(0, 3))],
+        }
+        for i in range(count)
+    ]
+
+
+def substring_search(challenges, q):
+    """Il confronto per sottostringhe che /challenges/search usava prima di ChallengeMatcher"""
+    q_lower = q.lower()
+    matches = []
+    for c in challenges:
+        for kw in c.get("keywords", []):
+            if kw in q_lower or q_lower in kw:
+                matches.append(c)
+                break
+        else:
+            if q_lower in c["name"].lower() or q_lower in c["description"].lower():
+                matches.append(c)
+    return matches
+
+
+def dashboard_matches(challenges, question):
+    """La regola della Dashboard, senza keyword e nomi vuoti che prima scattavano sempre"""
+    question = question.lower()
+    return [
+        idx for idx, c in enumerate(challenges)
+        if any(kw and kw in question for kw in c.get("keywords", []))
+        or (c["name"] and c["name"].lower() in question)
+    ]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_search_matches_the_substring_loop(seed):
+    rng = random.Random(seed)
+    challenges = random_challenges(rng, 15)
+    matcher = ChallengeMatcher(1, challenges)
+    for _ in range(50):
+        q = random_text(rng, 8)
+        if rng.random() < 0.2:
+            q = q.upper()
+        assert matcher.search(q) == substring_search(challenges, q), q
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_certain_question_matches_follow_the_dashboard_rule(seed):
+    rng = random.Random(seed)
+    challenges = random_challenges(rng, 15)
+    matcher = ChallengeMatcher(1, challenges)
+    for _ in range(50):
+        question = random_text(rng, 12)
+        certain, _ = matcher.question_matches(question)
+        assert certain == dashboard_matches(challenges, question), question
+
+
+def test_empty_keywords_and_names_no_longer_trigger_from_chat():
+    challenges = [
+        {"id": "vuota", "name": "", "description": "Senza nome", "keywords": [""]},
+        {"id": "porta", "name": "La Porta", "description": "Aprire la porta", "keywords": ["aprire la porta"]},
+    ]
+    matcher = ChallengeMatcher(1, challenges)
+
+    assert matcher.question_matches("Come posso aprire la porta?") == ([1], [])
+    assert matcher.question_matches("Che ore sono?") == ([], [])
+    # Nella ricerca la keyword vuota resta contenuta in ogni query, come nel confronto originale
+    assert [c["id"] for c in matcher.search("orologio")] == ["vuota"]
+
+
+def test_inflected_keywords_are_only_likely_matches():
+    challenges = [
+        {"id": "porta", "name": "Il Varco", "description": "", "keywords": ["aprire la porta"]},
+        {"id": "sangue", "name": "Il Calice", "description": "", "keywords": ["sangue"]},
+    ]
+    matcher = ChallengeMatcher(1, challenges)
+
+    assert matcher.question_matches("Apro le porte della cripta") == ([], [0])
+    assert matcher.question_matches("Apro le porte e verso il sangue") == ([1], [0])
+    assert matcher.question_matches("Apro la finestra") == ([], [])
+
+
+def test_matcher_is_built_off_the_event_loop(mock_db, monkeypatch):
+    built_in = []
+
+    def recording_matcher(version, challenges):
+        built_in.append(threading.current_thread())
+        return ChallengeMatcher(version, challenges)
+
+    monkeypatch.setattr(server, "ChallengeMatcher", recording_matcher)
+    monkeypatch.setattr(server, "_challenge_matcher", None)
+    asyncio.run(mock_db.challenges.insert_one(
+        {"id": "porta", "name": "La Porta", "description": "", "keywords": ["porta"]}
+    ))
+
+    matcher = asyncio.run(server.get_challenge_matcher())
+
+    assert [c["id"] for c in matcher.search("porta")] == ["porta"]
+    assert built_in and built_in[0] is not threading.main_thread()
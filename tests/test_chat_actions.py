@@ -0,0 +1,218 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import server
+
+USER = {"id": "pg-1", "used_actions": 0, "effective_max_actions": 20}
+
+
+@pytest.fixture
+def ledger(monkeypatch):
+    """Sostituisce prenotazione e restituzione delle azioni con un contatore"""
+    state = {"reserved": 0, "refunded": 0}
+
+    async def reserve_action(user_id):
+        state["reserved"] += 1
+        return {**USER, "used_actions": USER["used_actions"] + 1}
+
+    async def refund_action(user_id):
+        state["refunded"] += 1
+
+    monkeypatch.setattr(server, "reserve_action", reserve_action)
+    monkeypatch.setattr(server, "refund_action", refund_action)
+    monkeypatch.setattr(server.answer_cache, "get", lambda question, scope: None)
+    monkeypatch.setattr(server, "build_oracle_prompt", lambda *args: SimpleNamespace(
+        prefix="persona", question="domanda", context="", total_tokens=10, context_chunks=0, dropped_chunks=0
+    ))
+    return state
+
+
+def fake_scope(monkeypatch):
+    snapshot = SimpleNamespace(version=1, prefix_hash="h")
+
+    async def get_oracle_scope(user):
+        return snapshot, frozenset()
+
+    monkeypatch.setattr(server, "get_oracle_scope", get_oracle_scope)
+
+
+def test_chat_does_not_reserve_when_the_scope_fails(ledger, monkeypatch):
+    async def broken_scope(user):
+        raise RuntimeError("MongoDB non raggiungibile")
+
+    monkeypatch.setattr(server, "get_oracle_scope", broken_scope)
+    request = server.ChatRequest(question="Chi governa la città?")
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(server.send_chat(request, USER))
+    with pytest.raises(RuntimeError):
+        asyncio.run(server.send_chat_stream(request, USER))
+    assert ledger == {"reserved": 0, "refunded": 0}
+
+
+def test_chat_refunds_when_saving_fails(ledger, monkeypatch):
+    fake_scope(monkeypatch)
+
+    async def answer(*args, **kwargs):
+        return "La Principessa."
+
+    async def broken_save(*args):
+        raise RuntimeError("scrittura fallita")
+
+    monkeypatch.setattr(server.llm_dispatcher, "call", answer)
+    monkeypatch.setattr(server, "save_chat_answer", broken_save)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(server.send_chat(server.ChatRequest(question="Chi governa la città?"), USER))
+    assert ledger == {"reserved": 1, "refunded": 1}
+
+
+def test_stream_refunds_when_the_client_leaves_before_the_first_chunk(ledger, monkeypatch):
+    fake_scope(monkeypatch)
+
+    async def scenario():
+        response = await server.send_chat_stream(server.ChatRequest(question="Chi governa la città?"), USER)
+        # Il generatore non parte mai: resta solo il background task della risposta
+        await response.background()
+
+    asyncio.run(scenario())
+    assert ledger == {"reserved": 1, "refunded": 1}
+
+
+def test_stream_refunds_once_when_the_model_fails(ledger, monkeypatch):
+    fake_scope(monkeypatch)
+
+    async def failing_stream(user_id, make_stream):
+        raise RuntimeError("modello non disponibile")
+        yield
+
+    monkeypatch.setattr(server.llm_dispatcher, "stream", failing_stream)
+
+    async def scenario():
+        response = await server.send_chat_stream(server.ChatRequest(question="Chi governa la città?"), USER)
+        events = [event async for event in response.body_iterator]
+        await response.background()
+        return events
+
+    events = asyncio.run(scenario())
+    assert events[-1].startswith("event: error")
+    assert ledger == {"reserved": 1, "refunded": 1}
+
+
+def test_completed_stream_keeps_the_action(ledger, monkeypatch):
+    fake_scope(monkeypatch)
+
+    async def answer_stream(user_id, make_stream):
+        yield "La "
+        yield "Principessa."
+
+    async def save(user, question, answer, llm_usage):
+        return {"id": "c1", "answer": answer, "created_at": "2026-01-01T00:00:00+00:00"}
+
+    monkeypatch.setattr(server.llm_dispatcher, "stream", answer_stream)
+    monkeypatch.setattr(server, "save_chat_answer", save)
+
+    async def scenario():
+        response = await server.send_chat_stream(server.ChatRequest(question="Chi governa la città?"), USER)
+        events = [event async for event in response.body_iterator]
+        await response.background()
+        return events
+
+    events = asyncio.run(scenario())
+    assert events[-1].startswith("event: done")
+    assert ledger == {"reserved": 1, "refunded": 0}
+
+
+@pytest.mark.parametrize("fragments, cached", [([], []), (["  ", "\n"], []), (["La ", "Principessa."], ["La Principessa."])])
+def test_only_non_empty_answers_are_cached(ledger, monkeypatch, fragments, cached):
+    fake_scope(monkeypatch)
+    puts = []
+
+    async def answer(*args, **kwargs):
+        return "".join(fragments)
+
+    async def answer_stream(user_id, make_stream):
+        for fragment in fragments:
+            yield fragment
+
+    async def save(user, question, answer, llm_usage):
+        return {"id": "c1", "answer": answer, "created_at": "2026-01-01T00:00:00+00:00"}
+
+    monkeypatch.setattr(server.answer_cache, "put", lambda question, scope, answer: puts.append(answer))
+    monkeypatch.setattr(server.llm_dispatcher, "call", answer)
+    monkeypatch.setattr(server.llm_dispatcher, "stream", answer_stream)
+    monkeypatch.setattr(server, "save_chat_answer", save)
+
+    async def scenario():
+        await server.send_chat(server.ChatRequest(question="Chi governa la città?"), USER)
+        response = await server.send_chat_stream(server.ChatRequest(question="Chi governa la città?"), USER)
+        [event async for event in response.body_iterator]
+
+    asyncio.run(scenario())
+    assert puts == cached * 2
+
+
+@pytest.fixture
+def catalog(mock_db):
+    now = datetime.now(timezone.utc)
+    asyncio.run(mock_db.challenges.insert_one({
+        "id": "porta", "name": "La Porta", "description": "", "keywords": [],
+        "tests": [{"attribute": "Forza", "difficulty": 2, "success_text": "Si apre.",
+                   "tie_text": "Cigola.", "failure_text": "Resta chiusa."}]
+    }))
+    asyncio.run(mock_db.aids.insert_one({
+        "id": "intuito", "name": "Intuito", "attribute": "Astuzia", "event_date": "2026-01-01",
+        "starts_at": now - timedelta(hours=1), "ends_at": now + timedelta(hours=1),
+        "levels": [{"level": 2, "level_name": "Sussurro", "text": "Qualcuno ti osserva."}]
+    }))
+    return mock_db
+
+
+def use_actions():
+    """Una prova e un aiuto, le due azioni che non passano dall'Oracolo"""
+    return [
+        lambda: server.attempt_challenge(server.ChallengeAttempt(challenge_id="porta", test_index=0, player_value=3), USER),
+        lambda: server.use_aid(server.UseAid(aid_id="intuito", level=2, player_attribute_value=3), USER),
+    ]
+
+
+def fail_inserts(monkeypatch, collection_db, name, error):
+    # mongomock_motor si presenta come AsyncIOMotorCollection: type() dà la classe vera
+    collection_class = type(collection_db[name])
+    original_insert_one = collection_class.insert_one
+
+    async def insert_one(self, *args, **kwargs):
+        if self.name == name:
+            raise error
+        return await original_insert_one(self, *args, **kwargs)
+
+    monkeypatch.setattr(collection_class, "insert_one", insert_one)
+
+
+@pytest.mark.parametrize("action", range(2))
+def test_challenges_and_aids_keep_the_action_when_saved(ledger, catalog, action):
+    asyncio.run(use_actions()[action]())
+
+    assert ledger == {"reserved": 1, "refunded": 0}
+
+
+@pytest.mark.parametrize("action", range(2))
+def test_challenges_and_aids_refund_when_the_archive_write_fails(ledger, catalog, monkeypatch, action):
+    fail_inserts(monkeypatch, catalog, "chat_history", RuntimeError("scrittura fallita"))
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(use_actions()[action]())
+    assert ledger == {"reserved": 1, "refunded": 1}
+
+
+@pytest.mark.parametrize("action, log", [(0, "challenge_attempts"), (1, "aid_uses")])
+def test_concurrent_duplicates_are_refunded_once(ledger, catalog, monkeypatch, action, log):
+    fail_inserts(monkeypatch, catalog, log, server.DuplicateKeyError("E11000"))
+
+    with pytest.raises(server.HTTPException) as exc:
+        asyncio.run(use_actions()[action]())
+    assert exc.value.status_code == 403
+    assert ledger == {"reserved": 1, "refunded": 1}
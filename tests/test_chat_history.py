@@ -0,0 +1,153 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import server
+
+USER = {"id": "pg-1"}
+
+
+@pytest.fixture
+def history(mock_db, monkeypatch):
+    """Archivio con voci che condividono created_at, per verificare lo spareggio sull'id"""
+    # mongomock non conosce $substrCP: l'anteprima viene salvata già pronta nelle voci
+    monkeypatch.setattr(server, "HISTORY_LIST_PROJECTION", {
+        "_id": 0, "id": 1, "question": 1, "created_at": 1, "type": 1, "answer_preview": 1
+    })
+    entries = [
+        {
+            "id": f"voce-{i:02d}",
+            "user_id": USER["id"],
+            "question": f"Domanda {i}",
+            "answer": f"Risposta {i}",
+            "answer_preview": f"Risposta {i}",
+            "created_at": f"2026-03-{1 + i // 3:02d}T20:00:00+00:00",
+            "type": "challenge" if i % 4 == 0 else "chat",
+        }
+        for i in range(10)
+    ]
+    entries.append({**entries[0], "id": "altro-pg", "user_id": "pg-2"})
+    asyncio.run(mock_db.chat_history.insert_many([dict(e) for e in entries]))
+    newest_first = sorted(entries[:10], key=lambda e: (e["created_at"], e["id"]), reverse=True)
+    return [e["id"] for e in newest_first]
+
+
+def fetch_pages(limit):
+    async def scenario():
+        pages, before = [], None
+        while True:
+            page = await server.get_chat_history(before=before, limit=limit, user=USER)
+            pages.append(page)
+            if page.next_cursor is None:
+                return pages
+            before = page.next_cursor
+    return asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("limit", [1, 3, 4, 10])
+def test_keyset_pages_cover_the_archive_once_in_order(history, limit):
+    pages = fetch_pages(limit)
+
+    assert [item.id for page in pages for item in page.items] == history
+    assert all(len(page.items) == limit for page in pages[:-1])
+    assert pages[-1].next_cursor is None
+
+
+def test_entries_with_the_same_created_at_are_split_by_id(history):
+    first = asyncio.run(server.get_chat_history(before=None, limit=2, user=USER))
+    # voce-09 è sola nel suo giorno, voce-08 divide created_at con voce-07 e voce-06
+    assert [item.id for item in first.items] == ["voce-09", "voce-08"]
+    assert first.next_cursor == "2026-03-03T20:00:00+00:00,voce-08"
+
+    second = asyncio.run(server.get_chat_history(before=first.next_cursor, limit=2, user=USER))
+    assert [item.id for item in second.items] == ["voce-07", "voce-06"]
+
+
+def test_cursor_is_the_last_entry_of_the_page():
+    entries = [
+        {"id": f"v{i}", "question": "d", "answer_preview": "r", "created_at": f"2026-01-0{i}T00:00:00+00:00"}
+        for i in (3, 2, 1)
+    ]
+    page = server.history_page(entries, 2)
+
+    assert [item.id for item in page.items] == ["v3", "v2"]
+    assert page.next_cursor == server.history_cursor(entries[1])
+    assert server.history_page(entries, 3).next_cursor is None
+
+
+def preview_entry(answer):
+    # Come HISTORY_LIST_PROJECTION: un carattere oltre l'anteprima
+    return {"id": "v", "question": "d", "answer_preview": answer[:server.HISTORY_PREVIEW_CHARS + 1],
+            "created_at": "2026-01-01T00:00:00+00:00"}
+
+
+def test_long_previews_are_marked_as_truncated():
+    answer = "sangue " * (server.HISTORY_PREVIEW_CHARS // 7 + 1)
+
+    item = server.history_page([preview_entry(answer)], 1).items[0]
+    assert item.answer_preview == answer[:server.HISTORY_PREVIEW_CHARS].rstrip() + "…"
+
+
+def test_answers_exactly_as_long_as_the_preview_are_not_marked():
+    answer = "s" * server.HISTORY_PREVIEW_CHARS
+
+    item = server.history_page([preview_entry(answer)], 1).items[0]
+    assert item.answer_preview == answer
+
+
+@pytest.mark.parametrize("cursor", ["senza-virgola", ",voce-01", "2026-03-01T20:00:00+00:00,"])
+def test_malformed_cursors_are_rejected(cursor):
+    with pytest.raises(HTTPException) as exc:
+        server.history_before_filter(cursor)
+    assert exc.value.status_code == 400
+
+
+def test_type_filter_keeps_its_public_name(history, monkeypatch):
+    client = TestClient(server.app)
+    server.app.dependency_overrides[server.get_current_user] = lambda: USER
+    try:
+        challenges = client.get("/api/chat/history/search", params={"type": "challenge"})
+        invalid = client.get("/api/chat/history/search", params={"type": "sogno"})
+    finally:
+        server.app.dependency_overrides.clear()
+
+    assert challenges.status_code == 200
+    assert [hit["id"] for hit in challenges.json()["items"]] == ["voce-08", "voce-04", "voce-00"]
+    assert invalid.status_code == 400
+
+
+def assert_ranges_cover(highlight, words):
+    assert [highlight.snippet[a:b] for a, b in highlight.ranges] == words
+
+
+def test_highlight_ranges_point_at_the_matched_words():
+    stems = set(server.analyze_text("porte"))
+    highlight = server.history_highlights("answer", "La porta della cripta e le Porte del tempio", stems)
+
+    assert highlight.field == "answer"
+    assert highlight.snippet == "La porta della cripta e le Porte del tempio"
+    assert_ranges_cover(highlight, ["porta", "Porte"])
+
+
+def test_highlight_ranges_account_for_the_leading_ellipsis():
+    text = "Nelle notti di luna piena " * 10 + "il sangue scorre nella cripta, sangue antico. " + "Fine. " * 40
+    highlight = server.history_highlights("answer", text, set(server.analyze_text("sangue")))
+
+    assert highlight.snippet.startswith("…")
+    assert highlight.snippet.endswith("…")
+    assert len(highlight.snippet) == server.HISTORY_SNIPPET_CHARS + 2
+    assert_ranges_cover(highlight, ["sangue", "sangue"])
+
+
+def test_highlight_drops_matches_outside_the_snippet():
+    text = "sangue " + "parola " * 60 + "sangue"
+    highlight = server.history_highlights("question", text, set(server.analyze_text("sangue")))
+
+    assert not highlight.snippet.startswith("…")
+    assert_ranges_cover(highlight, ["sangue"])
+
+
+def test_no_highlight_without_matches():
+    assert server.history_highlights("question", "Nessun termine", set(server.analyze_text("sangue"))) is None
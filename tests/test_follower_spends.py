@@ -0,0 +1,161 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+import server
+
+PAST_MONTH = "2020-01"
+
+
+@pytest.fixture
+def spends(mock_db):
+    asyncio.run(mock_db.users.insert_many([
+        {"id": pg, "username": pg, "max_actions": 20, "used_actions": 0, "effective_max_actions": 23}
+        for pg in ("pg-1", "pg-2", "pg-3")
+    ]))
+    return server.get_month_key(datetime.now(timezone.utc))
+
+
+def log_entry(user_id, month_key, amount):
+    return {"id": f"{user_id}-{month_key}-{amount}", "user_id": user_id, "month_key": month_key, "amount": amount,
+            "created_at": f"{month_key}-01T00:00:00+00:00"}
+
+
+def test_recorded_spends_match_the_log(spends, mock_db):
+    async def scenario():
+        await server.record_follower_spend("pg-1", 2)
+        await server.record_follower_spend("pg-1", 1)
+        mismatches = await server.reconcile_follower_spend_totals()
+        return mismatches, await server.get_follower_spent_this_month("pg-1"), await mock_db.users.find_one({"id": "pg-1"})
+
+    mismatches, spent, user = asyncio.run(scenario())
+    assert mismatches == []
+    assert spent == 3
+    assert user["effective_max_actions"] == 20
+
+
+def test_reconcile_rebuilds_counters_from_the_log(spends, mock_db):
+    current_month = spends
+
+    async def scenario():
+        await mock_db.follower_spends.insert_many([
+            # Contatore rimasto indietro nel mese corrente (scrittura persa tra log e $inc)
+            log_entry("pg-1", current_month, 2), log_entry("pg-1", current_month, 1),
+            # Mese passato con contatore sbagliato
+            log_entry("pg-2", PAST_MONTH, 2),
+            # Già allineato
+            log_entry("pg-3", current_month, 1),
+        ])
+        await mock_db.follower_spend_totals.insert_many([
+            {"user_id": "pg-1", "month_key": current_month, "amount": 1},
+            {"user_id": "pg-2", "month_key": PAST_MONTH, "amount": 5},
+            {"user_id": "pg-3", "month_key": current_month, "amount": 1},
+            # Contatore senza voci nel log
+            {"user_id": "pg-3", "month_key": PAST_MONTH, "amount": 4},
+        ])
+        first = await server.reconcile_follower_spend_totals()
+        second = await server.reconcile_follower_spend_totals()
+        totals = {
+            (t["user_id"], t["month_key"]): t["amount"]
+            async for t in mock_db.follower_spend_totals.find({}, {"_id": 0})
+        }
+        limits = {u["id"]: u["effective_max_actions"] async for u in mock_db.users.find({}, {"_id": 0})}
+        return first, second, totals, limits
+
+    first, second, totals, limits = asyncio.run(scenario())
+    assert sorted(first, key=lambda m: (m["user_id"], m["month_key"])) == [
+        {"user_id": "pg-1", "month_key": current_month, "counter": 1, "log": 3},
+        {"user_id": "pg-2", "month_key": PAST_MONTH, "counter": 5, "log": 2},
+        {"user_id": "pg-3", "month_key": PAST_MONTH, "counter": 4, "log": 0},
+    ]
+    assert second == []
+    assert totals == {
+        ("pg-1", current_month): 3,
+        ("pg-2", PAST_MONTH): 2,
+        ("pg-3", current_month): 1,
+        ("pg-3", PAST_MONTH): 0,
+    }
+    # Solo il mese corrente sposta il limite effettivo, della differenza corretta
+    assert limits == {"pg-1": 21, "pg-2": 23, "pg-3": 23}
+
+
+def test_spends_leave_legacy_limits_to_be_recomputed(spends, mock_db):
+    async def scenario():
+        await mock_db.users.insert_many([
+            {"id": "pg-vecchio", "username": "pg-vecchio", "max_actions": 20, "used_actions": 0},
+            {"id": "pg-nullo", "username": "pg-nullo", "max_actions": 20, "used_actions": 0, "effective_max_actions": None},
+        ])
+        await mock_db.backgrounds.insert_many([
+            {"user_id": "pg-vecchio", "seguaci": 3}, {"user_id": "pg-nullo", "seguaci": 3}
+        ])
+        for user_id in ("pg-vecchio", "pg-nullo"):
+            await server.record_follower_spend(user_id, 2)
+        after_spend = {u["id"]: u async for u in mock_db.users.find({"id": {"$in": ["pg-vecchio", "pg-nullo"]}}, {"_id": 0})}
+        limits = {
+            user_id: await server.get_effective_max_actions(user)
+            for user_id, user in after_spend.items()
+        }
+        return after_spend, limits
+
+    after_spend, limits = asyncio.run(scenario())
+    # Nessun limite inventato dalla spesa: manca ancora (o, su MongoDB, è stato rimosso)
+    assert "effective_max_actions" not in after_spend["pg-vecchio"]
+    assert not server.has_action_limit(after_spend["pg-nullo"])
+    # Ricalcolato dalle fonti alla prima lettura: 20 + 3 SEGUACI - 2 spesi
+    assert limits == {"pg-vecchio": 21, "pg-nullo": 21}
+
+
+def test_spend_between_the_two_reads_is_not_a_mismatch(spends, mock_db, monkeypatch):
+    current_month = spends
+    collection_class = type(mock_db.follower_spend_totals)
+    original_find = collection_class.find
+
+    class SpendBeforeIterating:
+        """Cursore dei contatori: la spesa arriva dopo l'aggregazione del log, prima della lettura"""
+
+        def __init__(self, collection, args, kwargs):
+            self.collection, self.args, self.kwargs = collection, args, kwargs
+
+        async def _documents(self):
+            await server.record_follower_spend("pg-1", 2)
+            async for doc in original_find(self.collection, *self.args, **self.kwargs):
+                yield doc
+
+        def __aiter__(self):
+            return self._documents()
+
+    def find(self, *args, **kwargs):
+        if self.name == "follower_spend_totals" and not getattr(find, "done", False):
+            find.done = True
+            return SpendBeforeIterating(self, args, kwargs)
+        return original_find(self, *args, **kwargs)
+
+    async def scenario():
+        await mock_db.follower_spends.insert_one(log_entry("pg-1", current_month, 1))
+        await mock_db.follower_spend_totals.insert_one({"user_id": "pg-1", "month_key": current_month, "amount": 1})
+        monkeypatch.setattr(collection_class, "find", find)
+        mismatches = await server.reconcile_follower_spend_totals()
+        return mismatches, await server.get_follower_spent_this_month("pg-1"), await mock_db.users.find_one({"id": "pg-1"})
+
+    mismatches, spent, user = asyncio.run(scenario())
+    assert mismatches == []
+    assert spent == 3
+    assert user["effective_max_actions"] == 21
+
+
+def test_spend_still_being_recorded_is_left_alone(spends, mock_db):
+    current_month = spends
+
+    async def scenario():
+        # Voce appena scritta nel log, $inc sul contatore non ancora arrivato
+        await mock_db.follower_spends.insert_one(
+            {**log_entry("pg-1", current_month, 2), "created_at": datetime.now(timezone.utc).isoformat()}
+        )
+        mismatches = await server.reconcile_follower_spend_totals()
+        return mismatches, await mock_db.follower_spend_totals.count_documents({}), await mock_db.users.find_one({"id": "pg-1"})
+
+    mismatches, counters, user = asyncio.run(scenario())
+    assert mismatches == []
+    assert counters == 0
+    assert user["effective_max_actions"] == 23
@@ -0,0 +1,110 @@
+import asyncio
+import threading
+
+import pytest
+
+import server
+
+ITALIAN_TEXT = (
+    "La congrega si riunisce nelle catacombe sotto la basilica di San Clemente, "
+    "dove i Nosferatu custodiscono gli archivi proibiti della città eterna. "
+) * 40
+
+
+def words_tokenizer(text):
+    # Stima pessimistica per l'italiano: due token per parola, più uno per ogni a capo
+    return 2 * len(text.split()) + text.count("\n")
+
+
+@pytest.fixture(params=["default", "words"])
+def tokenizer(request, monkeypatch):
+    if request.param == "words":
+        monkeypatch.setattr(server, "count_tokens", words_tokenizer)
+    return server.count_tokens
+
+
+@pytest.mark.parametrize("max_tokens", [8, 50, 400])
+def test_chunks_stay_within_budget(tokenizer, max_tokens):
+    text = "# Catacombe\n\n" + ITALIAN_TEXT + "\n\n" + "parolalunghissima" * 200 + "\n\nFine."
+    chunks = server.split_into_chunks(text, max_tokens)
+
+    assert chunks
+    for chunk in chunks:
+        assert chunk["tokens"] == tokenizer(chunk["text"])
+        assert chunk["tokens"] <= max_tokens
+
+
+def test_long_sentence_without_punctuation_is_split(tokenizer):
+    sentence = " ".join(["vampiro"] * 1000)
+    pieces = server._split_long_paragraph(sentence, 100)
+
+    assert len(pieces) > 1
+    assert all(tokenizer(piece) <= 100 for piece in pieces)
+    assert " ".join(pieces).split() == sentence.split()
+
+
+def test_short_paragraphs_are_packed_together(tokenizer):
+    chunks = server.split_into_chunks("Primo paragrafo.\n\nSecondo paragrafo.", 400)
+
+    assert [c["text"] for c in chunks] == ["Primo paragrafo.\n\nSecondo paragrafo."]
+
+
+def test_headings_start_new_chunks(tokenizer):
+    chunks = server.split_into_chunks("# Uno\nTesto uno.\n\n# Due\nTesto due.", 400)
+
+    assert [(c["section"], c["text"]) for c in chunks] == [("Uno", "Testo uno."), ("Due", "Testo due.")]
+
+
+def test_store_kb_chunks_chunks_in_a_thread(mock_db, monkeypatch):
+    built_in = []
+    original = server.build_kb_chunks
+
+    def recording_build(kb_doc):
+        built_in.append(threading.current_thread())
+        return original(kb_doc)
+
+    monkeypatch.setattr(server, "build_kb_chunks", recording_build)
+    kb_doc = {"id": "kb1", "title": "Catacombe", "content": ITALIAN_TEXT, "created_at": "2026-01-01T00:00:00+00:00"}
+
+    stored = asyncio.run(server.store_kb_chunks(kb_doc))
+
+    assert stored == asyncio.run(mock_db.knowledge_chunks.count_documents({"kb_id": "kb1"})) > 0
+    assert built_in and built_in[0] is not threading.main_thread()
+
+
+def test_storing_the_same_document_twice_adds_no_chunks(mock_db):
+    kb_doc = {"id": "kb1", "title": "Catacombe", "content": ITALIAN_TEXT, "created_at": "2026-01-01T00:00:00+00:00"}
+
+    async def scenario():
+        # Due processi che fanno il backfill dello stesso documento
+        first, second = await asyncio.gather(server.store_kb_chunks(kb_doc), server.store_kb_chunks(kb_doc))
+        return first, second, await mock_db.knowledge_chunks.count_documents({"kb_id": "kb1"})
+
+    first, second, stored = asyncio.run(scenario())
+    assert stored == first + second == max(first, second) > 0
+
+
+def test_backfill_runs_once_and_removes_duplicates(mock_db):
+    async def scenario():
+        await mock_db.knowledge_base.insert_many([
+            {"id": "kb1", "title": "Catacombe", "content": ITALIAN_TEXT, "created_at": "2026-01-01T00:00:00+00:00"},
+            {"id": "vuoto", "title": "Vuoto", "content": "", "created_at": "2026-01-02T00:00:00+00:00"},
+            {"id": "kb2", "title": "Doppio", "content": "Un solo paragrafo.", "created_at": "2026-01-03T00:00:00+00:00"},
+        ])
+        # Chunk già duplicato da due backfill concorrenti prima dell'indice unique
+        chunk = server.build_kb_chunks({"id": "kb2", "title": "Doppio", "content": "Un solo paragrafo."})[0]
+        await mock_db.knowledge_chunks.insert_many([dict(chunk), dict(chunk)])
+
+        await server.backfill_kb_chunks()
+        after_first = await server.get_collection_version("knowledge_base")
+        counts = {kb_id: await mock_db.knowledge_chunks.count_documents({"kb_id": kb_id}) for kb_id in ("kb1", "kb2", "vuoto")}
+        server._collection_versions.clear()
+        await server.backfill_kb_chunks()
+        after_second = await server.get_collection_version("knowledge_base")
+        return after_first, after_second, counts, await mock_db.maintenance.find_one({"id": "kb_chunks_built"})
+
+    after_first, after_second, counts, marker = asyncio.run(scenario())
+    assert counts["kb1"] > 0 and counts["kb2"] == 1 and counts["vuoto"] == 0
+    # Il documento vuoto non fa ripartire il backfill (e non invalida le cache) a ogni avvio
+    assert after_second == after_first > 0
+    assert marker["documents"] == 1
@@ -0,0 +1,49 @@
+import asyncio
+import threading
+
+import server
+
+
+def chunk(kb_id, position):
+    return {
+        "id": f"{kb_id}-{position}",
+        "kb_id": kb_id,
+        "title": kb_id,
+        "section": None,
+        "position": position,
+        "text": f"testo {kb_id} {position}",
+        "tokens": 4,
+        "required_contacts": [],
+        "required_mentor": None,
+        "required_notoriety": None,
+        "created_at": "2026-01-01T00:00:00+00:00",
+    }
+
+
+def test_chunks_of_documents_created_together_stay_grouped(mock_db, monkeypatch):
+    monkeypatch.setattr(server, "_kb_snapshot", None)
+    # Stesso created_at (import in blocco): inseriti alternati
+    asyncio.run(mock_db.knowledge_chunks.insert_many(
+        [chunk("b", 0), chunk("a", 0), chunk("b", 1), chunk("a", 1)]
+    ))
+
+    snapshot = asyncio.run(server.get_kb_snapshot())
+
+    assert [c["id"] for c in snapshot.chunks] == ["a-0", "a-1", "b-0", "b-1"]
+
+
+def test_snapshot_is_built_off_the_event_loop(mock_db, monkeypatch):
+    monkeypatch.setattr(server, "_kb_snapshot", None)
+    built_in = []
+    original = server.KBSnapshot
+
+    def recording_snapshot(version, chunks):
+        built_in.append(threading.current_thread())
+        return original(version, chunks)
+
+    monkeypatch.setattr(server, "KBSnapshot", recording_snapshot)
+    asyncio.run(mock_db.knowledge_chunks.insert_one(chunk("a", 0)))
+
+    asyncio.run(server.get_kb_snapshot())
+
+    assert built_in and built_in[0] is not threading.main_thread()
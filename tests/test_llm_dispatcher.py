@@ -0,0 +1,229 @@
+import asyncio
+
+import pytest
+
+import server
+from server import LLMDispatcher
+
+
+class FakeRateLimit(Exception):
+    status_code = 429
+
+
+async def settle():
+    """Lascia girare i task pronti finché la coda del dispatcher non si stabilizza"""
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def test_in_flight_calls_never_exceed_the_limit():
+    async def scenario():
+        dispatcher = LLMDispatcher(2)
+        gate = asyncio.Event()
+        running, peak = 0, 0
+
+        async def fake_llm():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await gate.wait()
+            running -= 1
+            return "risposta"
+
+        tasks = [asyncio.create_task(dispatcher.call(f"user-{i}", fake_llm)) for i in range(6)]
+        await settle()
+        status = dispatcher.status()
+        gate.set()
+        results = await asyncio.gather(*tasks)
+        return peak, status, results, dispatcher.status()
+
+    peak, status, results, final = asyncio.run(scenario())
+
+    assert peak == 2
+    assert status["in_flight"] == 2 and status["queue_depth"] == 4
+    assert results == ["risposta"] * 6
+    assert final["in_flight"] == 0 and final["queue_depth"] == 0
+
+
+def test_waiting_users_are_served_round_robin():
+    async def scenario():
+        dispatcher = LLMDispatcher(1)
+        served = []
+        gates = {}
+
+        def fake_llm(name):
+            async def call():
+                served.append(name)
+                gates[name] = asyncio.Event()
+                await gates[name].wait()
+            return call
+
+        tasks = [asyncio.create_task(dispatcher.call("alice", fake_llm("alice-1")))]
+        await settle()
+        # alice accoda altre tre domande prima che bob e carla ne facciano una
+        for user_id, name in [("alice", "alice-2"), ("alice", "alice-3"), ("alice", "alice-4"),
+                              ("bob", "bob-1"), ("carla", "carla-1")]:
+            tasks.append(asyncio.create_task(dispatcher.call(user_id, fake_llm(name))))
+            await settle()
+        while len(served) < len(tasks):
+            gates[served[-1]].set()
+            await settle()
+        gates[served[-1]].set()
+        await asyncio.gather(*tasks)
+        return served
+
+    served = asyncio.run(scenario())
+
+    assert served == ["alice-1", "alice-2", "bob-1", "carla-1", "alice-3", "alice-4"]
+
+
+def test_rate_limits_are_retried_with_backoff_outside_the_slot(monkeypatch):
+    dispatcher = LLMDispatcher(1)
+    backoffs = []
+
+    def fake_retry_delay(attempt):
+        # Durante l'attesa il posto deve essere libero per gli altri
+        backoffs.append((attempt, dispatcher.in_flight))
+        return 0
+
+    monkeypatch.setattr(server, "retry_delay", fake_retry_delay)
+    attempts = 0
+
+    async def flaky_llm():
+        nonlocal attempts
+        attempts += 1
+        if attempts < 3:
+            raise FakeRateLimit("429 Too Many Requests")
+        return "risposta"
+
+    assert asyncio.run(dispatcher.call("alice", flaky_llm)) == "risposta"
+    assert attempts == 3
+    assert backoffs == [(0, 0), (1, 0)]
+
+
+def test_rate_limit_retries_are_bounded(monkeypatch):
+    monkeypatch.setattr(server, "retry_delay", lambda attempt: 0)
+    dispatcher = LLMDispatcher(1)
+    attempts = 0
+
+    async def always_limited():
+        nonlocal attempts
+        attempts += 1
+        raise FakeRateLimit("rate limit")
+
+    with pytest.raises(FakeRateLimit):
+        asyncio.run(dispatcher.call("alice", always_limited))
+    assert attempts == server.LLM_MAX_RETRIES + 1
+    assert dispatcher.in_flight == 0
+
+
+def test_other_errors_are_not_retried(monkeypatch):
+    monkeypatch.setattr(server, "retry_delay", lambda attempt: 0)
+    dispatcher = LLMDispatcher(1)
+    attempts = 0
+
+    async def broken_llm():
+        nonlocal attempts
+        attempts += 1
+        raise ValueError("risposta non valida")
+
+    with pytest.raises(ValueError):
+        asyncio.run(dispatcher.call("alice", broken_llm))
+    assert attempts == 1
+    assert dispatcher.in_flight == 0
+
+
+def test_cancelled_calls_release_or_leave_the_queue():
+    async def scenario():
+        dispatcher = LLMDispatcher(1)
+        gate = asyncio.Event()
+
+        async def slow_llm():
+            await gate.wait()
+
+        running = asyncio.create_task(dispatcher.call("alice", slow_llm))
+        waiting = asyncio.create_task(dispatcher.call("bob", slow_llm))
+        await settle()
+        assert dispatcher.status()["queue_depth"] == 1
+
+        # Chi è in coda esce dalla coda senza toccare i posti occupati
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert dispatcher.status()["queue_depth"] == 0 and dispatcher.in_flight == 1
+
+        # Chi è in corso libera il posto
+        running.cancel()
+        await asyncio.gather(running, return_exceptions=True)
+        return dispatcher.in_flight
+
+    assert asyncio.run(scenario()) == 0
+
+
+def test_slot_handed_to_a_cancelled_waiter_is_passed_on():
+    async def scenario():
+        dispatcher = LLMDispatcher(1)
+        await dispatcher._acquire("alice")
+        waiter = asyncio.create_task(dispatcher._acquire("bob"))
+        await settle()
+
+        # Il posto passa a bob, che viene cancellato prima di poterlo usare
+        dispatcher._release()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        return dispatcher.in_flight, dispatcher.queue_depth
+
+    assert asyncio.run(scenario()) == (0, 0)
+
+
+def test_stream_holds_the_slot_until_it_ends_or_is_closed():
+    async def scenario():
+        dispatcher = LLMDispatcher(1)
+
+        async def fake_stream():
+            for text in ["La ", "notte ", "è ", "giovane."]:
+                yield text
+
+        seen_in_flight = []
+        parts = []
+        async for text in dispatcher.stream("alice", fake_stream):
+            seen_in_flight.append(dispatcher.in_flight)
+            parts.append(text)
+        after_end = dispatcher.in_flight
+
+        # Client che si disconnette dopo il primo frammento
+        stream = dispatcher.stream("bob", fake_stream)
+        await stream.__anext__()
+        during = dispatcher.in_flight
+        await stream.aclose()
+        return "".join(parts), seen_in_flight, after_end, during, dispatcher.in_flight
+
+    text, seen_in_flight, after_end, during, after_close = asyncio.run(scenario())
+
+    assert text == "La notte è giovane."
+    assert seen_in_flight == [1, 1, 1, 1]
+    assert (after_end, during, after_close) == (0, 1, 0)
+
+
+def test_stream_retries_only_before_the_first_fragment(monkeypatch):
+    monkeypatch.setattr(server, "retry_delay", lambda attempt: 0)
+    dispatcher = LLMDispatcher(1)
+    attempts = 0
+
+    async def limited_then_streaming():
+        nonlocal attempts
+        attempts += 1
+        if attempts == 1:
+            raise FakeRateLimit("429")
+        yield "ok"
+        raise FakeRateLimit("429 a metà risposta")
+
+    async def consume():
+        parts = []
+        async for text in dispatcher.stream("alice", limited_then_streaming):
+            parts.append(text)
+        return parts
+
+    with pytest.raises(FakeRateLimit):
+        asyncio.run(consume())
+    assert attempts == 2
+    assert dispatcher.in_flight == 0
@@ -0,0 +1,103 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+import server
+
+LAST_MONTH_RESET = "2020-01-01T00:00:00+00:00"
+
+
+def user_doc(user_id, **fields):
+    return {"id": user_id, "username": user_id, "max_actions": 20, "used_actions": 7, **fields}
+
+
+@pytest.fixture
+def reset_state(mock_db, monkeypatch):
+    """Processo appena avviato: non sa ancora se il reset del mese è stato fatto"""
+    monkeypatch.setattr(server, "_monthly_reset_month", None)
+    monkeypatch.setattr(server, "_monthly_reset_lock", asyncio.Lock())
+    now = datetime.now(timezone.utc)
+    return server.get_month_key(now), datetime(now.year, now.month, 1, tzinfo=timezone.utc).isoformat()
+
+
+async def users_by_id(mock_db):
+    return {u["id"]: u async for u in mock_db.users.find({}, {"_id": 0})}
+
+
+def test_users_reset_in_an_earlier_month_start_over(reset_state, mock_db):
+    current_month, _ = reset_state
+
+    async def scenario():
+        await mock_db.users.insert_many([
+            user_doc("pg-1", last_action_reset=LAST_MONTH_RESET, followers_total=3, effective_max_actions=21),
+            user_doc("pg-2", max_actions=15, last_action_reset=LAST_MONTH_RESET, followers_total=0, effective_max_actions=10),
+        ])
+        reset = await server.run_monthly_reset()
+        return reset, await users_by_id(mock_db)
+
+    reset, users = asyncio.run(scenario())
+    assert reset == 2
+    assert {u["id"]: u["used_actions"] for u in users.values()} == {"pg-1": 0, "pg-2": 0}
+    # Nuovo mese senza SEGUACI spesi: max_actions + followers_total
+    assert {u["id"]: u["effective_max_actions"] for u in users.values()} == {"pg-1": 23, "pg-2": 15}
+    assert all(server.get_month_key(datetime.fromisoformat(u["last_action_reset"])) == current_month
+               for u in users.values())
+
+
+def test_users_without_a_reset_date_only_get_the_date(reset_state, mock_db):
+    current_month, _ = reset_state
+
+    async def scenario():
+        await mock_db.users.insert_many([
+            user_doc("pg-senza-data", followers_total=3, effective_max_actions=21),
+            user_doc("pg-data-vuota", last_action_reset="", followers_total=3, effective_max_actions=21),
+        ])
+        reset = await server.run_monthly_reset()
+        return reset, await users_by_id(mock_db)
+
+    reset, users = asyncio.run(scenario())
+    assert reset == 0
+    for user in users.values():
+        assert user["used_actions"] == 7
+        assert user["effective_max_actions"] == 21
+        assert server.get_month_key(datetime.fromisoformat(user["last_action_reset"])) == current_month
+
+
+def test_users_already_reset_this_month_are_left_alone(reset_state, mock_db):
+    _, month_start = reset_state
+    untouched = user_doc("pg-1", last_action_reset=month_start, followers_total=3, effective_max_actions=21)
+
+    async def scenario():
+        await mock_db.users.insert_one(dict(untouched))
+        reset = await server.run_monthly_reset()
+        return reset, await mock_db.users.find_one({"id": "pg-1"}, {"_id": 0})
+
+    reset, user = asyncio.run(scenario())
+    assert reset == 0
+    assert user == untouched
+
+
+def test_a_second_run_in_the_same_month_resets_nobody(reset_state, mock_db, monkeypatch):
+    current_month, _ = reset_state
+
+    async def scenario():
+        await mock_db.users.insert_one(
+            user_doc("pg-1", last_action_reset=LAST_MONTH_RESET, followers_total=0, effective_max_actions=20)
+        )
+        first = await server.run_monthly_reset()
+        # Un altro processo, avviato dopo il reset, trova il marcatore; le azioni usate nel frattempo restano
+        await mock_db.users.update_one({"id": "pg-1"}, {"$set": {"used_actions": 4, "last_action_reset": LAST_MONTH_RESET}})
+        monkeypatch.setattr(server, "_monthly_reset_month", None)
+        second = await server.run_monthly_reset()
+        # Questo processo sa già che il mese è fatto: nessuna lettura del marcatore
+        await server.ensure_monthly_reset()
+        marker = await mock_db.maintenance.find_one({"id": server.MONTHLY_RESET_MARKER}, {"_id": 0})
+        return first, second, marker, await mock_db.users.find_one({"id": "pg-1"})
+
+    first, second, marker, user = asyncio.run(scenario())
+    assert (first, second) == (1, 0)
+    assert marker["month"] == current_month
+    assert marker["reset_users"] == 1
+    assert user["used_actions"] == 4
+    assert server._monthly_reset_month == current_month
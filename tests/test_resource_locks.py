@@ -0,0 +1,168 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from pymongo.errors import PyMongoError
+
+import server
+
+USER = {"id": "pg-1"}
+
+
+def as_utc(moment):
+    return moment.replace(tzinfo=timezone.utc) if moment.tzinfo is None else moment
+
+
+@pytest.fixture
+def resources(mock_db):
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    asyncio.run(mock_db.backgrounds.insert_one({"user_id": USER["id"], "risorse": 10, "locked_resources": 0}))
+    asyncio.run(mock_db.resource_items.insert_one({
+        "id": "pugnale", "name": "Pugnale", "description": "", "cost_resources": 2,
+        "block_until": (now + timedelta(days=3)).isoformat()
+    }))
+    return now
+
+
+def test_purchase_during_refresh_keeps_its_unlock_time(resources, mock_db, monkeypatch):
+    now = resources
+
+    async def scenario():
+        # Un lock appena scaduto e già rilasciato: next_unlock_at è vecchio e va tolto
+        await mock_db.backgrounds.update_one({"user_id": USER["id"]}, {"$set": {"next_unlock_at": now - timedelta(minutes=1)}})
+
+        # mongomock_motor si presenta come AsyncIOMotorCollection: type() dà la classe vera
+        collection_class = type(mock_db.resource_locks)
+        original_find_one = collection_class.find_one
+        purchased = []
+
+        async def find_one_with_purchase(self, *args, **kwargs):
+            result = await original_find_one(self, *args, **kwargs)
+            if self.name == "resource_locks" and not purchased:
+                # L'acquisto arriva dopo la lettura dei lock, prima della scrittura di refresh_next_unlock.
+                # Segnaposto prima dell'await: anche il refresh fatto dall'acquisto passa da qui
+                purchased.append(None)
+                purchased[0] = await server.purchase_resource(server.ResourcePurchaseRequest(item_id="pugnale"), USER)
+            return result
+
+        monkeypatch.setattr(collection_class, "find_one", find_one_with_purchase)
+        await server.refresh_next_unlock(USER["id"])
+        return await mock_db.backgrounds.find_one({"user_id": USER["id"]})
+
+    bg = asyncio.run(scenario())
+    assert bg["locked_resources"] == 2
+    assert as_utc(bg["next_unlock_at"]) == now + timedelta(days=3)
+
+
+def test_refresh_drops_the_unlock_time_when_no_lock_is_left(resources, mock_db):
+    now = resources
+
+    async def scenario():
+        await mock_db.backgrounds.update_one({"user_id": USER["id"]}, {"$set": {"next_unlock_at": now - timedelta(minutes=1)}})
+        await server.refresh_next_unlock(USER["id"])
+        return await mock_db.backgrounds.find_one({"user_id": USER["id"]})
+
+    assert "next_unlock_at" not in asyncio.run(scenario())
+
+
+def test_sweeps_never_release_a_lock_twice(resources, mock_db, monkeypatch):
+    now = resources
+    in_three_days = now + timedelta(days=3)
+
+    def lock(lock_id, amount, expires_at, status="active"):
+        return {"id": lock_id, "user_id": USER["id"], "item_id": "pugnale", "amount": amount,
+                "expires_at": expires_at, "status": status}
+
+    async def scenario():
+        await mock_db.backgrounds.update_one(
+            {"user_id": USER["id"]},
+            {"$set": {"locked_resources": 5, "next_unlock_at": now - timedelta(hours=2)}}
+        )
+        await mock_db.resource_locks.insert_many([
+            lock("scaduto-1", 2, now - timedelta(hours=2)),
+            lock("scaduto-2", 1, now - timedelta(minutes=5)),
+            lock("attivo", 2, in_three_days),
+            lock("già-rilasciato", 3, now - timedelta(days=1), status="released"),
+        ])
+        # Un altro processo fa lo sweep completo dopo che questo ha già letto i lock scaduti
+        collection_class = type(mock_db.resource_locks)
+        original_update_one = collection_class.update_one
+        other_sweep = []
+
+        async def update_one_after_other_sweep(self, *args, **kwargs):
+            if self.name == "resource_locks" and not other_sweep:
+                # Segnaposto prima dell'await: anche lo sweep annidato passa da qui
+                other_sweep.append(None)
+                other_sweep[0] = await server.release_expired_locks(USER["id"])
+            return await original_update_one(self, *args, **kwargs)
+
+        monkeypatch.setattr(collection_class, "update_one", update_one_after_other_sweep)
+        first = await server.release_expired_locks()
+        concurrent = [first, other_sweep[0]]
+        later = await server.release_expired_locks()
+        statuses = {l["id"]: l["status"] async for l in mock_db.resource_locks.find({}, {"_id": 0})}
+        return concurrent, later, statuses, await mock_db.backgrounds.find_one({"user_id": USER["id"]})
+
+    concurrent, later, statuses, bg = asyncio.run(scenario())
+    assert sum(concurrent) == 2
+    assert later == 0
+    assert statuses == {"scaduto-1": "released", "scaduto-2": "released", "attivo": "active", "già-rilasciato": "released"}
+    assert bg["locked_resources"] == 2
+    assert as_utc(bg["next_unlock_at"]) == in_three_days
+
+
+def test_purchase_releases_an_expired_lock_the_sweeper_has_not_reached(resources, mock_db):
+    now = resources
+    expired_at = now - timedelta(minutes=5)
+
+    async def scenario():
+        # Tutte le RISORSE bloccate da un lock già scaduto, non ancora rilasciato
+        await mock_db.backgrounds.update_one(
+            {"user_id": USER["id"]},
+            {"$set": {"locked_resources": 10, "next_unlock_at": expired_at}}
+        )
+        await mock_db.resource_locks.insert_one({
+            "id": "scaduto", "user_id": USER["id"], "item_id": "pugnale", "amount": 10,
+            "expires_at": expired_at, "status": "active"
+        })
+        response = await server.purchase_resource(server.ResourcePurchaseRequest(item_id="pugnale"), USER)
+        expired = await mock_db.resource_locks.find_one({"id": "scaduto"})
+        return response, expired, await mock_db.backgrounds.find_one({"user_id": USER["id"]})
+
+    response, expired, bg = asyncio.run(scenario())
+    assert expired["status"] == "released"
+    assert bg["locked_resources"] == 2
+    assert as_utc(bg["next_unlock_at"]) == now + timedelta(days=3)
+    assert response.locked_resources == 2
+
+
+
+@pytest.mark.parametrize("failing_write", ["lock", "unlock_time"])
+def test_failed_purchase_unlocks_the_reserved_resources(resources, mock_db, monkeypatch, failing_write):
+    collection_class = type(mock_db.resource_locks)
+    original_insert_one, original_update_one = collection_class.insert_one, collection_class.update_one
+
+    async def insert_one(self, *args, **kwargs):
+        if failing_write == "lock" and self.name == "resource_locks":
+            raise PyMongoError("inserimento del lock fallito")
+        return await original_insert_one(self, *args, **kwargs)
+
+    async def update_one(self, query, update, *args, **kwargs):
+        # Lock inserito, ma la sua scadenza non viene pubblicata
+        if failing_write == "unlock_time" and "$min" in update:
+            raise PyMongoError("aggiornamento di next_unlock_at fallito")
+        return await original_update_one(self, query, update, *args, **kwargs)
+
+    monkeypatch.setattr(collection_class, "insert_one", insert_one)
+    monkeypatch.setattr(collection_class, "update_one", update_one)
+
+    async def scenario():
+        with pytest.raises(PyMongoError):
+            await server.purchase_resource(server.ResourcePurchaseRequest(item_id="pugnale"), USER)
+        locks = await mock_db.resource_locks.count_documents({})
+        return locks, await mock_db.backgrounds.find_one({"user_id": USER["id"]})
+
+    locks, bg = asyncio.run(scenario())
+    assert locks == 0
+    assert bg["locked_resources"] == 0
+    assert "next_unlock_at" not in bg